@@ -1,7 +1,7 @@
 #!/bin/bash
 script_name="pycodesign"
 
-tar cvzf $script_name.tgz ./$script_name.py
+tar cvzf $script_name.tgz ./$script_name.py ./${script_name}_core.py
 
 git commit -m "refresh tgz" $script_name.tgz
 git push
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""Benchmark harness for pycodesign.py
+
+Runs sign(), package(), notarize() and main() against synthetic file trees using
+stub `codesign`, `ditto`, `productbuild`, `xcrun` and `stapler` executables placed
+at the front of $PATH, so the whole pipeline can be timed on Linux or macOS
+without touching a keychain or Apple's servers.
+
+Each scenario runs in its own python process so peak RSS is measured per scenario.
+Results are written as json and can be compared with an earlier run:
+
+    $ ./pycodesign_bench.py --sizes 10,1000,10000
+    $ ./pycodesign_bench.py --sizes 10,1000,10000 --compare bench_results/20231101-120000.json
+
+`--startup` instead checks how quickly `pycodesign.py -V`, `-h` and `-N` start and
+that they do not import the modules only the pipeline stages need; it exits
+with status 1 if either regresses:
+
+    $ ./pycodesign_bench.py --startup --max-startup-ms 100
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import py_compile
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+SCENARIOS = ('sign-deep', 'sign-jobs', 'sign-inside-out', 'sign-cached',
+             'package-auto', 'package-copy', 'package-ditto', 'notarize', 'main')
+
+# command lines that must start quickly and the modules they must not import
+STARTUP_COMMANDS = (('-V',), ('-h',), ('-N',))
+DEFERRED_MODULES = ('asyncio', 'subprocess', 'concurrent.futures', 'tempfile', 'hashlib',
+                    'json', 'selectors', 'mmap', 'glob', 'random')
+
+MACHO_HEADER = b'\xcf\xfa\xed\xfe\x07\x00\x00\x01'
+
+# stub tools; latency (seconds) and output volume (bytes) are read from
+# BENCH_<TOOL>_LATENCY and BENCH_<TOOL>_OUTPUT
+STUB_HEADER = '''#!/bin/sh
+latency=${BENCH_%(name)s_LATENCY:-0}
+output=${BENCH_%(name)s_OUTPUT:-0}
+[ "$latency" != "0" ] && sleep "$latency"
+[ "$output" != "0" ] && head -c "$output" /dev/zero | tr '\\0' 'x' >&2
+'''
+
+STUBS = {
+    'codesign': STUB_HEADER % {'name': 'CODESIGN'} + 'exit 0\n',
+    'ditto': STUB_HEADER % {'name': 'DITTO'} + 'mkdir -p "$(dirname "$2")" && cp -R "$1" "$2"\n',
+    'productbuild': STUB_HEADER % {'name': 'PRODUCTBUILD'} + 'for a; do last=$a; done\necho pkg > "$last"\n',
+    'stapler': STUB_HEADER % {'name': 'STAPLER'} + 'echo "The staple and validate action worked!"\n',
+    'xcrun': STUB_HEADER % {'name': 'XCRUN'} + '''case "$1 $2" in
+    "notarytool submit") echo '{"id": "bench-submission", "message": "Successfully uploaded file"}' ;;
+    "notarytool info") echo '{"id": "bench-submission", "status": "Accepted"}' ;;
+    "notarytool log") echo '{"status": "Accepted", "issues": null}' ;;
+    stapler*) echo "The staple and validate action worked!" ;;
+esac
+exit 0
+''',
+}
+
+
+
+
+
+
+def write_stubs(directory):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, script in STUBS.items():
+        path = directory/name
+        path.write_text(script)
+        path.chmod(0o755)
+    return directory
+
+
+
+
+
+
+def make_tree(root, count, file_size=64, macho_ratio=0.2):
+    """build a PyInstaller onedir-like tree of `count` files; returns (bundle dir, mach-o files)"""
+    bundle = Path(root)/'dist'/'benchtool'
+    internal = bundle/'_internal'
+    framework = internal/'Python.framework'/'Versions'/'3.11'
+    framework.mkdir(parents=True, exist_ok=True)
+
+    machos = []
+    main = bundle/'benchtool'
+    main.write_bytes(MACHO_HEADER + b'\0'*file_size)
+    machos.append(main)
+    (framework/'Python').write_bytes(MACHO_HEADER + b'\0'*file_size)
+
+    every = max(1, round(1/macho_ratio)) if macho_ratio else 0
+    for i in range(max(0, count - 2)):
+        directory = internal/'lib'/f'pkg{i // 500:03d}'
+        if i % 500 == 0:
+            directory.mkdir(parents=True, exist_ok=True)
+        if every and i % every == 0:
+            path = directory/f'mod{i:05d}.cpython-311-darwin.so'
+            path.write_bytes(MACHO_HEADER + b'\0'*file_size)
+            machos.append(path)
+        else:
+            path = directory/f'mod{i:05d}.pyc'
+            path.write_bytes(b'\0'*file_size)
+    return bundle, machos
+
+
+
+
+
+
+def make_config(workdir, file_list, **main):
+    return {
+        'identification': {'application_id': 'BENCH', 'installer_id': 'BENCH', 'keychain-profile': 'bench'},
+        'package_details': {'package_name': 'benchtool', 'bundle_id': 'com.example.benchtool',
+                            'file_list': [str(f) for f in file_list], 'installation_path': '/usr/local/bin',
+                            'entitlements': 'None', 'version': '1.0.0'},
+        # every per-user cache lives in the workdir: a ledger entry from an earlier run
+        # would skip the upload and the notarize scenario would measure nothing
+        'main': {'cache': 'no', 'notarize_timer': '0.01', 'cache_dir': str(Path(workdir)/'cache'),
+                 'digest_cache': str(Path(workdir)/'digests.json'),
+                 'tree_index': str(Path(workdir)/'tree-index.json'),
+                 'identity_cache': str(Path(workdir)/'identities.json'),
+                 'ledger_file': str(Path(workdir)/'notary-ledger.json'),
+                 'notary_scheduler_file': str(Path(workdir)/'notary-scheduler.json'),
+                 'resolve_identity': 'no', **main},
+    }
+
+
+
+
+
+
+def write_ini(path, config):
+    lines = []
+    for section, values in config.items():
+        lines.append(f'[{section}]')
+        for key, value in values.items():
+            value = ','.join(value) if isinstance(value, list) else value
+            lines.append(f'{key} = {value}')
+    Path(path).write_text('\n'.join(lines) + '\n')
+
+
+
+
+
+
+def peak_rss_mb():
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on macOS, KB everywhere else
+    return usage/1024**2 if sys.platform == 'darwin' else usage/1024
+
+
+
+
+
+
+def run_one(scenario, size, workdir, jobs):
+    """run a single scenario in this process and return its measurements"""
+    sys.path.insert(0, str(HERE))
+    sys.argv = [sys.argv[0]]
+    import pycodesign_core as pycodesign
+
+    os.chdir(workdir)
+    bundle, machos = make_tree(workdir, size)
+    count = len(machos)
+
+    if scenario == 'sign-deep':
+        config = make_config(workdir, [bundle])
+        function = lambda: pycodesign.sign(config)
+    elif scenario == 'sign-jobs':
+        config = make_config(workdir, machos, jobs=jobs)
+        function = lambda: pycodesign.sign(config)
+    elif scenario == 'sign-inside-out':
+        config = make_config(workdir, [bundle], jobs=jobs, inside_out='yes')
+        function = lambda: pycodesign.sign(config)
+    elif scenario == 'sign-cached':
+        config = make_config(workdir, machos, jobs=jobs, cache='yes')
+        with contextlib.redirect_stdout(io.StringIO()):
+            pycodesign.sign(make_config(workdir, machos, jobs=jobs, cache='yes'))
+        function = lambda: pycodesign.sign(config)
+    elif scenario.startswith('package-'):
+        config = make_config(workdir, [bundle], staging=scenario.split('-', 1)[1])
+        count = size
+        function = lambda: pycodesign.package(config)
+    elif scenario == 'notarize':
+        config = make_config(workdir, [bundle])
+        Path('benchtool.pkg').write_bytes(b'pkg')
+        count = 1
+        function = lambda: pycodesign.notarize(config)
+    elif scenario == 'main':
+        config = make_config(workdir, [bundle], jobs=jobs, inside_out='yes')
+        write_ini('bench.ini', config)
+        sys.argv = ['pycodesign.py', '--fresh', 'bench.ini']
+        count = size
+        function = pycodesign.main
+    else:
+        raise ValueError(f'unknown scenario: {scenario}')
+
+    records = len(pycodesign.RUN_RECORDS)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    seconds = time.perf_counter() - start
+
+    return_code = result[0] if isinstance(result, tuple) else 0
+    return {'scenario': scenario, 'size': size, 'items': count, 'seconds': seconds,
+            'items_per_second': count/seconds if seconds else None,
+            'subprocesses': len(pycodesign.RUN_RECORDS) - records,
+            'peak_rss_mb': peak_rss_mb(), 'return_code': return_code}
+
+
+
+
+
+
+def run_scenario(scenario, size, env, jobs):
+    with tempfile.TemporaryDirectory(prefix='pycodesign-bench-') as workdir:
+        cmd = subprocess.run([sys.executable, __file__, '--run-one', scenario, str(size), workdir, str(jobs)],
+                             env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if cmd.returncode != 0:
+            return {'scenario': scenario, 'size': size, 'error': cmd.stderr.decode(errors='replace')[-2000:]}
+        return json.loads(cmd.stdout.decode().strip().splitlines()[-1])
+
+
+
+
+
+
+def format_results(results, previous=None):
+    baseline = {(r['scenario'], r['size']): r for r in (previous or {}).get('results', [])}
+    header = ['scenario', 'size', 'seconds', 'items/s', 'subprocs', 'rss MB'] + (['vs previous'] if previous else [])
+    rows = []
+    for r in results:
+        if 'error' in r:
+            rows.append([r['scenario'], str(r['size']), 'error', '', '', ''] + ([''] if previous else []))
+            continue
+        row = [r['scenario'], str(r['size']), f'{r["seconds"]:.3f}', f'{r["items_per_second"]:.0f}',
+               str(r['subprocesses']), f'{r["peak_rss_mb"]:.1f}']
+        if previous:
+            old = baseline.get((r['scenario'], r['size']))
+            row.append(f'{(r["seconds"] - old["seconds"])/old["seconds"]*100:+.1f}%' if old and old.get('seconds') else 'n/a')
+        rows.append(row)
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    lines = ['  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip() for row in [header] + rows]
+    lines.insert(1, '  '.join('-'*w for w in widths))
+    return '\n'.join(lines)
+
+
+
+
+
+
+def import_times(stderr):
+    """(total microseconds of the top level imports, names of every imported module)
+    from the output of `python -X importtime`"""
+    total = 0
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        modules.add(name.strip())
+        if len(name) - len(name.lstrip()) == 1:
+            total += int(cumulative)
+    return total, modules
+
+
+
+
+
+
+def check_startup(runs, max_ms, max_import_ms):
+    """time each of STARTUP_COMMANDS; returns False if any is too slow or imports a deferred module"""
+    ok = True
+    rows = [('command', 'wall ms', 'import ms', 'result')]
+    # the first run after an install caches the bytecode of pycodesign_core; compile it here
+    # so PYTHONDONTWRITEBYTECODE does not make every timed run compile the module again
+    py_compile.compile(str(HERE/'pycodesign_core.py'), doraise=True)
+    with tempfile.TemporaryDirectory(prefix='pycodesign-startup-') as workdir:
+        for command in STARTUP_COMMANDS:
+            argv = [sys.executable, str(HERE/'pycodesign.py'), *command]
+            walls = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.run(argv, cwd=workdir, capture_output=True, check=True)
+                walls.append((time.perf_counter() - start)*1000)
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(os.path.join(workdir, 'pycodesign.ini'))
+            traced = subprocess.run([sys.executable, '-X', 'importtime', *argv[1:]], cwd=workdir,
+                                    capture_output=True, text=True, check=True)
+            total, modules = import_times(traced.stderr)
+            problems = []
+            if min(walls) > max_ms:
+                problems.append(f'slower than {max_ms:g} ms')
+            if total/1000 > max_import_ms:
+                problems.append(f'imports take longer than {max_import_ms:g} ms')
+            deferred = sorted(m for m in DEFERRED_MODULES if m in modules)
+            if deferred:
+                problems.append(f'imports {", ".join(deferred)}')
+            ok = ok and not problems
+            rows.append((' '.join(command), f'{min(walls):.1f}', f'{total/1000:.1f}', '; '.join(problems) or 'ok'))
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip())
+    return ok
+
+
+
+
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark pycodesign.py with a stub Apple toolchain')
+    parser.add_argument('--sizes', type=str, default='10,1000,10000',
+                        help='comma separated number of files in the synthetic trees (default: 10,1000,10000)')
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS),
+                        help=f'comma separated scenarios (default: {",".join(SCENARIOS)})')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='workers used by the parallel signing scenarios (default: cpu count)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds each stub tool sleeps (default: 0)')
+    parser.add_argument('--output-bytes', type=int, default=0,
+                        help='bytes of output each stub tool writes (default: 0)')
+    parser.add_argument('-o', '--output', type=str, default=str(HERE/'bench_results'),
+                        help='directory to save results in (default: bench_results)')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='earlier results file to compare against')
+    parser.add_argument('--startup', action='store_true', default=False,
+                        help='check the start up time of -V, -h and -N instead; exits with status 1 on a regression')
+    parser.add_argument('--startup-runs', type=int, default=10,
+                        help='runs of each command; the fastest one counts (default: 10)')
+    parser.add_argument('--max-startup-ms', type=float, default=100,
+                        help='maximum wall time of each command in milliseconds (default: 100)')
+    parser.add_argument('--max-import-ms', type=float, default=50,
+                        help='maximum time spent importing modules in milliseconds (default: 50)')
+    parser.add_argument('--run-one', nargs=4, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+
+
+
+
+def main():
+    args = get_args()
+    if args.run_one:
+        scenario, size, workdir, jobs = args.run_one
+        print(json.dumps(run_one(scenario, int(size), workdir, int(jobs))))
+        return
+    if args.startup:
+        sys.exit(0 if check_startup(args.startup_runs, args.max_startup_ms, args.max_import_ms) else 1)
+
+    with tempfile.TemporaryDirectory(prefix='pycodesign-stubs-') as stubs:
+        write_stubs(stubs)
+        env = dict(os.environ, PATH=f'{stubs}{os.pathsep}{os.environ.get("PATH", "")}')
+        for tool in STUBS:
+            env[f'BENCH_{tool.upper()}_LATENCY'] = str(args.latency)
+            env[f'BENCH_{tool.upper()}_OUTPUT'] = str(args.output_bytes)
+
+        results = []
+        for size in [int(s) for s in args.sizes.split(',')]:
+            for scenario in [s.strip() for s in args.scenarios.split(',') if s.strip()]:
+                result = run_scenario(scenario, size, env, args.jobs)
+                results.append(result)
+                status = result.get('error', '').strip().splitlines()[-1:] or [f'{result.get("seconds", 0):.3f}s']
+                print(f'{scenario} ({size} files): {status[0]}')
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+              'platform': sys.platform, 'cpu_count': os.cpu_count(), 'jobs': args.jobs,
+              'latency': args.latency, 'output_bytes': args.output_bytes, 'results': results}
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    path = output/f'{time.strftime("%Y%m%d-%H%M%S")}.json'
+    path.write_text(json.dumps(report, indent=1))
+
+    print()
+    print(format_results(results, previous))
+    print(f'\nsaved results: {path}')
+
+
+
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5739 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+
+
+
+
+
+version = '0.3'
+
+import sys
+import importlib
+# from distutils import util
+import shlex
+import re
+from pathlib import Path
+from time import sleep
+import os
+import io
+import stat
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+
+
+
+
+
+class LazyModule:
+    """stand-in for a module that is imported the first time one of its attributes is used
+    
+    most runs only need some of these; -h and -N need none of them"""
+    def __init__(self, name):
+        self._lazy_name = name
+    
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._lazy_name)
+        # later lookups find the module attributes without calling __getattr__
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+logging = LazyModule('logging')
+configparser = LazyModule('configparser')
+argparse = LazyModule('argparse')
+subprocess = LazyModule('subprocess')
+tempfile = LazyModule('tempfile')
+shutil = LazyModule('shutil')
+hashlib = LazyModule('hashlib')
+json = LazyModule('json')
+asyncio = LazyModule('asyncio')
+random = LazyModule('random')
+glob = LazyModule('glob')
+selectors = LazyModule('selectors')
+mmap = LazyModule('mmap')
+struct = LazyModule('struct')
+futures = LazyModule('concurrent.futures')
+queue = LazyModule('queue')
+socket = LazyModule('socket')
+socketserver = LazyModule('socketserver')
+hmac = LazyModule('hmac')
+fcntl = LazyModule('fcntl')
+base64 = LazyModule('base64')
+calendar = LazyModule('calendar')
+lzma = LazyModule('lzma')
+zlib = LazyModule('zlib')
+saxutils = LazyModule('xml.sax.saxutils')
+
+
+
+
+
+
+def strtobool (val):
+    """Convert a string representation of truth to true (1) or false (0).
+    True values are 'y', 'yes', 't', 'true', 'on', and '1'; false values
+    are 'n', 'no', 'f', 'false', 'off', and '0'.  Raises ValueError if
+    'val' is anything else. 
+    
+    courtesy of 
+    https://github.com/python/cpython/blob/main/Lib/distutils/util.py
+    """
+    val = val.lower()
+    if val in ('y', 'yes', 't', 'true', 'on', '1'):
+        return 1
+    elif val in ('n', 'no', 'f', 'false', 'off', '0'):
+        return 0
+    else:
+        raise ValueError("invalid truth value %r" % (val,))
+
+
+
+
+
+
+def main_option(config, key, default=False):
+    """boolean option from the optional [main] section"""
+    value = config.get('main', {}).get(key, default)
+    if isinstance(value, bool):
+        return value
+    try:
+        return bool(strtobool(str(value)))
+    except ValueError:
+        logging.warning(f'invalid value for [main] {key}: {value}')
+        return default
+
+
+
+
+
+
+def get_config(args, default_config=None, filename='pycodesign.ini'):
+    file = args.config
+    
+    if file:
+        print (f'using configuration file: {file}')
+        config = configparser.ConfigParser()
+        config.read(file)
+    elif default_config and args.new_config:
+        print(f'writing default config file: {filename}')
+        # the layout ConfigParser.write() uses; -N does not need to import configparser
+        try:
+            with open(filename, 'w') as blank_config:
+                for section, values in default_config.items():
+                    blank_config.write(f'[{section}]\n')
+                    for key, value in values.items():
+                        value = str(value).replace('\n', '\n\t')
+                        blank_config.write(f'{key.lower()} = {value}\n')
+                    blank_config.write('\n')
+                blank_config.write(SAMPLE_MAIN_SECTION)
+        except OSError as e:
+            print(f'could not create {filename} due to error: {e}')
+        return {}
+    else:
+        return {}
+
+    return {s:dict(config.items(s)) for s in config.sections()}
+
+
+
+
+
+
+def add_run_args(parser):
+    """options shared by the single config and batch command lines"""
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        metavar="<INTEGER>",
+                        help='sign each file with its own codesign call using <INTEGER> parallel workers (overrides [main] jobs)')
+    
+    parser.add_argument('-I', '--inside_out', dest='inside_out',
+                        action='store_true', default=None,
+                        help='sign nested code leaf-first without --deep; each level is signed in parallel (overrides [main] inside_out)')
+    
+    parser.add_argument('--pool', type=str, default=None,
+                        choices=['thread', 'process'],
+                        help='type of worker pool used with --jobs (default: thread)')
+
+    parser.add_argument('--no-cache', dest='no_cache',
+                        action='store_true', default=False,
+                        help='sign every file even if a signed copy is in the signing cache')
+    
+    parser.add_argument('--fresh', dest='fresh',
+                        action='store_true', default=False,
+                        help='ignore the saved pipeline state and run every stage')
+    
+    parser.add_argument('--report', type=str, default=None,
+                        metavar='<RUN.JSON>',
+                        help='write the timing, cpu time and exit code of every stage and subprocess as json')
+    
+    parser.add_argument('--trace', type=str, default=None,
+                        metavar='<TRACE.JSON>',
+                        help='write a Chrome trace-event file of the stages and subprocesses')
+    
+    parser.add_argument('-O', '--pkg_version', type=str, 
+                        default=None, 
+                        metavar="<VERSION STRING>",
+                        help='overide the version number in the .ini file and use supplied version number.')
+
+
+
+
+
+
+def help_formatter(prog):
+    """argparse's formatter given the terminal width, so it does not import shutil to find it"""
+    try:
+        columns = int(os.environ.get('COLUMNS') or os.get_terminal_size(sys.__stdout__.fileno()).columns)
+    except (ValueError, OSError):
+        columns = 80
+    return argparse.HelpFormatter(prog, width=columns - 2)
+
+
+
+
+
+
+def get_args():
+
+    saved =[]
+    for k in sys.argv:
+        saved.append(k)
+
+    if '-f' in saved:
+        logging.info('working in interactive jupyter environ')
+        try:
+            sys.argv = sys.argv[:sys.argv.index('-f')]
+        except ValueError as e:
+            pass
+    
+    
+    
+    parser = argparse.ArgumentParser(description='PyCodeSign -- Code Signing and Notarization Assistant',
+                                     formatter_class=help_formatter)
+    
+    parser.add_argument('-v', '--verbose', action='count', default=1)
+    
+    parser.add_argument('-V', '--version', dest='version',
+                       action='store_true', default=False)
+    
+    parser.add_argument('-N', '--new', dest='new_config', 
+                        action='store_true', default=False,
+                       help='create a new sample configuration with name "pycodesign.ini" in current directory')
+    
+    parser.add_argument('config', nargs='?', type=str, default=None,
+                       help='configuration file to use when codesigning',
+                       metavar='<PYCODESIGN_CONFIG.INI>')
+    
+    parser.add_argument('-s', '--sign', dest='sign_only',
+                       action='store_true', default=None,
+                       help='sign the executables, but take no further action (can be combined with -p, -n, -t)')
+    
+    parser.add_argument('-p', '--package', dest='package_only',
+                       action='store_true', default=None,
+                       help='package the executables, but take no further action (can be combined with -s, -n, -t)')
+    
+    parser.add_argument('-P', '--package_debug', dest='package_debug', 
+                        action='store_true', default=None,
+                        help='package but leave temporary files in place for debugging')
+    
+    parser.add_argument('-n', '--notarize', dest='notarize_only',
+                       action='store_true', default=None,
+                       help='notarize the package, but take no further action (can be combined with -s, -p, -t)')
+
+    parser.add_argument('-t', '--staple', dest='staple_only',
+                       action='store_true', default=None,
+                       help='stape the notarization to the the package, but take no further action (can be combined with -s, -p, -n)')
+    
+    #parser.add_argument('-T', '--notarize_timer', type=int, default=60,
+    #                   metavar="<INTEGER>",
+    #                   help='base time in seconds to wait between checking notarization status with apple (default 60)')
+    
+    #parser.add_argument('-C', '--num_checks', type=int, default=5, 
+    #                   metavar="<INTEGER>",
+    #                   help='number of times to check notarization status with apple (default 5) -- each check doubles notarize_timer')
+
+    add_run_args(parser)
+    
+    parser.add_argument('--scan', dest='scan',
+                        action='store_true', default=False,
+                        help='list the Mach-O files in file_list with their architectures, signature state and linked libraries, then exit')
+    
+    parser.add_argument('--cache-stats', dest='cache_stats',
+                        action='store_true', default=False,
+                        help='print signing cache statistics')
+    
+#     known_args, unknown_args = parser.parse_known_args()
+    args = parser.parse_args()
+#     return(known_args, unknown_args)
+    return args
+
+
+
+
+
+
+def validate_config(config, expected_keys):
+    missing = {}
+    for section, keys in expected_keys.items():
+        if not section in config.keys():
+            missing[section] = expected_keys[section]
+            continue
+        for key in keys:
+            if not key in config[section].keys():
+                if not section in missing:
+                    missing[section] = {}
+                missing[section][key] = keys[key]
+                
+    if missing:
+        print('Config file is missing values:')
+        for section, values in missing.items():
+            print(f'[{section}]')
+            for k, v in values.items():
+                print(f'\t{k}: {v}')
+                    
+    return missing
+
+
+
+
+
+
+# every subprocess and stage span of this run; see write_report() and write_trace()
+RUN_START = time.time()
+RUN_RECORDS = []
+RUN_SPANS = []
+_records_lock = threading.Lock()
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+def record_command(argv, start, wall, cpu, return_code, stdout, stderr):
+    """add a subprocess record to RUN_RECORDS, tagged with the stage span it ran in
+    
+    `cpu` is (user, system) seconds, or None when the cpu time of the command is not known"""
+    span = _current_span.get()
+    record = {
+        'command': Path(argv[0]).name if argv else '',
+        'argv': list(argv),
+        'span': span['id'] if span else None,
+        'stage': span['stage'] if span else None,
+        'package': span['package'] if span else None,
+        'start': start - RUN_START,
+        'wall': wall,
+        'cpu_user': cpu[0] if cpu else None,
+        'cpu_system': cpu[1] if cpu else None,
+        'return_code': return_code,
+        'stdout_bytes': len(stdout or b''),
+        'stderr_bytes': len(stderr or b''),
+        'thread': threading.get_ident(),
+    }
+    with _records_lock:
+        RUN_RECORDS.append(record)
+    return record
+
+
+
+
+
+
+@contextmanager
+def stage_span(stage, package=None):
+    """time a pipeline stage; subprocesses started inside of it are attributed to the span
+    
+    contextvars do not follow work onto thread pools on their own; submit work with
+    in_context() so the span is carried along"""
+    with _records_lock:
+        span = {'id': len(RUN_SPANS), 'stage': stage, 'package': package,
+                'start': time.time() - RUN_START, 'wall': None}
+        RUN_SPANS.append(span)
+    token = _current_span.set(span)
+    start = time.monotonic()
+    try:
+        yield span
+    finally:
+        span['wall'] = time.monotonic() - start
+        _current_span.reset(token)
+
+
+
+
+
+
+def in_context(function):
+    """wrap `function` to run in a copy of the current context (for executor.submit/run_in_executor)"""
+    context = contextvars.copy_context()
+    def wrapper(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return wrapper
+
+
+
+
+
+
+def summarize_spans():
+    """stage spans with the totals of the subprocess records that ran inside of them
+    
+    the cpu totals only cover the commands whose cpu time is known (`cpu_commands`)"""
+    spans = []
+    for span in RUN_SPANS:
+        records = [r for r in RUN_RECORDS if r['span'] == span['id']]
+        measured = [r for r in records if r['cpu_user'] is not None]
+        spans.append({**span,
+                      'commands': len(records),
+                      'cpu_commands': len(measured),
+                      'subprocess_wall': sum(r['wall'] for r in records),
+                      'cpu_user': sum(r['cpu_user'] for r in measured),
+                      'cpu_system': sum(r['cpu_system'] for r in measured),
+                      'stdout_bytes': sum(r['stdout_bytes'] for r in records),
+                      'stderr_bytes': sum(r['stderr_bytes'] for r in records),
+                      'failed_commands': sum(1 for r in records if r['return_code'])})
+    return spans
+
+
+
+
+
+
+def write_report(path):
+    """write the subprocess records and stage spans of this run as json"""
+    report = {
+        'version': version,
+        'argv': sys.argv,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(RUN_START)),
+        'wall': time.time() - RUN_START,
+        'stages': summarize_spans(),
+        'commands': RUN_RECORDS,
+    }
+    atomic_write_json(path, report)
+    print(f'wrote run report: {path}')
+
+
+
+
+
+
+def write_trace(path):
+    """write the run in the Chrome trace event format (chrome://tracing, Perfetto)"""
+    pid = os.getpid()
+    events = []
+    packages = {}
+    for span in RUN_SPANS:
+        tid = packages.setdefault(span['package'], len(packages) + 1)
+        events.append({'name': span['stage'], 'cat': 'stage', 'ph': 'X', 'pid': pid, 'tid': tid,
+                       'ts': span['start']*1e6, 'dur': (span['wall'] or 0)*1e6,
+                       'args': {'package': span['package']}})
+    for tid, package in ((t, p) for p, t in packages.items()):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 
+                       'args': {'name': package or 'main'}})
+    for record in RUN_RECORDS:
+        events.append({'name': record['command'], 'cat': 'subprocess', 'ph': 'X', 'pid': pid, 
+                       'tid': record['thread'], 'ts': record['start']*1e6, 'dur': record['wall']*1e6,
+                       'args': {k: record[k] for k in ('argv', 'return_code', 'cpu_user', 'cpu_system',
+                                                       'stdout_bytes', 'stderr_bytes', 'stage', 'package')}})
+    atomic_write_json(path, {'traceEvents': events, 'displayTimeUnit': 'ms'})
+    print(f'wrote trace: {path}')
+
+
+
+
+
+
+def write_run_reports(args):
+    if getattr(args, 'report', None):
+        write_report(args.report)
+    if getattr(args, 'trace', None):
+        write_trace(args.trace)
+
+
+
+
+
+
+def exit_code(status):
+    """return code from an os.wait() status; negative for a signal like subprocess uses"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+
+
+
+
+def log_line(command, stream, line):
+    """default live handler for subprocess output"""
+    logging.getLogger('pycodesign.subprocess').debug(f'{command} {stream}: {line.rstrip().decode("utf-8", "replace")}')
+
+
+
+
+
+
+def run_command(command_list, timeout=None, cancel=None, on_line=log_line, capture_lines=10000):
+    """run the argv list `command_list`, streaming stdout and stderr as they are produced
+    
+    every complete line is passed to `on_line(command, stream, line)` as it arrives. 
+    Only the last `capture_lines` lines of each stream are kept for the return value.
+    The command is killed after `timeout` seconds or when the threading.Event `cancel`
+    is set. Returns return code, stdout, stderr"""
+    argv = [str(a) for a in command_list]
+    command = Path(argv[0]).name
+    start = time.time()
+    deadline = time.monotonic() + timeout if timeout else None
+    
+    cmd = subprocess.Popen(argv, stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE)
+    captured = {'stdout': deque(maxlen=capture_lines), 'stderr': deque(maxlen=capture_lines)}
+    partial = {'stdout': b'', 'stderr': b''}
+    sizes = {'stdout': 0, 'stderr': 0}
+    stopped = None
+    
+    with selectors.DefaultSelector() as selector:
+        selector.register(cmd.stdout, selectors.EVENT_READ, 'stdout')
+        selector.register(cmd.stderr, selectors.EVENT_READ, 'stderr')
+        while selector.get_map():
+            wait = 0.1 if cancel else None
+            if deadline:
+                wait = min(wait or 1, max(0, deadline - time.monotonic()))
+            for key, events in selector.select(wait):
+                stream = key.data
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    if partial[stream]:
+                        lines = [partial[stream]]
+                        partial[stream] = b''
+                    else:
+                        continue
+                else:
+                    sizes[stream] += len(chunk)
+                    *lines, partial[stream] = (partial[stream] + chunk).split(b'\n')
+                    lines = [l + b'\n' for l in lines]
+                for line in lines:
+                    captured[stream].append(line)
+                    if on_line:
+                        on_line(command, stream, line)
+            
+            if deadline and time.monotonic() >= deadline:
+                stopped = f'timed out after {timeout} seconds'
+            elif cancel is not None and cancel.is_set():
+                stopped = 'cancelled'
+            if stopped:
+                cmd.kill()
+                break
+    
+    cmd.stdout.close()
+    cmd.stderr.close()
+    # wait4 reaps the child and reports the cpu time of just this command; a child
+    # that closed both pipes but keeps running is still held to the deadline
+    while True:
+        pid, status, usage = os.wait4(cmd.pid, os.WNOHANG if (deadline or cancel) and not stopped else 0)
+        if pid:
+            break
+        if deadline and time.monotonic() >= deadline:
+            stopped = f'timed out after {timeout} seconds'
+        elif cancel is not None and cancel.is_set():
+            stopped = 'cancelled'
+        if stopped:
+            cmd.kill()
+        else:
+            sleep(0.05)
+    cmd.returncode = exit_code(status)
+    
+    stdout = b''.join(captured['stdout'])
+    stderr = b''.join(captured['stderr'])
+    if stopped:
+        logging.warning(f'{command} {stopped}')
+        message = bytes(f'{command} {stopped}\n', 'utf-8')
+        stderr += message
+        sizes['stderr'] += len(message)
+    
+    record = record_command(argv, start, time.time() - start, (usage.ru_utime, usage.ru_stime),
+                            cmd.returncode, b'', b'')
+    record['stdout_bytes'], record['stderr_bytes'] = sizes['stdout'], sizes['stderr']
+    return cmd.returncode, stdout, stderr
+
+
+
+
+
+
+def file_digests(path, algorithms=('sha256',), chunk_size=1024*1024):
+    """streaming digests of the file at `path`; every algorithm is fed from the same read"""
+    digests = [(name, hashlib.new(name)) for name in algorithms]
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            for name, digest in digests:
+                digest.update(view[:size])
+    return {name: digest.hexdigest() for name, digest in digests}
+
+
+
+
+
+
+def file_sha256(path, chunk_size=1024*1024):
+    """streaming SHA-256 of the file at `path`"""
+    return file_digests(path, ('sha256',), chunk_size)['sha256']
+
+
+
+
+
+
+def atomic_write_json(path, data):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(temp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(temp, path)
+
+
+
+
+
+
+class DigestCache:
+    """file digests keyed by path and (inode, mtime, size) so unchanged files are not read again"""
+    
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.run_stats = {'hits': 0, 'misses': 0}
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)['entries']
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+    
+    def digests(self, path, algorithms=('sha256',)):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = [st.st_ino, st.st_mtime_ns, st.st_size]
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry['key'] == key and all(a in entry for a in algorithms):
+                self.run_stats['hits'] += 1
+                return {a: entry[a] for a in algorithms}
+            self.run_stats['misses'] += 1
+        
+        digests = file_digests(path, algorithms)
+        # a file that changed while it was read is hashed again next time
+        if os.stat(path).st_mtime_ns == st.st_mtime_ns:
+            with self.lock:
+                self.entries[path] = {'key': key, **digests}
+                self.dirty = True
+        return digests
+    
+    def sha256(self, path):
+        return self.digests(path)['sha256']
+    
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.entries = {p: e for p, e in self.entries.items() if os.path.exists(p)}
+            atomic_write_json(self.path, {'entries': self.entries})
+            self.dirty = False
+
+
+
+
+
+
+_digest_caches = {}
+_digest_caches_lock = threading.Lock()
+
+def get_digest_cache(config):
+    """the DigestCache for `config`; shared by every package that uses the same cache file"""
+    path = os.path.expanduser(config.get('main', {}).get('digest_cache', '~/.cache/pycodesign/digests.json'))
+    with _digest_caches_lock:
+        if path not in _digest_caches:
+            _digest_caches[path] = DigestCache(path)
+        return _digest_caches[path]
+
+
+
+
+
+
+def digest_algorithms(config):
+    """names from `[main] digests`; sha256 is always included"""
+    names = config.get('main', {}).get('digests', 'sha256')
+    algorithms = ['sha256']
+    for name in (n.strip().lower() for n in names.split(',')):
+        if not name or name in algorithms:
+            continue
+        if name not in hashlib.algorithms_guaranteed or name.startswith('shake'):
+            logging.warning(f'ignoring unknown digest algorithm: {name}')
+            continue
+        algorithms.append(name)
+    return tuple(algorithms)
+
+
+
+
+
+
+class SignCache:
+    """persistent store of signed outputs keyed by the input content and signing options
+    
+    blobs are stored by the SHA-256 of the signed output. Each blob is indexed 
+    twice: by the hash of the unsigned input (restore the signed output) and by the
+    hash of the signed output itself (the file is already signed, nothing to do).
+    Blobs are evicted least-recently-used first once the cache exceeds `max_size`."""
+    
+    def __init__(self, path, options_key, max_size=2*1024**3):
+        self.path = Path(path).expanduser()
+        self.blobs = self.path/'blobs'
+        self.index_file = self.path/'index.json'
+        self.options_key = options_key
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.run_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        try:
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        self.index.setdefault('entries', {})
+        self.index.setdefault('blobs', {})
+        self.index.setdefault('stats', {k: 0 for k in self.run_stats})
+    
+    def key(self, file_hash):
+        return hashlib.sha256(f'{file_hash}:{self.options_key}'.encode()).hexdigest()
+    
+    def blob_path(self, blob):
+        return self.blobs/blob[:2]/blob
+    
+    def lookup(self, file):
+        """returns (status, input_hash); status is 'signed', 'restored' or None
+        
+        a blob that no longer matches its hash is dropped and counts as a miss"""
+        input_hash = file_sha256(file)
+        with self.lock:
+            blob = self.index['entries'].get(self.key(input_hash))
+            if blob and not self.blob_path(blob).exists():
+                blob = None
+        if blob and blob != input_hash:
+            # replace the file with the cached signed output, keeping its mode
+            temp = f'{file}.pycodesign-restore'
+            shutil.copy2(self.blob_path(blob), temp)
+            if file_sha256(temp) == blob:
+                os.chmod(temp, os.stat(file).st_mode)
+                os.replace(temp, file)
+            else:
+                logging.warning(f'signing cache blob {blob} is corrupt; signing {file} again')
+                os.unlink(temp)
+                self.drop(blob)
+                blob = None
+        with self.lock:
+            self.run_stats['hits' if blob else 'misses'] += 1
+            if blob:
+                self.index['blobs'][blob]['atime'] = time.time()
+        if not blob:
+            return None, input_hash
+        return ('signed' if blob == input_hash else 'restored'), input_hash
+    
+    def drop(self, blob):
+        with self.lock:
+            self.index['blobs'].pop(blob, None)
+            self.index['entries'] = {k: v for k, v in self.index['entries'].items() if v != blob}
+        try:
+            self.blob_path(blob).unlink()
+        except FileNotFoundError:
+            pass
+    
+    def store(self, file, input_hash):
+        output_hash = file_sha256(file)
+        blob_path = self.blob_path(output_hash)
+        if not blob_path.exists():
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            temp = blob_path.with_name(f'{output_hash}.{threading.get_ident()}.tmp')
+            shutil.copy2(file, temp)
+            os.replace(temp, blob_path)
+        with self.lock:
+            self.index['entries'][self.key(input_hash)] = output_hash
+            self.index['entries'][self.key(output_hash)] = output_hash
+            self.index['blobs'][output_hash] = {'size': os.path.getsize(blob_path), 'atime': time.time()}
+            self.run_stats['stores'] += 1
+    
+    def size(self):
+        return sum(b['size'] for b in self.index['blobs'].values())
+    
+    def evict(self):
+        total = self.size()
+        for blob, info in sorted(self.index['blobs'].items(), key=lambda b: b[1]['atime']):
+            if total <= self.max_size:
+                break
+            try:
+                self.blob_path(blob).unlink()
+            except FileNotFoundError:
+                pass
+            total -= info['size']
+            del self.index['blobs'][blob]
+            self.run_stats['evictions'] += 1
+        live = self.index['blobs']
+        self.index['entries'] = {k: v for k, v in self.index['entries'].items() if v in live}
+    
+    def save(self):
+        with self.lock:
+            self.evict()
+            for k, v in self.run_stats.items():
+                self.index['stats'][k] += v
+            self.run_stats = {k: 0 for k in self.run_stats}
+            atomic_write_json(self.index_file, self.index)
+    
+    def report(self):
+        stats = self.index['stats']
+        lines = [f'signing cache: {self.path}',
+                 f'  blobs: {len(self.index["blobs"])}',
+                 f'  size: {self.size()/1024**2:.1f} MB of {self.max_size/1024**2:.0f} MB',
+                 f'  hits: {stats["hits"] + self.run_stats["hits"]}',
+                 f'  misses: {stats["misses"] + self.run_stats["misses"]}',
+                 f'  stores: {stats["stores"] + self.run_stats["stores"]}',
+                 f'  evictions: {stats["evictions"] + self.run_stats["evictions"]}']
+        return '\n'.join(lines)
+
+
+
+
+
+
+def get_sign_cache(config, sign_args=None, enabled=None):
+    """returns a SignCache for `config` or None if caching is disabled
+    
+    the cache is off unless [main] cache is set (or `enabled` is True): with it on, files
+    are replaced with signed copies from cache_dir without running codesign"""
+    main_config = config.get('main', {})
+    if not (main_option(config, 'cache', False) if enabled is None else enabled):
+        return None
+    
+    options = [config.get('identification', {}).get('application_id', '')]
+    entitlements = config.get('package_details', {}).get('entitlements')
+    if entitlements and os.path.isfile(str(entitlements)):
+        options.append(file_sha256(entitlements))
+    options.extend(sign_args or [])
+    options_key = hashlib.sha256('\0'.join(str(o) for o in options).encode()).hexdigest()
+    
+    cache_dir = main_config.get('cache_dir', '~/.cache/pycodesign/sign')
+    max_size = float(main_config.get('cache_size', 2048))*1024**2
+    return SignCache(cache_dir, options_key, max_size)
+
+
+
+
+
+
+def cache_lookup_files(cache, file_list, jobs=1):
+    """check `file_list` against `cache` in parallel
+    
+    returns (a dict of cached file: status, a dict of file: input hash for the rest)"""
+    cached = {}
+    pending = {}
+    files = [f for f in file_list if os.path.isfile(f)]
+    
+    def lookup(file):
+        try:
+            return cache.lookup(file)
+        except OSError as e:
+            logging.warning(f'signing cache lookup failed for {file}: {e}')
+            return None, None
+    
+    with futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for file, (status, input_hash) in zip(files, executor.map(lookup, files)):
+            if status:
+                cached[file] = status
+            elif input_hash:
+                pending[file] = input_hash
+    return cached, pending
+
+
+
+
+
+
+def cache_store_files(cache, results, input_hashes):
+    for result in results:
+        file = result['file']
+        if result['return_code'] == 0 and file in input_hashes:
+            try:
+                cache.store(file, input_hashes[file])
+            except OSError as e:
+                logging.warning(f'could not add {file} to signing cache: {e}')
+
+
+
+
+
+
+def tool_command(config, name):
+    """argv prefix for an external tool; [tools] in the config can replace any of them
+    
+    for example `lipo = /usr/bin/xcrun lipo` or a stub script used for testing"""
+    command = config.get('tools', {}).get(name)
+    return shlex.split(command) if command else [name]
+
+
+
+
+
+
+def sign_file(file, sign_args, timeout=None):
+    """sign a single file; returns a dict with the per-file result
+    
+    kept at module level so it can be pickled for a process pool"""
+    try:
+        return_code, stdout, stderr = run_command(sign_args + [file], timeout=timeout)
+    except OSError as e:
+        return_code, stdout, stderr = 127, b'', bytes(str(e), 'utf-8')
+    return {'file': file, 'return_code': return_code, 'stdout': stdout, 'stderr': stderr}
+
+
+
+
+
+
+def sign_files(file_list, sign_args, jobs=1, pool='thread', cache=None, timeout=None, remote=None):
+    """sign each file in `file_list` with its own codesign call on a pool of `jobs` workers
+    
+    a failure in one file does not stop the others; results are returned in the 
+    same order as `file_list`. Files found in `cache` are not signed again. With a
+    RemoteSigner as `remote` the files are signed on its workers instead."""
+    executor_class = futures.ProcessPoolExecutor if pool == 'process' else futures.ThreadPoolExecutor
+    results = {}
+    
+    input_hashes = {}
+    to_sign = file_list
+    if cache:
+        cached, input_hashes = cache_lookup_files(cache, file_list, jobs)
+        for file, status in cached.items():
+            print(f'[cached] {status}: {file}')
+            results[file] = {'file': file, 'return_code': 0, 'stdout': b'', 'stderr': b'', 'cached': status}
+        to_sign = [f for f in file_list if f not in cached]
+    
+    def completed(count, result):
+        file = result['file']
+        results[file] = result
+        status = 'ok' if result['return_code'] == 0 else 'FAILED'
+        where = f' ({result["worker"]})' if result.get('worker') else ''
+        print(f'[{count}/{len(to_sign)}] {status}: {file}{where}')
+        logging.debug(f'{file} return code: {result["return_code"]}')
+        logging.debug(f'{file} stdout: {result["stdout"]}')
+        logging.debug(f'{file} stderr: {result["stderr"]}')
+    
+    if remote is not None:
+        for count, result in enumerate(remote.sign(to_sign, timeout), start=1):
+            completed(count, result)
+    else:
+        with executor_class(max_workers=max(1, jobs)) as executor:
+            submit_function = sign_file if pool == 'process' else in_context(sign_file)
+            submitted = {executor.submit(submit_function, f, sign_args, timeout): f for f in to_sign}
+            for count, future in enumerate(futures.as_completed(submitted), start=1):
+                file = submitted[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'file': file, 'return_code': 1, 'stdout': b'', 'stderr': bytes(str(e), 'utf-8')}
+                completed(count, result)
+    
+    if cache:
+        cache_store_files(cache, [results[f] for f in to_sign], input_hashes)
+            
+    return [results[f] for f in file_list]
+
+
+
+
+
+
+def summarize_sign_results(results):
+    """collapse per-file results into a single return code, stdout, stderr"""
+    failed = [r for r in results if r['return_code'] != 0]
+    stdout = b''.join(r['stdout'] for r in results)
+    stderr = b''
+    if failed:
+        stderr = bytes(f'failed to sign {len(failed)} of {len(results)} files:\n', 'utf-8')
+        for r in failed:
+            stderr += bytes(f'{r["file"]} (return code {r["return_code"]}):\n', 'utf-8')
+            stderr += r['stderr']
+    return (1 if failed else 0), stdout, stderr
+
+
+
+
+
+
+MACHO_MAGICS = (b'\xfe\xed\xfa\xce', b'\xce\xfa\xed\xfe', b'\xfe\xed\xfa\xcf', b'\xcf\xfa\xed\xfe')
+FAT_MAGICS = (b'\xca\xfe\xba\xbe', b'\xca\xfe\xba\xbf')
+BUNDLE_SUFFIXES = ('.app', '.framework', '.bundle', '.plugin', '.xpc', '.appex', '.kext')
+
+
+
+
+
+
+CPU_TYPES = {
+    7: 'i386',
+    0x01000007: 'x86_64',
+    12: 'arm',
+    0x0100000c: 'arm64',
+    0x0200000c: 'arm64_32',
+    18: 'ppc',
+    0x01000012: 'ppc64',
+}
+
+MACHO_FILETYPES = {1: 'object', 2: 'execute', 6: 'dylib', 7: 'dylinker', 8: 'bundle', 
+                   9: 'dylib_stub', 10: 'dsym', 11: 'kext_bundle'}
+
+LC_REQ_DYLD = 0x80000000
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_REEXPORT_DYLIB = 0x1f | LC_REQ_DYLD
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+LC_RPATH = 0x1c | LC_REQ_DYLD
+LC_CODE_SIGNATURE = 0x1d
+DYLIB_COMMANDS = (LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB, LC_REEXPORT_DYLIB, LC_LAZY_LOAD_DYLIB, LC_LOAD_UPWARD_DYLIB)
+
+def arch_name(cputype, cpusubtype):
+    name = CPU_TYPES.get(cputype, f'cpu{cputype:#x}')
+    if name == 'arm64' and cpusubtype & 0xff == 2:
+        return 'arm64e'
+    return name
+
+
+
+
+
+
+def read_cstring(data, start, end):
+    stop = data.find(b'\0', start, end)
+    return bytes(data[start:stop if stop >= 0 else end]).decode('utf-8', 'replace')
+
+
+
+
+
+
+def parse_macho_slice(data, offset):
+    """parse the header and load commands of a thin Mach-O image at `offset` in `data`"""
+    magic = bytes(data[offset:offset+4])
+    endian = '>' if magic in (b'\xfe\xed\xfa\xce', b'\xfe\xed\xfa\xcf') else '<'
+    is_64 = magic in (b'\xfe\xed\xfa\xcf', b'\xcf\xfa\xed\xfe')
+    cputype, cpusubtype, filetype, ncmds, sizeofcmds, flags = struct.unpack_from(f'{endian}iIIIII', data, offset + 4)
+    
+    info = {'arch': arch_name(cputype, cpusubtype), 'filetype': MACHO_FILETYPES.get(filetype, str(filetype)),
+            'signed': False, 'dylibs': [], 'rpaths': [], 'install_name': None}
+    position = offset + (32 if is_64 else 28)
+    end = min(position + sizeofcmds, len(data))
+    for i in range(ncmds):
+        if position + 8 > end:
+            break
+        cmd, cmdsize = struct.unpack_from(f'{endian}II', data, position)
+        if cmdsize < 8:
+            break
+        if cmd == LC_CODE_SIGNATURE:
+            info['signed'] = True
+        elif cmd in DYLIB_COMMANDS or cmd == LC_ID_DYLIB:
+            name_offset, = struct.unpack_from(f'{endian}I', data, position + 8)
+            name = read_cstring(data, position + name_offset, position + cmdsize)
+            if cmd == LC_ID_DYLIB:
+                info['install_name'] = name
+            else:
+                info['dylibs'].append(name)
+        elif cmd == LC_RPATH:
+            path_offset, = struct.unpack_from(f'{endian}I', data, position + 8)
+            info['rpaths'].append(read_cstring(data, position + path_offset, position + cmdsize))
+        position += cmdsize
+    return info
+
+
+
+
+
+
+def scan_macho(path):
+    """read the Mach-O headers of `path` without spawning file/otool/codesign
+    
+    the file is mmapped, so only the pages holding the headers and load commands
+    are read from disk. Returns a dict with 'macho' False for anything else."""
+    result = {'path': path, 'macho': False, 'fat': False, 'archs': [], 'signed': False,
+              'filetype': None, 'dylibs': [], 'rpaths': [], 'install_name': None, 'error': None}
+    head = b''
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(8)
+            if not (head[:4] in MACHO_MAGICS or 
+                    (head[:4] in FAT_MAGICS and 0 < int.from_bytes(head[4:8], 'big') < 20)):
+                return result
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if head[:4] in FAT_MAGICS:
+                    result['fat'] = True
+                    is_64 = head[:4] == FAT_MAGICS[1]
+                    count = int.from_bytes(head[4:8], 'big')
+                    slices = []
+                    for i in range(count):
+                        if is_64:
+                            cputype, cpusubtype, offset, size, align, reserved = struct.unpack_from('>iIQQII', data, 8 + i*32)
+                        else:
+                            cputype, cpusubtype, offset, size, align = struct.unpack_from('>iIIII', data, 8 + i*20)
+                        slices.append(parse_macho_slice(data, offset))
+                else:
+                    slices = [parse_macho_slice(data, 0)]
+    except (OSError, ValueError, struct.error) as e:
+        # a damaged header is still treated as code so codesign gets to report it
+        result['macho'] = head[:4] in MACHO_MAGICS + FAT_MAGICS
+        result['error'] = str(e)
+        return result
+    
+    result['macho'] = True
+    result['archs'] = [s['arch'] for s in slices]
+    # a universal binary is only fully signed when every slice is
+    result['signed'] = all(s['signed'] for s in slices)
+    result['filetype'] = slices[0]['filetype']
+    result['install_name'] = slices[0]['install_name']
+    for s in slices:
+        result['dylibs'].extend(d for d in s['dylibs'] if d not in result['dylibs'])
+        result['rpaths'].extend(r for r in s['rpaths'] if r not in result['rpaths'])
+    return result
+
+
+
+
+
+
+def scan_tree(file_list, jobs=None):
+    """scan every file in `file_list` (directories are walked) in parallel; returns {path: result}"""
+    files = []
+    for entry in file_list:
+        if os.path.isdir(entry):
+            files.extend(find_nested_code(entry)[1])
+        else:
+            files.append(entry)
+    with futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        return dict(zip(files, executor.map(scan_macho, files)))
+
+
+
+
+
+
+SYSTEM_LIBRARY_PREFIXES = ('/usr/lib/', '/System/', '@rpath/', '@loader_path/', '@executable_path/')
+
+def check_binaries(scan, listed=()):
+    """warnings about a scan_tree() result that are worth knowing before signing"""
+    warnings = []
+    for path in listed:
+        result = scan.get(path)
+        if result and not result['macho'] and not result['error']:
+            warnings.append(f'{path} is not a Mach-O binary; its signature will be stored in extended attributes')
+    archs = {}
+    for path, result in scan.items():
+        if result['error']:
+            warnings.append(f'{path} could not be read as Mach-O: {result["error"]}')
+        if not result['macho'] or result['error']:
+            continue
+        archs[path] = set(result['archs'])
+        for dylib in result['dylibs']:
+            if not dylib.startswith(SYSTEM_LIBRARY_PREFIXES):
+                warnings.append(f'{path} loads {dylib} which is outside of the bundle and the system libraries')
+    if archs:
+        every = set.union(*archs.values())
+        for path, found in archs.items():
+            if found != every:
+                warnings.append(f'{path} is missing architectures: {", ".join(sorted(every - found))}')
+    return warnings
+
+
+
+
+
+
+def format_scan(scan):
+    machos = [r for r in scan.values() if r['macho']]
+    lines = [f'scanned {len(scan)} files: {len(machos)} Mach-O, '
+             f'{sum(1 for r in machos if r["signed"])} already signed, '
+             f'{sum(1 for r in machos if r["fat"])} universal']
+    for result in machos:
+        signed = 'signed' if result['signed'] else 'unsigned'
+        lines.append(f'  {result["path"]}: {result["filetype"]} [{", ".join(result["archs"])}] {signed}')
+        for dylib in result['dylibs']:
+            lines.append(f'      {dylib}')
+    return '\n'.join(lines)
+
+
+
+
+
+
+def is_bundle(path):
+    return os.path.isdir(path) and not os.path.islink(path) and path.endswith(BUNDLE_SUFFIXES)
+
+
+
+
+
+
+def bundle_main_executable(file, bundle):
+    """true if `file` is the main executable that is signed along with `bundle`"""
+    stem = Path(bundle).stem
+    rel = Path(file).relative_to(bundle).parts
+    if bundle.endswith('.framework'):
+        return rel[-1] == stem and (len(rel) == 1 or rel[0] == 'Versions')
+    return rel == ('Contents', 'MacOS', stem) or rel == (stem,)
+
+
+
+
+
+
+def find_nested_code(root):
+    """walk `root` without following symlinks; return (bundles, candidate files)"""
+    bundles = []
+    files = []
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logging.warning(f'could not scan {directory}: {e}')
+            continue
+        for entry in entries:
+            if entry.is_symlink():
+                continue
+            if entry.is_dir():
+                if entry.name.endswith(BUNDLE_SUFFIXES):
+                    bundles.append(entry.path)
+                stack.append(entry.path)
+            elif entry.is_file():
+                files.append(entry.path)
+    return bundles, files
+
+
+
+
+
+
+def nearest_bundle(path, bundle_set):
+    parent = os.path.dirname(path)
+    while parent and parent != os.path.dirname(parent):
+        if parent in bundle_set:
+            return parent
+        parent = os.path.dirname(parent)
+    return None
+
+
+
+
+
+
+def plan_signing(file_list, jobs=None, scan=None):
+    """build an inside-out signing plan for the entries in `file_list`
+    
+    directories are searched for nested bundles and Mach-O files (classified by 
+    their headers with scan_macho()). Each bundle depends on all of the code nested
+    inside of it and each binary on the libraries it loads from the same tree. The
+    plan is a list of levels; every file in a level can be signed concurrently once
+    all previous levels are signed. Pass a scan_tree() result as `scan` to reuse it."""
+    if scan is None:
+        scan = scan_tree(file_list, jobs)
+    nodes = []
+    for entry in file_list:
+        entry = os.path.normpath(entry)
+        if not os.path.isdir(entry):
+            # explicitly listed files are always signed
+            nodes.append(entry)
+            continue
+        bundles, files = find_nested_code(entry)
+        if is_bundle(entry):
+            bundles.append(entry)
+        machos = [f for f in files if scan.get(f, {}).get('macho')]
+        # main executables are signed together with their bundle
+        bundle_set = set(bundles)
+        for f in machos:
+            parent = nearest_bundle(f, bundle_set)
+            if parent and bundle_main_executable(f, parent):
+                continue
+            nodes.append(f)
+        nodes.extend(bundles)
+    
+    bundle_set = {n for n in nodes if is_bundle(n)}
+    by_name = {}
+    for node in nodes:
+        by_name.setdefault(os.path.basename(node), []).append(node)
+    
+    deps = {n: set() for n in nodes}
+    for node in nodes:
+        parent = nearest_bundle(node, bundle_set)
+        if parent:
+            deps[parent].add(node)
+        for dylib in scan.get(node, {}).get('dylibs', []):
+            deps[node].update(d for d in by_name.get(os.path.basename(dylib), []) if d != node)
+    
+    level = {}
+    def place(node, visiting=()):
+        if node not in level:
+            # a dependency cycle between libraries is broken where it is found
+            level[node] = 1 + max((place(d, visiting + (node,)) for d in deps[node] if d not in visiting),
+                                  default=-1)
+        return level[node]
+    for node in nodes:
+        place(node)
+    
+    plan = [[] for i in range(max(level.values(), default=-1) + 1)]
+    for node in nodes:
+        plan[level[node]].append(node)
+    return plan
+
+
+
+
+
+
+def sign_inside_out(file_list, sign_args, jobs=None, pool='thread', cache=None, timeout=None, scan=None, remote=None):
+    """sign nested code leaf-first, one level at a time; stops at the first failing level"""
+    jobs = jobs or os.cpu_count()
+    plan = plan_signing(file_list, jobs, scan)
+    logging.debug(f'signing plan: {plan}')
+    workers = remote.describe() if remote else f'{jobs} {pool} workers'
+    print(f'signing {sum(len(l) for l in plan)} items in {len(plan)} levels using {workers}')
+    
+    results = []
+    for number, level in enumerate(plan, start=1):
+        print(f'signing level {number} of {len(plan)}: {len(level)} items')
+        level_results = sign_files(level, sign_args, jobs=jobs, pool=pool, cache=cache, timeout=timeout, remote=remote)
+        results.extend(level_results)
+        if any(r['return_code'] for r in level_results):
+            print(f'level {number} failed; skipping remaining levels')
+            break
+    return results
+
+
+
+
+
+
+def universal_dir(config):
+    return Path(config.get('main', {}).get('universal_dir', 'universal'))
+
+
+
+
+
+
+def group_slices(arch_file_lists):
+    """{arch: [files]} -> {file name: {arch: file}}; slices are matched by file name"""
+    groups = {}
+    for arch, files in arch_file_lists.items():
+        for file in files:
+            groups.setdefault(os.path.basename(os.path.normpath(file)), {})[arch] = file
+    return groups
+
+
+
+
+
+
+def merge_slices(lipo, output, slices, timeout=None):
+    """lipo the signed `slices` into one universal binary at `output`"""
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        return_code, stdout, stderr = run_command(lipo + ['-create', '-output', str(output)] + list(slices),
+                                                  timeout=timeout)
+    except OSError as e:
+        return_code, stdout, stderr = 127, b'', bytes(str(e), 'utf-8')
+    return {'file': str(output), 'return_code': return_code, 'stdout': stdout, 'stderr': stderr}
+
+
+
+
+
+
+def sign_universal(config, sign_args, jobs=None, timeout=None):
+    """sign per-architecture slices, merge them with lipo and sign the merged binaries
+    
+    every slice is signed concurrently; each binary is merged as soon as all of its
+    slices are signed and re-signed as soon as it is merged, so the steps for 
+    different binaries overlap. Returns sign_files() style results for every step."""
+    groups = group_slices(config['package_details']['arch_file_lists'])
+    output_dir = universal_dir(config)
+    lipo = tool_command(config, 'lipo')
+    archs = sorted(config['package_details']['arch_file_lists'])
+    for name, slices in groups.items():
+        if len(slices) != len(archs):
+            logging.warning(f'{name} has no slice for {", ".join(sorted(set(archs) - set(slices)))}')
+    
+    print(f'signing {sum(len(s) for s in groups.values())} slices of {len(groups)} universal binaries')
+    results = []
+    steps = {}
+    remaining = {name: len(slices) for name, slices in groups.items()}
+    failed = set()
+    with futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        for name, slices in groups.items():
+            for arch, file in slices.items():
+                steps[executor.submit(in_context(sign_file), file, sign_args, timeout)] = ('slice', name)
+        
+        while steps:
+            done, pending = futures.wait(steps, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                step, name = steps.pop(future)
+                result = future.result()
+                results.append(result)
+                if result['return_code'] != 0:
+                    print(f'FAILED {step}: {result["file"]}')
+                    failed.add(name)
+                    continue
+                print(f'ok {step}: {result["file"]}')
+                if step == 'slice':
+                    remaining[name] -= 1
+                    if remaining[name] == 0 and name not in failed:
+                        slices = [groups[name][a] for a in archs if a in groups[name]]
+                        steps[executor.submit(in_context(merge_slices), lipo, output_dir/name, 
+                                              slices, timeout)] = ('merge', name)
+                elif step == 'merge':
+                    steps[executor.submit(in_context(sign_file), result['file'], sign_args, timeout)] = ('sign', name)
+    return results
+
+
+
+
+
+
+def sign_flagged(config, flagged, sign_args, jobs=1, pool='thread', timeout=None):
+    """re-sign only the files flagged by the last notarization log and the bundles around them
+    
+    bundles are signed after everything inside them, deepest first, so their seals 
+    cover the new signatures"""
+    roots = [os.path.abspath(f) for f in config['package_details']['file_list']]
+    bundles = set()
+    for file in flagged:
+        parent = os.path.dirname(os.path.abspath(file))
+        while any(parent == r or parent.startswith(r + os.sep) for r in roots):
+            if is_bundle(parent):
+                bundles.add(parent)
+            parent = os.path.dirname(parent)
+    levels = [flagged]
+    for depth in sorted({b.count(os.sep) for b in bundles}, reverse=True):
+        levels.append(sorted(os.path.relpath(b) for b in bundles if b.count(os.sep) == depth))
+    
+    print(f're-signing {len(flagged)} files flagged by notarization and {len(bundles)} enclosing bundles')
+    results = []
+    for level in levels:
+        results.extend(sign_files(level, sign_args, jobs=jobs, pool=pool, timeout=timeout))
+        if any(r['return_code'] != 0 for r in results):
+            break
+    return_code, stdout, stderr = summarize_sign_results(results)
+    if return_code == 0:
+        mark_flagged_resigned(config)
+    return return_code, stdout, stderr
+
+
+
+
+
+
+def get_jobs(config):
+    try:
+        return int(config.get('main', {}).get('jobs') or 0)
+    except ValueError:
+        logging.warning(f'invalid value for [main] jobs: {config["main"]["jobs"]}')
+        return 0
+
+
+
+
+
+
+def der_element(data, offset):
+    """(tag, start, end) of the content of the DER element at `offset`"""
+    tag, length = data[offset], data[offset + 1]
+    start = offset + 2
+    if length & 0x80:
+        count = length & 0x7F
+        length = int.from_bytes(data[start:start + count], 'big')
+        start += count
+    return tag, start, start + length
+
+
+
+
+
+
+def certificate_not_after(der):
+    """expiry of a DER encoded X.509 certificate as a unix time"""
+    _, tbs, _ = der_element(der, 0)
+    _, field, _ = der_element(der, tbs)
+    tag, _, end = der_element(der, field)
+    # skip the optional [0] version, then serial number, signature algorithm and issuer
+    field = end if tag == 0xA0 else field
+    for _ in range(3):
+        _, _, field = der_element(der, field)
+    _, validity, _ = der_element(der, field)
+    _, _, not_after = der_element(der, validity)
+    tag, start, end = der_element(der, not_after)
+    text = der[start:end].decode('ascii').rstrip('Z')
+    if tag == 0x17:
+        # UTCTime has a two digit year
+        text = ('19' if int(text[:2]) >= 50 else '20') + text
+    return calendar.timegm(time.strptime(text[:14], '%Y%m%d%H%M%S'))
+
+
+
+
+
+
+FIND_IDENTITY_LINE = re.compile(r'\s*\d+\)\s+([0-9A-F]{40})\s+"(.*)"')
+SHA1_IDENTITY = re.compile(r'[0-9A-Fa-f]{40}\Z')
+
+_keychain_identities = None
+_keychain_identities_lock = threading.Lock()
+
+def keychain_identities(config):
+    """{sha1: name} of the valid signing identities; `security find-identity` runs once per process"""
+    global _keychain_identities
+    with _keychain_identities_lock:
+        if _keychain_identities is None:
+            r, o, e = run_command(tool_command(config, 'security') + ['find-identity', '-v'])
+            identities = {}
+            for line in o.decode('utf-8', errors='replace').splitlines():
+                match = FIND_IDENTITY_LINE.match(line)
+                if match:
+                    identities[match.group(1)] = match.group(2)
+            _keychain_identities = identities
+        return _keychain_identities
+
+
+
+
+
+
+def certificate_expiry(config, name):
+    """{sha1: expiry} of the certificates whose name contains `name`"""
+    r, o, e = run_command(tool_command(config, 'security') + ['find-certificate', '-a', '-Z', '-p', '-c', name])
+    expiry = {}
+    for sha1, pem in re.findall(rb'SHA-1 hash: ([0-9A-F]{40})\s+-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----', o, re.S):
+        try:
+            expiry[sha1.decode()] = certificate_not_after(base64.b64decode(pem))
+        except (ValueError, IndexError) as e:
+            logging.warning(f'could not read the certificate {sha1.decode()}: {e}')
+    return expiry
+
+
+
+
+
+
+def resolve_identity(config, value, installer=False):
+    """look up the application (or installer) identity whose name contains `value`
+    
+    returns an identity cache entry or None"""
+    try:
+        identities = keychain_identities(config)
+    except OSError as e:
+        logging.debug(f'could not list signing identities: {e}')
+        return None
+    # like codesign and productbuild, only consider the kind of certificate the tool signs with
+    matches = {sha1: name for sha1, name in identities.items()
+               if (value in name or value.upper() == sha1) and ('Installer' in name) == installer}
+    names = sorted(set(matches.values()))
+    if not matches:
+        logging.warning(f'no valid signing identity matches "{value}"')
+        return None
+    if len(names) > 1:
+        logging.warning(f'"{value}" matches several signing identities: {", ".join(names)}')
+        return None
+    try:
+        expiry = certificate_expiry(config, names[0])
+    except OSError as e:
+        logging.debug(f'could not read certificates: {e}')
+        expiry = {}
+    # a renewed certificate has the same name as the old one; use the one that is valid longest
+    sha1 = max(matches, key=lambda s: expiry.get(s, 0))
+    if sha1 not in expiry:
+        logging.warning(f'could not read the expiry date of {names[0]} ({sha1})')
+    return {'sha1': sha1, 'name': names[0], 'not_after': expiry.get(sha1), 'resolved': time.time()}
+
+
+
+
+
+
+_signing_identities = {}
+_signing_identities_lock = threading.Lock()
+
+def signing_identity(config, key):
+    """the certificate SHA-1 for `[identification] key` (application_id or installer_id)
+    
+    the substring is resolved with `security` and kept in the identity cache for
+    identity_ttl seconds, so codesign and productbuild get an exact identity instead
+    of searching the keychain on every call. The substring is used as it is when it
+    cannot be resolved to exactly one valid identity"""
+    value = config['identification'][key]
+    if SHA1_IDENTITY.match(value) or not main_option(config, 'resolve_identity', True):
+        return value
+    path = Path(os.path.expanduser(config.get('main', {}).get('identity_cache', '~/.cache/pycodesign/identities.json')))
+    ttl = float(config.get('main', {}).get('identity_ttl', 24*3600))
+    
+    with _signing_identities_lock:
+        if (key, value) in _signing_identities:
+            return _signing_identities[key, value]
+        try:
+            with open(path) as f:
+                cache = json.load(f)['identities']
+        except (OSError, ValueError, KeyError):
+            cache = {}
+        now = time.time()
+        entry = cache.get(f'{key} {value}')
+        if entry and now - entry['resolved'] < ttl and (entry['not_after'] or now + 1) > now:
+            logging.debug(f'using cached identity for "{value}": {entry["name"]} ({entry["sha1"]})')
+        else:
+            entry = resolve_identity(config, value, key == 'installer_id')
+            if entry is None:
+                _signing_identities[key, value] = value
+                return value
+            cache[f'{key} {value}'] = entry
+            atomic_write_json(path, {'identities': cache})
+            logging.info(f'resolved "{value}" to {entry["name"]} ({entry["sha1"]})')
+        
+        if entry['not_after'] and entry['not_after'] - now < 30*24*3600:
+            logging.warning(f'{entry["name"]} expires on '
+                            f'{time.strftime("%Y-%m-%d", time.localtime(entry["not_after"]))}')
+        _signing_identities[key, value] = entry['sha1']
+        return entry['sha1']
+
+
+
+
+
+
+def sign(config):
+    
+    try:
+        entitlements = strtobool(config['package_details']['entitlements'])
+    except (AttributeError, ValueError):
+        entitlements = config['package_details']['entitlements']
+    
+    if (not entitlements) or (entitlements == 'None'):
+        entitlements = None
+        
+    config['package_details']['entitlements'] = entitlements
+
+    args = {
+        'command': tool_command(config, 'codesign'),
+        'args': ['--deep', '--force', '--timestamp', '--options=runtime'],
+        'entitlements': ['--entitlements', config["package_details"]["entitlements"]] if config["package_details"]["entitlements"] else [],
+        'signature': ['--sign', signing_identity(config, 'application_id')],
+        'files': config['package_details']['file_list']
+    }
+        
+    jobs = get_jobs(config)
+    pool = config.get('main', {}).get('pool', 'thread')
+    file_list = config['package_details']['file_list']
+    timeout = float(config.get('main', {}).get('sign_timeout', 0)) or None
+    
+    inside_out = main_option(config, 'inside_out', False)
+    
+    if inside_out:
+        # nested code is signed explicitly, so --deep is not needed
+        args['args'].remove('--deep')
+    sign_args = [i for k, v in args.items() if k != 'files' for i in v]
+    
+    flagged = flagged_files(config)
+    if flagged:
+        return sign_flagged(config, flagged, [a for a in sign_args if a != '--deep'], jobs or 1, pool, timeout)
+    
+    cache = get_sign_cache(config, sign_args)
+    
+    universal_results = []
+    if config['package_details'].get('arch_file_lists'):
+        # universal binaries are built and signed here; sign everything else below
+        universal_results = sign_universal(config, [a for a in sign_args if a != '--deep'], jobs, timeout)
+        merged = {str(universal_dir(config)/name) for name in group_slices(config['package_details']['arch_file_lists'])}
+        file_list = [f for f in file_list if f not in merged]
+        args['files'] = file_list
+        if not file_list:
+            return summarize_sign_results(universal_results)
+    
+    scan = scan_tree(file_list, jobs)
+    for warning in check_binaries(scan, file_list):
+        logging.warning(warning)
+    
+    # files and bundles can be signed on other hosts; see `pycodesign.py worker`
+    remote = get_remote_signer(config, sign_args)
+    if inside_out:
+        results = sign_inside_out(file_list, sign_args, jobs=jobs, pool=pool, cache=cache, timeout=timeout, scan=scan,
+                                  remote=remote)
+    elif remote:
+        print(f'signing {len(file_list)} files using {remote.describe()}')
+        results = sign_files(file_list, sign_args, cache=cache, timeout=timeout, remote=remote)
+    elif jobs:
+        # one codesign call per file on a pool of workers
+        print(f'signing {len(file_list)} files using {jobs} {pool} workers')
+        results = sign_files(file_list, sign_args, jobs=jobs, pool=pool, cache=cache, timeout=timeout)
+    else:
+        results = None
+    
+    if results is not None:
+        if cache:
+            cache.save()
+        return summarize_sign_results(universal_results + results)
+    
+    input_hashes = {}
+    if cache:
+        cached, input_hashes = cache_lookup_files(cache, file_list)
+        for file, status in cached.items():
+            print(f'[cached] {status}: {file}')
+        file_list = [f for f in file_list if f not in cached]
+        args['files'] = file_list
+        if not file_list:
+            cache.save()
+            return summarize_sign_results(universal_results)
+    
+    final_list = [i for k, v in args.items() for i in v]
+    logging.debug('running command:')
+    logging.debug(shlex.join(final_list))
+
+    print(f'signing files: {" ".join(args["files"])}')
+    
+    output = CodesignOutput(file_list)
+    return_code, stdout, stderr = run_command(final_list, timeout=timeout, on_line=output.on_line)
+    logging.debug(f'return code: {return_code}')
+    logging.debug(f'stdout: {stdout}')
+    logging.debug(f'stderr: {stderr}')
+    for verdict in output.failed():
+        print(f'FAILED: {verdict.path}: {"; ".join(verdict.messages)}')
+    
+    if cache:
+        if return_code == 0:
+            cache_store_files(cache, [{'file': f, 'return_code': 0} for f in file_list], input_hashes)
+        cache.save()
+    
+    if universal_results:
+        universal_code, universal_stdout, universal_stderr = summarize_sign_results(universal_results)
+        return return_code or universal_code, universal_stdout + stdout, universal_stderr + stderr
+    return return_code, stdout, stderr
+    
+
+
+
+
+
+
+def new_staging_stats():
+    return {'files': 0, 'bytes_linked': 0, 'bytes_cloned': 0, 'bytes_copied': 0}
+
+
+
+
+
+
+def copy_xattrs(src, dst):
+    """copy extended attributes; copystat() already does this where os.listxattr exists"""
+    if hasattr(os, 'listxattr') or sys.platform != 'darwin':
+        return
+    import ctypes
+    libc = ctypes.CDLL('libc.dylib', use_errno=True)
+    COPYFILE_XATTR = 1 << 2
+    if libc.copyfile(os.fsencode(src), os.fsencode(dst), None, COPYFILE_XATTR) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), str(dst))
+
+
+
+
+
+
+def stage_file_copy(src, dst, stats):
+    """in-process copy of data, mode, timestamps and xattrs"""
+    shutil.copyfile(src, dst, follow_symlinks=False)
+    shutil.copystat(src, dst, follow_symlinks=False)
+    copy_xattrs(src, dst)
+    stats['bytes_copied'] += os.path.getsize(dst)
+
+
+
+
+
+
+def clone_file(src, dst):
+    """copy-on-write clone of `src`; raises OSError if the filesystem can not clone"""
+    if sys.platform == 'darwin':
+        import ctypes
+        libc = ctypes.CDLL('libc.dylib', use_errno=True)
+        # clonefile() also clones mode, timestamps and xattrs
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(dst))
+        return
+    
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst, follow_symlinks=False)
+
+
+
+
+
+
+def copy_file_range_file(src, dst):
+    """in-kernel copy with os.copy_file_range (linux); may be shared by the filesystem"""
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        remaining = os.fstat(s.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+    shutil.copystat(src, dst, follow_symlinks=False)
+
+
+
+
+
+
+def stage_file_reflink(src, dst, stats):
+    """clone `src`; falls back to copy_file_range and then an in-process copy"""
+    size = os.path.getsize(src)
+    try:
+        clone_file(src, dst)
+        stats['bytes_cloned'] += size
+        return
+    except (OSError, AttributeError) as e:
+        logging.debug(f'could not clone {src}: {e}')
+    if hasattr(os, 'copy_file_range'):
+        try:
+            copy_file_range_file(src, dst)
+            stats['bytes_copied'] += size
+            return
+        except OSError as e:
+            logging.debug(f'copy_file_range failed for {src}: {e}')
+    stage_file_copy(src, dst, stats)
+
+
+
+
+
+
+def stage_file_hardlink(src, dst, stats):
+    """hardlink `src`; the link shares mode and xattrs with the source. Falls back to
+    reflink/copy when the staging directory is on another filesystem"""
+    try:
+        os.link(src, dst, follow_symlinks=False)
+        stats['bytes_linked'] += os.path.getsize(dst)
+    except OSError as e:
+        logging.debug(f'could not hardlink {src}: {e}')
+        stage_file_reflink(src, dst, stats)
+
+
+
+
+
+
+def stage_tree(src, dst, stage_file, stats):
+    """recreate `src` at `dst` using `stage_file` for each regular file
+    
+    symlinks inside of the tree are recreated as symlinks, nothing is staged as a symlink"""
+    src = str(src)
+    dst = str(dst)
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+    elif os.path.isdir(src):
+        os.makedirs(dst, exist_ok=True)
+        for entry in os.scandir(src):
+            stage_tree(entry.path, os.path.join(dst, entry.name), stage_file, stats)
+        shutil.copystat(src, dst, follow_symlinks=False)
+        copy_xattrs(src, dst)
+    else:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        stage_file(src, dst, stats)
+        stats['files'] += 1
+
+
+
+
+
+
+def stage_ditto(src, dst, stats):
+    return_code, stdout, stderr = run_command(['ditto', str(src), str(dst)])
+    if return_code != 0:
+        raise OSError(f'ditto failed with return code {return_code}: {str(stderr, "utf-8").strip()}')
+    for root, dirs, files in os.walk(src):
+        for f in files:
+            path = os.path.join(root, f)
+            if not os.path.islink(path):
+                stats['bytes_copied'] += os.path.getsize(path)
+                stats['files'] += 1
+    if os.path.isfile(src):
+        stats['bytes_copied'] += os.path.getsize(src)
+        stats['files'] += 1
+
+
+
+
+
+
+# staging backends copy one file_list entry (a file or a directory) into the 
+# package root: backend(src, dst, stats)
+STAGING_BACKENDS = {
+    'ditto': stage_ditto,
+    'auto': lambda src, dst, stats: stage_tree(src, dst, stage_file_hardlink, stats),
+    'hardlink': lambda src, dst, stats: stage_tree(src, dst, stage_file_hardlink, stats),
+    'reflink': lambda src, dst, stats: stage_tree(src, dst, stage_file_reflink, stats),
+    'copy': lambda src, dst, stats: stage_tree(src, dst, stage_file_copy, stats),
+}
+
+
+
+
+
+
+def get_staging_backend(config):
+    name = config.get('main', {}).get('staging', 'auto')
+    try:
+        return name, STAGING_BACKENDS[name]
+    except KeyError:
+        logging.warning(f'unknown staging backend "{name}"; using "auto"')
+        return 'auto', STAGING_BACKENDS['auto']
+
+
+
+
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+    return f'{size:.1f} {unit}' if unit != 'B' else f'{size} B'
+
+
+
+
+
+
+def format_staging_stats(stats):
+    return (f'staged {stats["files"]} files: {format_size(stats["bytes_linked"])} linked, '
+            f'{format_size(stats["bytes_cloned"])} cloned, {format_size(stats["bytes_copied"])} copied')
+
+
+
+
+
+
+def payload_manifest(file_list, digests=None, algorithms=('sha256',), names=None):
+    """describe every path that package() stages, relative to the installation path
+    
+    `digests` is a DigestCache used to skip hashing unchanged files; `names` maps
+    entries to their path in the package when it is not just their file name
+    returns {relative path: {'type', 'source', 'mode', 'size', digests... or 'target'}}"""
+    manifest = {}
+    
+    def add(source, rel):
+        st = os.lstat(source)
+        if os.path.islink(source):
+            manifest[rel] = {'type': 'link', 'source': source, 'target': os.readlink(source)}
+        elif os.path.isdir(source):
+            manifest[rel] = {'type': 'dir', 'source': source, 'mode': st.st_mode}
+        else:
+            manifest[rel] = {'type': 'file', 'source': source, 'mode': st.st_mode, 'size': st.st_size,
+                             **(digests.digests(source, algorithms) if digests else file_digests(source, algorithms))}
+    
+    for file in file_list:
+        my_file = Path(file).resolve()
+        top = (names or {}).get(file) or my_file.name
+        add(str(my_file), top)
+        if not my_file.is_dir():
+            continue
+        for root, dirs, files in os.walk(my_file):
+            for name in dirs + files:
+                source = os.path.join(root, name)
+                add(source, os.path.join(top, os.path.relpath(source, my_file)))
+    return manifest
+
+
+
+
+
+
+def staging_paths(config):
+    """persistent staging directory and build manifest for incremental packaging"""
+    root = Path(config.get('main', {}).get('staging_dir', '.pycodesign/staging'))
+    name = config['package_details']['package_name']
+    return (root/name).resolve(), root/f'{name}.build.json'
+
+
+
+
+
+
+def build_params(config):
+    details = config['package_details']
+    params = {'installation_path': str(Path(details['installation_path']).resolve()),
+            'bundle_id': details['bundle_id'],
+            'version': details['version'],
+            'installer_id': config['identification']['installer_id']}
+    if pkg_builder(config) == 'xar':
+        params.update(builder='xar', signed=main_option(config, 'pkg_sign', True))
+    return params
+
+
+
+
+
+
+def update_staging(temp_path, previous, current, backend, stats):
+    """bring the persistent staging directory from `previous` to `current` payload manifest
+    
+    only entries that were added or changed are staged again; returns the number of changes"""
+    changed = set()
+    stale = [rel for rel in previous if rel not in current or previous[rel] != current[rel]]
+    # deepest first so directories are emptied before they are removed
+    for rel in sorted(stale, key=lambda r: r.count(os.sep), reverse=True):
+        if rel in current and current[rel]['type'] == 'dir' == previous[rel]['type']:
+            continue
+        target = temp_path/rel
+        if target.is_dir() and not target.is_symlink():
+            shutil.rmtree(target, ignore_errors=True)
+        elif target.exists() or target.is_symlink():
+            target.unlink()
+        changed.add(rel)
+    
+    for rel in sorted(current, key=lambda r: r.count(os.sep)):
+        entry = current[rel]
+        if previous.get(rel) == entry and (os.path.lexists(temp_path/rel)):
+            continue
+        target = temp_path/rel
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if entry['type'] == 'dir':
+            target.mkdir(exist_ok=True)
+            os.chmod(target, entry['mode'] & 0o7777)
+        elif entry['type'] == 'link':
+            os.symlink(entry['target'], target)
+        else:
+            backend(entry['source'], target, stats)
+        changed.add(rel)
+    return len(changed)
+
+
+
+
+
+
+# flat packages are xar archives holding a Distribution and one component package
+# (Bom, PackageInfo and a pbzx compressed cpio Payload); see `build_flat_package`
+
+BIT_REVERSED = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+
+class PosixCksum:
+    """the CRC of cksum(1), which the Bom records for every file and link"""
+    __slots__ = ('crc', 'length')
+    
+    def __init__(self):
+        # zlib inverts the value on the way in and out; this starts the register at 0 like cksum
+        self.crc = 0xFFFFFFFF
+        self.length = 0
+    
+    def update(self, data):
+        # cksum uses the unreflected CRC-32; zlib computes the reflected one of the bit reversed bytes
+        self.crc = zlib.crc32(data.translate(BIT_REVERSED), self.crc)
+        self.length += len(data)
+    
+    def value(self):
+        length, tail = self.length, bytearray()
+        while length:
+            tail.append(length & 0xFF)
+            length >>= 8
+        crc = zlib.crc32(bytes(tail).translate(BIT_REVERSED), self.crc)
+        return int(f'{crc:032b}'[::-1], 2)
+
+
+
+
+
+
+def payload_entries(root):
+    """(relative name, full path, lstat) for `root` and everything below it
+    
+    breadth first and sorted by name, the order the Bom assigns its ids in"""
+    entries = [('.', str(root), os.lstat(root))]
+    queue = deque(entries)
+    while queue:
+        rel, path, _ = queue.popleft()
+        with os.scandir(path) as scan:
+            children = sorted(scan, key=lambda e: e.name)
+        for child in children:
+            entry = (f'{rel}/{child.name}', child.path, child.stat(follow_symlinks=False))
+            entries.append(entry)
+            if child.is_dir(follow_symlinks=False):
+                queue.append(entry)
+    return entries
+
+
+
+
+
+
+def cpio_header(name, mode, size, ino, mtime, nlink=1):
+    """portable ASCII (odc) cpio header as pkgbuild writes it, owned by root:wheel"""
+    encoded = name.encode('utf-8') + b'\0'
+    return b'070707%06o%06o%06o%06o%06o%06o%06o%011o%06o%011o' % (
+        0, ino & 0o777777, mode, 0, 0, nlink, 0, mtime & 0o77777777777, len(encoded), size) + encoded
+
+
+
+
+
+
+def cpio_stream(entries, checksums, chunk_size=1024*1024):
+    """yield the cpio archive of `entries` in pieces, filling `checksums` with the cksum of each
+    
+    files are read once, for the archive and the Bom checksum together"""
+    for ino, (rel, path, st) in enumerate(entries, start=1):
+        mtime = int(st.st_mtime)
+        if stat.S_ISLNK(st.st_mode):
+            target = os.readlink(path).encode('utf-8')
+            cksum = checksums[rel] = PosixCksum()
+            cksum.update(target)
+            yield cpio_header(rel, st.st_mode, len(target), ino, mtime) + target
+        elif stat.S_ISREG(st.st_mode):
+            cksum = checksums[rel] = PosixCksum()
+            yield cpio_header(rel, st.st_mode, st.st_size, ino, mtime)
+            with open(path, 'rb') as f:
+                while True:
+                    data = f.read(chunk_size)
+                    if not data:
+                        break
+                    cksum.update(data)
+                    yield data
+            if cksum.length != st.st_size:
+                raise OSError(f'{path} changed while it was archived')
+        else:
+            yield cpio_header(rel, st.st_mode, 0, ino, mtime, 2 if stat.S_ISDIR(st.st_mode) else 1)
+    yield cpio_header('TRAILER!!!', 0, 0, 0, 0)
+
+
+
+
+
+
+def fixed_chunks(pieces, size):
+    """regroup the byte strings in `pieces` into chunks of `size` bytes; the last may be shorter"""
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+
+
+
+
+def compress_chunk(chunk):
+    """xz compress one pbzx chunk; runs in a pool process"""
+    compressed = lzma.compress(chunk, format=lzma.FORMAT_XZ)
+    # chunks that do not shrink are stored as they are; readers expect that when both sizes match
+    return compressed if len(compressed) < len(chunk) else chunk
+
+
+
+
+
+
+PBZX_CHUNK = 16*1024**2
+
+def write_pbzx(chunks, output, jobs=None):
+    """write `chunks` to the binary file `output` as a pbzx stream, the Payload format of pkgbuild
+    
+    every chunk is an independent xz stream, so they are compressed on a process pool
+    and written in order; at most 2 * jobs chunks are held at once. Returns the
+    uncompressed size"""
+    jobs = jobs or os.cpu_count()
+    output.write(b'pbzx' + struct.pack('>Q', PBZX_CHUNK))
+    pending = deque()
+    total, last = 0, PBZX_CHUNK
+    executor = None
+    
+    def write_next():
+        chunk, compressed = pending.popleft()
+        if not isinstance(compressed, bytes):
+            compressed = compressed.result()
+        output.write(struct.pack('>QQ', len(chunk), len(compressed)))
+        output.write(compressed)
+    
+    try:
+        for chunk in chunks:
+            total, last = total + len(chunk), len(chunk)
+            if executor is None and pending:
+                # more than one chunk: worth starting the pool
+                executor = futures.ProcessPoolExecutor(max_workers=jobs)
+                first, _ = pending.pop()
+                pending.append((first, executor.submit(compress_chunk, first)))
+            pending.append((chunk, executor.submit(compress_chunk, chunk) if executor else None))
+            if len(pending) >= 2*jobs:
+                write_next()
+        if len(pending) == 1 and executor is None:
+            pending[0] = (pending[0][0], compress_chunk(pending[0][0]))
+        while pending:
+            write_next()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if last == PBZX_CHUNK:
+        # readers stop after the first chunk shorter than the chunk size
+        output.write(struct.pack('>QQ', 0, 0))
+    return total
+
+
+
+
+
+
+class BomWriter:
+    """BOMStore file as written by mkbom: numbered blocks, named variables and an index table"""
+    def __init__(self):
+        # block 0 is the null block
+        self.blocks = [None]
+        self.variables = []
+    
+    def add(self, data=b''):
+        self.blocks.append(bytes(data))
+        return len(self.blocks) - 1
+    
+    def variable(self, name, data):
+        self.variables.append((name, self.add(data)))
+    
+    def tree(self, root, path_count, block_size=4096):
+        return (b'tree' + struct.pack('>IIIIB', 1, root, block_size, path_count, 0))
+    
+    def paths(self, is_leaf, indices, forward=0, backward=0, size=4096):
+        data = struct.pack('>HHII', is_leaf, len(indices), forward, backward)
+        data += b''.join(struct.pack('>II', *pair) for pair in indices)
+        return data.ljust(size, b'\0')
+    
+    def tobytes(self):
+        header_size = 512
+        offset, pointers = header_size, [(0, 0)]
+        for block in self.blocks[1:]:
+            pointers.append((offset, len(block)))
+            offset += len(block)
+        variables = struct.pack('>I', len(self.variables)) + b''.join(
+            struct.pack('>IB', index, len(name)) + name.encode() for name, index in self.variables)
+        # the block table is followed by an (empty) free list
+        index = struct.pack('>I', len(pointers)) + b''.join(struct.pack('>II', *p) for p in pointers)
+        index += struct.pack('>IIIII', 2, 0, 0, 0, 0)
+        vars_offset = offset
+        index_offset = vars_offset + len(variables)
+        header = b'BOMStore' + struct.pack('>IIIIII', 1, len(self.blocks) - 1, index_offset, len(index),
+                                           vars_offset, len(variables))
+        return b''.join([header.ljust(header_size, b'\0'), *self.blocks[1:], variables, index])
+
+
+
+
+
+
+BOM_LEAF_ENTRIES = 256
+
+def build_bom(entries, checksums):
+    """Bom of the staged `entries` (from `payload_entries`) with cksums from `cpio_stream`"""
+    bom = BomWriter()
+    ids = {}
+    keyed = []
+    for number, (rel, path, st) in enumerate(entries, start=1):
+        ids[rel] = number
+        parent, _, name = rel.rpartition('/')
+        link = os.readlink(path).encode('utf-8') if stat.S_ISLNK(st.st_mode) else b''
+        kind = 3 if link else 2 if stat.S_ISDIR(st.st_mode) else 1
+        checksum = checksums[rel].value() if rel in checksums else 0
+        info = struct.pack('>BBHHIIIIBII', kind, 1, 0, st.st_mode & 0xFFFF, 0, 0, int(st.st_mtime),
+                           0 if kind == 2 else st.st_size & 0xFFFFFFFF, 1, checksum,
+                           len(link) + 1 if link else 0) + (link + b'\0' if link else b'')
+        info_index = bom.add(struct.pack('>II', number, bom.add(info)))
+        key_index = bom.add(struct.pack('>I', ids.get(parent, 0)) + name.encode('utf-8') + b'\0')
+        keyed.append((info_index, key_index))
+    
+    # leaves linked to their neighbours, then branch levels until a single root is left
+    level = [keyed[i:i + BOM_LEAF_ENTRIES] for i in range(0, len(keyed), BOM_LEAF_ENTRIES)]
+    nodes = [bom.add() for _ in level]
+    for i, (node, indices) in enumerate(zip(nodes, level)):
+        bom.blocks[node] = bom.paths(1, indices, nodes[i + 1] if i + 1 < len(nodes) else 0,
+                                     nodes[i - 1] if i else 0)
+    keys = [indices[-1][1] for indices in level]
+    fanout = (4096 - 12) // 8
+    while len(nodes) > 1:
+        children = list(zip(nodes, keys))
+        level = [children[i:i + fanout] for i in range(0, len(children), fanout)]
+        nodes = [bom.add(bom.paths(0, indices)) for indices in level]
+        keys = [indices[-1][1] for indices in level]
+    
+    bom.variable('BomInfo', struct.pack('>IIIIIII', 1, len(entries) + 1, 1, 0, 0, 0, 0))
+    bom.variable('Paths', bom.tree(nodes[0], len(entries)))
+    bom.variable('HLIndex', bom.tree(bom.add(bom.paths(1, [])), 0))
+    vtree = bom.add(bom.tree(bom.add(bom.paths(1, [], size=128)), 0, 128))
+    bom.variable('VIndex', struct.pack('>IIIB', 1, vtree, 0, 0))
+    bom.variable('Size64', bom.tree(bom.add(bom.paths(1, [])), 0))
+    return bom.tobytes()
+
+
+
+
+
+
+def package_info_xml(config, number_of_files, install_kbytes):
+    details = config['package_details']
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<pkg-info overwrite-permissions="true" relocatable="false" identifier={saxutils.quoteattr(details["bundle_id"] + ".pkg")} postinstall-action="none" version={saxutils.quoteattr(details["version"])} format-version="2" generator-version="pycodesign-{version}" install-location="/" auth="root">
+    <payload numberOfFiles="{number_of_files}" installKBytes="{install_kbytes}"/>
+    <bundle-version/>
+    <upgrade-bundle/>
+    <update-bundle/>
+    <atomic-update-bundle/>
+    <strict-identifier/>
+    <relocate/>
+</pkg-info>
+'''
+
+
+
+
+
+
+def distribution_xml(config, component, install_kbytes):
+    details = config['package_details']
+    pkg_id = saxutils.quoteattr(details['bundle_id'] + '.pkg')
+    return f'''<?xml version="1.0" encoding="utf-8"?>
+<installer-gui-script minSpecVersion="2">
+    <pkg-ref id={pkg_id}>
+        <bundle-version/>
+    </pkg-ref>
+    <options customize="never" require-scripts="false" hostArchitectures="x86_64,arm64"/>
+    <choices-outline>
+        <line choice="default">
+            <line choice={pkg_id}/>
+        </line>
+    </choices-outline>
+    <choice id="default"/>
+    <choice id={pkg_id} visible="false">
+        <pkg-ref id={pkg_id}/>
+    </choice>
+    <pkg-ref id={pkg_id} version={saxutils.quoteattr(details["version"])} onConclusion="none" installKBytes="{install_kbytes}">#{saxutils.escape(component)}</pkg-ref>
+</installer-gui-script>
+'''
+
+
+
+
+
+
+class HashingWriter:
+    """binary file wrapper that counts and sha1 hashes everything written through it"""
+    def __init__(self, file):
+        self.file = file
+        self.sha1 = hashlib.sha1()
+        self.length = 0
+    
+    def write(self, data):
+        self.sha1.update(data)
+        self.length += len(data)
+        return self.file.write(data)
+
+
+
+
+
+
+def xar_member(data):
+    """(length, sha1, reader) of in-memory content for `write_xar`"""
+    return len(data), hashlib.sha1(data).hexdigest(), io.BytesIO(data)
+
+
+
+
+
+
+def write_xar(output, members):
+    """write the xar archive of `members` to the binary file `output`
+    
+    `members` is a list of (name, content) where content is a (length, sha1, reader)
+    tuple for a file or another list of members for a directory. Everything is stored
+    uncompressed; the TOC is zlib compressed and checked with sha1 like xar does"""
+    heap, offset, ids = [], 20, iter(range(1, 1 << 32))
+    
+    def toc_files(members, indent):
+        nonlocal offset
+        lines = []
+        for name, content in members:
+            lines.append(f'{indent}<file id="{next(ids)}">')
+            if isinstance(content, list):
+                kind, mode = 'directory', '0755'
+            else:
+                kind, mode = 'file', '0644'
+                length, sha1, reader = content
+                heap.append(reader)
+                lines += [f'{indent} <data>', f'{indent}  <length>{length}</length>',
+                          f'{indent}  <offset>{offset}</offset>', f'{indent}  <size>{length}</size>',
+                          f'{indent}  <encoding style="application/octet-stream"/>',
+                          f'{indent}  <extracted-checksum style="sha1">{sha1}</extracted-checksum>',
+                          f'{indent}  <archived-checksum style="sha1">{sha1}</archived-checksum>',
+                          f'{indent} </data>']
+                offset += length
+            lines += [f'{indent} <name>{saxutils.escape(name)}</name>', f'{indent} <type>{kind}</type>',
+                      f'{indent} <mode>{mode}</mode>', f'{indent} <uid>0</uid>', f'{indent} <user>root</user>',
+                      f'{indent} <gid>0</gid>', f'{indent} <group>wheel</group>']
+            if kind == 'directory':
+                lines += toc_files(content, indent + ' ')
+            lines.append(f'{indent}</file>')
+        return lines
+    
+    files = toc_files(members, '  ')
+    toc = '\n'.join(['<?xml version="1.0" encoding="UTF-8"?>', '<xar>', ' <toc>',
+                     '  <checksum style="sha1">', '   <offset>0</offset>', '   <size>20</size>', '  </checksum>',
+                     f'  <creation-time>{time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime())}</creation-time>',
+                     *files, ' </toc>', '</xar>', '']).encode('utf-8')
+    compressed = zlib.compress(toc, 9)
+    output.write(struct.pack('>4sHHQQI', b'xar!', 28, 1, len(compressed), len(toc), 1))
+    output.write(compressed)
+    output.write(hashlib.sha1(compressed).digest())
+    for reader in heap:
+        shutil.copyfileobj(reader, output, 1024*1024)
+
+
+
+
+
+
+def build_flat_package(config, root, output, jobs=None):
+    """write the staging directory `root` as the unsigned product archive `output`
+    
+    the layout of productbuild --root <root> /, built in process so it also works away
+    from a Mac; the payload chunks are compressed on `jobs` processes"""
+    entries = payload_entries(root)
+    component = f'{config["package_details"]["package_name"]}.pkg'
+    checksums = {}
+    with tempfile.TemporaryFile() as payload:
+        writer = HashingWriter(payload)
+        size = write_pbzx(fixed_chunks(cpio_stream(entries, checksums), PBZX_CHUNK), writer, jobs)
+        payload.seek(0)
+        logging.debug(f'payload: {len(entries)} entries, {format_size(size)} archived, '
+                      f'{format_size(writer.length)} compressed')
+        install_kbytes = -(-sum(st.st_size for _, _, st in entries if stat.S_ISREG(st.st_mode)) // 1024)
+        members = [
+            ('Distribution', xar_member(distribution_xml(config, component, install_kbytes).encode('utf-8'))),
+            (component, [
+                ('Bom', xar_member(build_bom(entries, checksums))),
+                ('Payload', (writer.length, writer.sha1.hexdigest(), payload)),
+                ('PackageInfo', xar_member(package_info_xml(config, len(entries), install_kbytes).encode('utf-8'))),
+            ]),
+        ]
+        with open(output, 'wb') as f:
+            write_xar(f, members)
+
+
+
+
+
+
+def pkg_builder(config):
+    """`productbuild` or the in process `xar` writer, from [main] pkg_builder"""
+    builder = config.get('main', {}).get('pkg_builder', 'productbuild')
+    if builder not in ('productbuild', 'xar'):
+        logging.warning(f'invalid value for [main] pkg_builder: {builder}; using productbuild')
+        return 'productbuild'
+    return builder
+
+
+
+
+
+
+def xar_package(config, pkg_temp, package_file):
+    """build `package_file` from the staging directory with `build_flat_package` and sign it with productsign"""
+    signed = main_option(config, 'pkg_sign', True)
+    unsigned = package_file.with_name(f'{package_file.stem}.unsigned.pkg') if signed else package_file
+    print(f'packaging {package_file} (xar)')
+    try:
+        build_flat_package(config, pkg_temp, unsigned, get_jobs(config))
+    except OSError as e:
+        unsigned.unlink(missing_ok=True)
+        return 1, b'', bytes(f'could not build {unsigned}: {e}', 'utf-8')
+    if not signed:
+        print(f'{package_file} was left unsigned ([main] pkg_sign = no)')
+        return 0, b'', b''
+    
+    # productsign will not replace an existing package; the old one is only replaced once signing worked
+    signing = package_file.with_name(f'{package_file.stem}.signing.pkg')
+    signing.unlink(missing_ok=True)
+    args = {
+        'command': tool_command(config, 'productsign'),
+        'signature': ['--sign', signing_identity(config, 'installer_id')],
+        'args': ['--timestamp'],
+        'files': [str(unsigned), str(signing)]
+    }
+    final_list = [i for k, v in args.items() for i in v]
+    
+    logging.debug('running command:')
+    logging.debug(shlex.join(final_list))
+    
+    try:
+        r, o, e = run_command(final_list)
+    except OSError as error:
+        r, o, e = 127, b'', bytes(f'could not run productsign: {error}', 'utf-8')
+    if r != 0:
+        signing.unlink(missing_ok=True)
+        e += bytes(f'\n{package_file} was not replaced; the unsigned package is {unsigned}', 'utf-8')
+        return r, o, e
+    os.replace(signing, package_file)
+    unsigned.unlink(missing_ok=True)
+    return r, o, e
+
+
+
+
+
+
+def manifest_file(config):
+    return Path(f'{config["package_details"]["package_name"]}.manifest.json')
+
+
+
+
+
+
+def write_package_manifest(config, package_file, payload, digests, algorithms):
+    """write the integrity manifest of `package_file` and its payload next to the package"""
+    install_path = config['package_details']['installation_path']
+    files = {}
+    for rel, entry in sorted(payload.items()):
+        if entry['type'] == 'dir':
+            continue
+        path = os.path.join(install_path, rel)
+        if entry['type'] == 'link':
+            files[path] = {'link': entry['target']}
+        else:
+            files[path] = {'size': entry['size'], 'mode': f'{entry["mode"] & 0o7777:o}', 
+                           **{a: entry[a] for a in algorithms}}
+    manifest = {
+        'package': {'name': package_file.name, 'size': package_file.stat().st_size,
+                    **digests.digests(package_file, algorithms)},
+        'bundle_id': config['package_details']['bundle_id'],
+        'version': config['package_details']['version'],
+        'installation_path': install_path,
+        'files': files,
+    }
+    atomic_write_json(manifest_file(config), manifest)
+    return manifest
+
+
+
+
+
+
+def update_manifest_package(config):
+    """refresh the package digests in the manifest and the build record after the package was 
+    changed (stapled); otherwise the next -p finds a changed package and builds it again"""
+    package_file = Path(f'{config["package_details"]["package_name"]}.pkg')
+    digests = get_digest_cache(config)
+    build_path = staging_paths(config)[1]
+    try:
+        with open(build_path) as f:
+            build = json.load(f)
+    except (OSError, ValueError):
+        build = {}
+    if build.get('pkg_sha256'):
+        build['pkg_sha256'] = digests.sha256(package_file)
+        atomic_write_json(build_path, build)
+    
+    path = manifest_file(config)
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+    if manifest:
+        algorithms = tuple(a for a in manifest['package'] if a not in ('name', 'size'))
+        manifest['package'] = {'name': package_file.name, 'size': package_file.stat().st_size,
+                               **digests.digests(package_file, algorithms)}
+        atomic_write_json(path, manifest)
+    digests.save()
+
+
+
+
+
+
+def package(config, package_debug=False):
+    incremental = main_option(config, 'incremental', True) and not package_debug
+    write_manifest = main_option(config, 'manifest', True)
+    package_file = Path(f'{config["package_details"]["package_name"]}.pkg')
+    digests = get_digest_cache(config)
+    algorithms = digest_algorithms(config)
+    
+    if incremental:
+        # persistent staging directory that is updated in place between builds
+        pkg_temp, build_path = staging_paths(config)
+        try:
+            with open(build_path) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = {}
+        params = build_params(config)
+        current = payload_manifest(config['package_details']['file_list'], digests, algorithms,
+                                   config['package_details'].get('staging_names'))
+        
+        if (previous.get('params') == params and previous.get('files') == current
+                and package_file.exists() and digests.sha256(package_file) == previous.get('pkg_sha256')):
+            print(f'{package_file} is up to date; nothing changed since it was built')
+            if write_manifest and not manifest_file(config).exists():
+                write_package_manifest(config, package_file, current, digests, algorithms)
+            digests.save()
+            return 0, b'', b''
+        
+        if (config.get('main', {}).get('fresh') or previous.get('params', {}).get('installation_path') != params['installation_path']):
+            shutil.rmtree(pkg_temp, ignore_errors=True)
+            previous = {}
+        if not pkg_temp.exists():
+            previous = {}
+    else:
+        pkg_temp = Path(tempfile.mkdtemp()).resolve()
+        if write_manifest:
+            current = payload_manifest(config['package_details']['file_list'], digests, algorithms,
+                                       config['package_details'].get('staging_names'))
+    
+    install_path = Path(config['package_details']['installation_path']).resolve()
+    
+    temp_path = Path(f'{pkg_temp}/{install_path}')
+    
+#     return pkg_temp, install_path
+    
+    logging.debug(f'pkg_temp: {pkg_temp}')
+    logging.debug(f'install_path: {install_path}')
+    logging.debug(f'temp_path: {temp_path}')
+    
+ 
+    backend_name, backend = get_staging_backend(config)
+    stats = new_staging_stats()
+    temp_path.mkdir(parents=True, exist_ok=True)
+    
+    if incremental:
+        try:
+            changed = update_staging(temp_path, previous.get('files', {}), current, backend, stats)
+        except OSError as e:
+            logging.warning(f'could not update staging directory: {e}')
+            shutil.rmtree(pkg_temp, ignore_errors=True)
+            return 1, b'', bytes(f'could not update staging directory {pkg_temp}: {e}', 'utf-8')
+        print(f'{changed} staged paths added, changed or removed since the last build ({len(current)} in total)')
+    else:
+        for file in config['package_details']['file_list']:
+            my_file = Path(file).resolve()
+            file_name = staging_name(config, file)
+            
+            logging.debug(f'staging {my_file} -> {temp_path/file_name} ({backend_name})')
+            try:
+                (temp_path/file_name).parent.mkdir(parents=True, exist_ok=True)
+                backend(my_file, temp_path/file_name, stats)
+            except OSError as e:
+                logging.warning(f'could not stage file into temp path: {e}')
+                if not package_debug:
+                    shutil.rmtree(pkg_temp)
+                return 1, b'', bytes(f'could not stage {my_file}: {e}', 'utf-8')
+    
+    print(format_staging_stats(stats))
+    
+    if pkg_builder(config) == 'xar':
+        r, o, e = xar_package(config, pkg_temp, package_file)
+    else:
+        args = {
+            'command': tool_command(config, 'productbuild'),
+            'identifier': ['--identifier', f'{config["package_details"]["bundle_id"]}.pkg'],
+            'signature': ['--sign', signing_identity(config, 'installer_id')],
+            'args': ['--timestamp'],
+            'version': ['--version', config["package_details"]["version"]],
+            'root': ['--root', str(pkg_temp), '/', f'./{package_file}']
+            
+        }
+        
+        print(f'packaging {package_file}')
+        final_list = [i for k, v in args.items() for i in v]
+        
+        logging.debug('running command:')
+        logging.debug(shlex.join(final_list))    
+        
+        r, o, e = run_command(final_list)
+    
+    
+#     logging.debug(f'return code: {return_code}')
+#     logging.debug(f'stdout: {stdout}')
+#     logging.debug(f'stderr: {stderr}')
+    
+    if r == 0 and write_manifest and package_file.exists():
+        write_package_manifest(config, package_file, current, digests, algorithms)
+        print(f'wrote integrity manifest {manifest_file(config)}')
+    
+    if incremental:
+        build = {'params': params, 'files': current, 'staging': str(pkg_temp),
+                 'pkg_sha256': digests.sha256(package_file) if r == 0 and package_file.exists() else None}
+        atomic_write_json(build_path, build)
+    elif not package_debug:
+        shutil.rmtree(pkg_temp, ignore_errors=True)
+    else:
+        print(f'Package debugging active:')
+        print(f'Temp files: {pkg_temp}')
+    digests.save()
+    return r, o, e       
+        
+    
+
+
+
+
+
+
+# def package(config, package_debug=False):
+#     pkg_temp = tempfile.mkdtemp()
+#     pkg_temp_path = Path(pkg_temp).resolve()
+#     install_path = Path(config['package_details']['installation_path']).resolve()
+#     logging.debug(f'using pkg_temp_path: {pkg_temp_path}')
+#     logging.debug(f'install_path: {install_path}')
+#     for file in config['package_details']['file_list']:
+#         my_file = Path(file).resolve()
+#         file_name = my_file.name
+#         logging.debug(f'copying file: {file}')
+#         command = f'ditto {file} {pkg_temp_path/install_path/file_name}'
+#         logging.debug(f'run command:\n {command}')
+#         return_code, stderr, stdout = run_command(shlex.split(command))
+#         if return_code > 0:
+#             pkg_temp.cleanup()
+#             return return_code, stderr, stdout
+    
+#     args = {
+#         'command': 'productbuild',
+#         'identifier': f'--identifier {config["package_details"]["bundle_id"]}.pkg',
+#         'signature': f'--sign {config["identification"]["installer_id"]}',
+#         'args': '--timestamp',
+#         'version': f'--version {config["package_details"]["version"]}',
+#         'root': f'--root {pkg_temp_path} / ./{config["package_details"]["package_name"]}.pkg'
+        
+#     }
+    
+#     print(f'packaging {config["package_details"]["package_name"]}.pkg')
+#     final_list = [i if i is not None else '' for k, i in args.items()]
+    
+#     logging.debug('running command:')
+#     logging.debug(' '.join(final_list))    
+    
+#     return_code, stdout, stderr = run_command(final_list)
+    
+#     logging.debug(f'return code: {return_code}')
+#     logging.debug(f'stdout: {stdout}')
+#     logging.debug(f'stderr: {stderr}')
+    
+#     if not package_debug:
+#         shutil.rmtree(pkg_temp_path, ignore_errors=True)
+#     else:
+#         print(f'Package debugging active:')
+#         print(f'Temp files: {pkg_temp_path}')
+#     return return_code, stdout, stderr
+
+
+
+
+
+
+class JSONStream:
+    """incremental parser for the json that notarytool writes with --output-format json
+    
+    pass `on_line` to run_command(); each document is decoded as soon as its last 
+    line arrives, so the output does not have to be kept and scanned again"""
+    __slots__ = ('documents', 'parts', 'depth', 'in_string')
+    # escaped characters, quotes and brackets are all that matter for finding the end of a document
+    tokens = re.compile(r'\\.|["{}\[\]]')
+    
+    def __init__(self):
+        self.documents = []
+        self.parts = []
+        self.depth = 0
+        self.in_string = False
+    
+    def feed(self, text):
+        start = 0 if self.depth else None
+        for match in self.tokens.finditer(text):
+            token = match.group()
+            if self.depth == 0:
+                if token in '{[':
+                    start = match.start()
+                    self.depth = 1
+                continue
+            if token == '"':
+                self.in_string = not self.in_string
+            elif self.in_string or token[0] == '\\':
+                continue
+            elif token in '{[':
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.parts.append(text[start:match.end()])
+                    self.finish()
+                    start = None
+        if self.depth:
+            self.parts.append(text[start:])
+    
+    def finish(self):
+        try:
+            self.documents.append(json.loads(''.join(self.parts)))
+        except ValueError as e:
+            logging.debug(f'could not parse json output: {e}')
+        self.parts = []
+    
+    def on_line(self, command, stream, line):
+        log_line(command, stream, line)
+        if stream == 'stdout':
+            self.feed(line.decode('utf-8', 'replace'))
+    
+    def document(self):
+        """the last complete json object; {} if there was none"""
+        objects = [d for d in self.documents if isinstance(d, dict)]
+        return objects[-1] if objects else {}
+
+
+
+
+
+
+def parse_json_output(stdout):
+    """parse json output that was already captured; returns {} if it is not json"""
+    stream = JSONStream()
+    stream.feed(str(stdout, 'utf-8', 'replace') if isinstance(stdout, bytes) else stdout)
+    return stream.document()
+
+
+
+
+
+
+class NotarySubmission:
+    """output of `notarytool submit` or `notarytool info`"""
+    __slots__ = ('id', 'status', 'name', 'created', 'message', 'raw')
+    
+    def __init__(self, data):
+        self.id = data.get('id')
+        self.status = data.get('status')
+        self.name = data.get('name')
+        self.created = data.get('createdDate')
+        self.message = data.get('message')
+        self.raw = data
+    
+    def __repr__(self):
+        return f'NotarySubmission(id={self.id!r}, status={self.status!r})'
+
+
+
+
+
+
+class NotaryIssue:
+    """one entry of the issues list in a notarization log"""
+    __slots__ = ('severity', 'code', 'path', 'message', 'architecture', 'doc_url')
+    
+    def __init__(self, data):
+        self.severity = data.get('severity')
+        self.code = data.get('code')
+        self.path = data.get('path')
+        self.message = data.get('message')
+        self.architecture = data.get('architecture')
+        self.doc_url = data.get('docUrl')
+    
+    def __repr__(self):
+        return f'NotaryIssue({self.severity!r}, {self.path!r}, {self.message!r})'
+
+
+
+
+
+
+class NotaryLog:
+    """output of `notarytool log`"""
+    __slots__ = ('id', 'status', 'summary', 'sha256', 'issues', 'raw')
+    
+    def __init__(self, data):
+        self.id = data.get('jobId')
+        self.status = data.get('status')
+        self.summary = data.get('statusSummary')
+        self.sha256 = data.get('sha256')
+        self.issues = [NotaryIssue(i) for i in data.get('issues') or [] if isinstance(i, dict)]
+        self.raw = data
+
+
+
+
+
+
+# codesign lines about a file that are not problems
+CODESIGN_INFO = ('replacing existing signature', 'signed ', 'valid on disk', 
+                 'satisfies its designated requirement', 'explicit requirement satisfied')
+
+class CodesignVerdict:
+    """what codesign reported about one file; `ok` is None if it said nothing about it"""
+    __slots__ = ('path', 'ok', 'messages')
+    
+    def __init__(self, path):
+        self.path = path
+        self.ok = None
+        self.messages = []
+    
+    def __repr__(self):
+        return f'CodesignVerdict({self.path!r}, ok={self.ok!r})'
+
+
+
+
+
+
+class CodesignOutput:
+    """per-file verdicts from the `<path>: <message>` lines codesign writes to stderr
+    
+    pass `on_line` to run_command(); lines that are not about one of `files` 
+    (such as keychain errors) are kept in `other`"""
+    __slots__ = ('verdicts', 'other')
+    
+    def __init__(self, files):
+        self.verdicts = {str(f): CodesignVerdict(str(f)) for f in files}
+        self.other = []
+    
+    def feed(self, text):
+        text = text.rstrip()
+        if not text:
+            return
+        # try the longest prefix first; paths can contain ': ' too
+        index = text.rfind(': ')
+        while index > 0:
+            verdict = self.verdicts.get(text[:index])
+            if verdict:
+                message = text[index + 2:]
+                verdict.messages.append(message)
+                if message.lower().startswith(CODESIGN_INFO):
+                    verdict.ok = verdict.ok is not False
+                else:
+                    verdict.ok = False
+                return
+            index = text.rfind(': ', 0, index)
+        self.other.append(text)
+    
+    def on_line(self, command, stream, line):
+        log_line(command, stream, line)
+        if stream == 'stderr':
+            self.feed(line.decode('utf-8', 'replace'))
+    
+    def failed(self):
+        return [v for v in self.verdicts.values() if v.ok is False]
+
+
+
+
+
+
+def notarytool_command(config, *args):
+    return [*tool_command(config, 'xcrun'), 'notarytool', *args, 
+            '--keychain-profile', config["identification"]["keychain-profile"],
+            '--output-format', 'json']
+
+
+
+
+
+
+def submission_file(config):
+    return Path(f'{config["package_details"]["package_name"]}.submission.json')
+
+
+
+
+
+
+class NotaryLedger:
+    """every notarization submission keyed by the SHA-256 of the package that was uploaded
+    
+    the file is re-read before every change so packages notarized by other 
+    processes are not lost; each record holds the submission id, status, 
+    timestamps, the final `notarytool info` output and the notarization log"""
+    
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        self.lock = threading.Lock()
+    
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)['submissions']
+        except (OSError, ValueError, KeyError):
+            return []
+    
+    def update(self, submission_id, **values):
+        with self.lock:
+            submissions = self.load()
+            for record in submissions:
+                if record['id'] == submission_id:
+                    record.update(values)
+                    break
+            else:
+                submissions.append({'id': submission_id, **values})
+            atomic_write_json(self.path, {'submissions': submissions})
+    
+    def submitted(self, submission_id, pkg_hash, config):
+        self.update(submission_id, sha256=pkg_hash, status='submitted',
+                    package=f'{config["package_details"]["package_name"]}.pkg',
+                    bundle_id=config['package_details']['bundle_id'],
+                    version=config['package_details']['version'],
+                    submitted=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    
+    def latest(self, pkg_hash):
+        """the most recent submission of the package with SHA-256 `pkg_hash`, if any"""
+        matches = [r for r in self.load() if r.get('sha256') == pkg_hash]
+        return matches[-1] if matches else None
+    
+    def query(self, pkg_hash=None, submission_id=None, package=None, status=None):
+        records = self.load()
+        if pkg_hash:
+            records = [r for r in records if r.get('sha256', '').startswith(pkg_hash)]
+        if submission_id:
+            records = [r for r in records if r['id'] == submission_id]
+        if package:
+            records = [r for r in records if r.get('package') == package]
+        if status:
+            records = [r for r in records if r.get('status', '').lower() == status.lower()]
+        return records
+
+
+
+
+
+
+_notary_ledgers = {}
+_notary_ledgers_lock = threading.Lock()
+
+def get_notary_ledger(config):
+    """the NotaryLedger for `config` or None if [main] ledger is off"""
+    if not main_option(config, 'ledger', True):
+        return None
+    path = os.path.expanduser(config.get('main', {}).get('ledger_file', '~/.cache/pycodesign/notary-ledger.json'))
+    with _notary_ledgers_lock:
+        if path not in _notary_ledgers:
+            _notary_ledgers[path] = NotaryLedger(path)
+        return _notary_ledgers[path]
+
+
+
+
+
+
+RATE_LIMITED = re.compile(rb'\b429\b|rate.?limit|too many requests|throttl', re.IGNORECASE)
+
+def rate_limited(return_code, stdout, stderr):
+    """True if a failed notarytool call was turned away by Apple's rate limiting"""
+    return return_code != 0 and bool(RATE_LIMITED.search(stderr) or RATE_LIMITED.search(stdout))
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+
+
+
+
+class NotaryScheduler:
+    """admission control for `notarytool submit` shared by every pycodesign process on the host
+    
+    the state - a token bucket refilled at `rate` uploads per minute, the uploads in
+    flight, a queue of waiting uploads ordered by priority then arrival, and the
+    back off after Apple answered 429 - is a json file that is only read and written
+    while holding a flock on its .lock file. Entries of processes that died are dropped"""
+    
+    def __init__(self, path, rate=10, burst=3, max_in_flight=3, backoff=30, max_backoff=900):
+        self.path = Path(path).expanduser()
+        self.lock_path = self.path.with_name(self.path.name + '.lock')
+        self.rate = max(rate, 0.01)/60
+        self.burst = max(burst, 1)
+        self.max_in_flight = max(max_in_flight, 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+    
+    @contextmanager
+    def state(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path) as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    state = {}
+                now = time.time()
+                state.setdefault('queue', {})
+                state.setdefault('in_flight', {})
+                state.setdefault('backoff', 0)
+                state.setdefault('backoff_until', 0)
+                # refill the bucket for the time since the last change
+                tokens = state.get('tokens', self.burst)
+                elapsed = max(now - state.get('updated', now), 0)
+                state['tokens'] = min(tokens + elapsed*self.rate, self.burst)
+                state['updated'] = now
+                # waiters touch their entry every few seconds; uploads take hours at most
+                for key, limit in (('queue', 60), ('in_flight', 4*3600)):
+                    for ticket, entry in list(state[key].items()):
+                        if not process_alive(entry['pid']) or now - entry.get('seen', entry['since']) > limit:
+                            logging.debug(f'dropping stale notary scheduler entry {ticket}')
+                            del state[key][ticket]
+                yield state
+                atomic_write_json(self.path, state)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    
+    def acquire(self, priority=0, name=''):
+        """block until this process may upload; returns the ticket to release()"""
+        ticket = f'{os.getpid()}-{threading.get_ident()}-{time.time_ns()}'
+        start = time.monotonic()
+        announced = set()
+        while True:
+            with self.state() as state:
+                now = time.time()
+                waiting = state['queue']
+                entry = waiting.setdefault(ticket, {'pid': os.getpid(), 'priority': priority,
+                                                    'since': now, 'name': name})
+                entry['seen'] = now
+                order = sorted(waiting, key=lambda t: (-waiting[t]['priority'], waiting[t]['since']))
+                position = order.index(ticket) + 1
+                in_flight = len(state['in_flight'])
+                if now < state['backoff_until']:
+                    reason, wait = 'backing off after rate limiting', state['backoff_until'] - now
+                elif in_flight >= self.max_in_flight:
+                    reason, wait = f'{in_flight} uploads in flight', 2
+                elif state['tokens'] < 1:
+                    reason, wait = 'upload rate limit', (1 - state['tokens'])/self.rate
+                elif position > 1:
+                    reason, wait = 'queued behind other uploads', 0.5
+                else:
+                    state['tokens'] -= 1
+                    del waiting[ticket]
+                    state['in_flight'][ticket] = {'pid': os.getpid(), 'since': now, 'name': name}
+                    break
+            if reason not in announced:
+                print(f'waiting to upload {name} ({reason}): {position} of {len(waiting)} in the queue')
+                announced.add(reason)
+            logging.debug(f'notary queue position {position} of {len(waiting)}, {in_flight} in flight, '
+                          f'{state["tokens"]:.2f} tokens, next check in {min(wait, 2):.1f}s')
+            # short naps so a higher priority arrival or a released slot is noticed
+            sleep(random.uniform(0.8, 1.0)*min(max(wait, 0.1), 2))
+        
+        waited = time.monotonic() - start
+        logging.info(f'notary slot for {name} after waiting {waited:.1f} seconds; '
+                     f'queue depth {len(waiting)}, {in_flight + 1} in flight')
+        if waited >= 1:
+            print(f'uploading {name} after waiting {waited:.0f} seconds')
+        return ticket
+    
+    def release(self, ticket, result='ok'):
+        """end an upload; `result` is 'ok', 'failed' or 'limited'"""
+        with self.state() as state:
+            state['in_flight'].pop(ticket, None)
+            self.adjust(state, result)
+    
+    def report(self, result):
+        """feed the outcome of another notarytool call (info, log) into the back off"""
+        with self.state() as state:
+            self.adjust(state, result)
+    
+    def adjust(self, state, result):
+        if result == 'limited':
+            state['backoff'] = min(max(state['backoff']*2, self.backoff), self.max_backoff)
+            state['backoff_until'] = time.time() + random.uniform(0.75, 1.0)*state['backoff']
+            state['tokens'] = 0
+            logging.warning(f'notarytool was rate limited; uploads from this host pause for {state["backoff"]:.0f} seconds')
+        elif result == 'ok' and state['backoff']:
+            state['backoff'] = state['backoff']/2 if state['backoff'] > self.backoff else 0
+    
+    def backoff_remaining(self):
+        with self.state() as state:
+            return max(state['backoff_until'] - time.time(), 0)
+
+
+
+
+
+
+_notary_schedulers = {}
+_notary_schedulers_lock = threading.Lock()
+
+def get_notary_scheduler(config):
+    """the NotaryScheduler for `config` or None if [main] notary_scheduler is off"""
+    if not main_option(config, 'notary_scheduler', True):
+        return None
+    main_config = config.get('main', {})
+    path = os.path.expanduser(main_config.get('notary_scheduler_file', '~/.cache/pycodesign/notary-scheduler.json'))
+    with _notary_schedulers_lock:
+        if path not in _notary_schedulers:
+            _notary_schedulers[path] = NotaryScheduler(path,
+                rate=float(main_config.get('notary_rate', 10)),
+                burst=float(main_config.get('notary_burst', 3)),
+                max_in_flight=int(main_config.get('notary_max_in_flight', 3)),
+                backoff=float(main_config.get('notary_backoff', 30)),
+                max_backoff=float(main_config.get('notary_max_backoff', 900)))
+        return _notary_schedulers[path]
+
+
+
+
+
+
+def notarize_submit(config):
+    """upload the package without waiting; returns return code, stdout, stderr, submission id
+    
+    uploads wait for the host-wide NotaryScheduler; one turned away with 429 is 
+    queued again up to [main] notary_retries times"""
+    package_file = f'{config["package_details"]["package_name"]}.pkg'
+    final_list = notarytool_command(config, 'submit', package_file)
+    logging.debug('running command:')
+    logging.debug(shlex.join(final_list))    
+    
+    scheduler = get_notary_scheduler(config)
+    priority = float(config.get('main', {}).get('notary_priority', 0))
+    retries = int(config.get('main', {}).get('notary_retries', 3))
+    for attempt in range(retries + 1):
+        ticket = scheduler.acquire(priority, package_file) if scheduler else None
+        return_code, stdout, stderr = 1, b'', b''
+        stream = JSONStream()
+        try:
+            return_code, stdout, stderr = run_command(final_list, on_line=stream.on_line)
+        finally:
+            limited = rate_limited(return_code, stdout, stderr)
+            if scheduler:
+                scheduler.release(ticket, 'limited' if limited else 'ok' if return_code == 0 else 'failed')
+        
+        logging.debug(f'return code: {return_code}')
+        logging.debug(f'stdout: {stdout}')
+        logging.debug(f'stderr: {stderr}')           
+        if not (limited and scheduler) or attempt == retries:
+            break
+        print(f'upload of {package_file} was rate limited; queueing it again')
+
+    submission_id = NotarySubmission(stream.document()).id
+    if return_code == 0 and submission_id:
+        print(f'submitted {package_file}: submission id {submission_id}')
+        atomic_write_json(submission_file(config), {
+            'id': submission_id, 
+            'package': package_file, 
+            'submitted': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    elif return_code == 0:
+        return_code = 1
+        stderr += b'\nno submission id found in notarytool output'
+    return return_code, stdout, stderr, submission_id
+
+
+
+
+
+
+async def run_command_async(command_list, timeout=None, on_line=log_line, capture_lines=10000):
+    """asyncio version of run_command(); cancelling the task kills the command"""
+    argv = [str(a) for a in command_list]
+    command = Path(argv[0]).name
+    start = time.time()
+    cmd = await asyncio.create_subprocess_exec(*argv, stdin=asyncio.subprocess.DEVNULL,
+                                               stdout=asyncio.subprocess.PIPE,
+                                               stderr=asyncio.subprocess.PIPE,
+                                               limit=16*1024**2)
+    sizes = {}
+    
+    async def read(stream_name, stream):
+        captured = deque(maxlen=capture_lines)
+        sizes[stream_name] = 0
+        async for line in stream:
+            sizes[stream_name] += len(line)
+            captured.append(line)
+            if on_line:
+                on_line(command, stream_name, line)
+        return b''.join(captured)
+    
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            asyncio.gather(read('stdout', cmd.stdout), read('stderr', cmd.stderr)), timeout)
+        await cmd.wait()
+    except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+        cmd.kill()
+        await cmd.wait()
+        if isinstance(e, asyncio.CancelledError):
+            raise
+        stdout, stderr = b'', bytes(f'{command} timed out after {timeout} seconds\n', 'utf-8')
+    
+    # asyncio reaps the child itself, so there is no rusage of just this command; the
+    # RUSAGE_CHILDREN totals include every other command that finished meanwhile
+    record = record_command(argv, start, time.time() - start, None, cmd.returncode, b'', b'')
+    record['stdout_bytes'], record['stderr_bytes'] = sizes.get('stdout', 0), sizes.get('stderr', 0)
+    return cmd.returncode, stdout, stderr
+
+
+
+
+
+
+NOTARY_FINAL_STATES = ('Accepted', 'Invalid', 'Rejected')
+
+async def poll_notarization(config, submission_id):
+    """poll `notarytool info` until the submission reaches a final state
+    
+    the delay between checks starts at [main] notarize_timer seconds and doubles up 
+    to [main] notarize_max_interval, with jitter so many pollers do not line up.
+    Gives up after [main] notarize_timeout seconds. Returns (status, info)"""
+    main_config = config.get('main', {})
+    delay = float(main_config.get('notarize_timer', 30))
+    max_delay = float(main_config.get('notarize_max_interval', 300))
+    deadline = time.monotonic() + float(main_config.get('notarize_timeout', 3600))
+    final_list = notarytool_command(config, 'info', submission_id)
+    scheduler = get_notary_scheduler(config)
+    check = 0
+    
+    while True:
+        check += 1
+        stream = JSONStream()
+        return_code, stdout, stderr = await run_command_async(final_list, on_line=stream.on_line)
+        submission = NotarySubmission(stream.document())
+        info, status = submission.raw, submission.status
+        logging.debug(f'{submission_id} check {check}: return code {return_code}, info: {info}')
+        if return_code != 0:
+            logging.warning(f'could not check status of {submission_id}: {str(stderr, "utf-8").strip()}')
+        if status in NOTARY_FINAL_STATES:
+            return status, info
+        
+        sleep_timer = random.uniform(delay/2, delay)
+        if scheduler and rate_limited(return_code, stdout, stderr):
+            scheduler.report('limited')
+        if scheduler:
+            # status checks count against the same limits as uploads
+            sleep_timer = max(sleep_timer, scheduler.backoff_remaining())
+        if time.monotonic() + sleep_timer > deadline:
+            print(f'gave up waiting for {submission_id} after {check} checks')
+            return 'Timeout', info
+        print(f'{submission_id}: {status or "unknown"}; checking again in {sleep_timer:.0f} seconds')
+        await asyncio.sleep(sleep_timer)
+        delay = min(delay*2, max_delay)
+
+
+
+
+
+
+async def fetch_notary_log(config, submission_id):
+    """the NotaryLog of a submission; None if it could not be fetched"""
+    stream = JSONStream()
+    # the log can be large; it is parsed as it arrives rather than kept
+    return_code, stdout, stderr = await run_command_async(notarytool_command(config, 'log', submission_id),
+                                                          on_line=stream.on_line, capture_lines=100)
+    if return_code != 0:
+        logging.warning(f'could not fetch the notarization log of {submission_id}: {str(stderr, "utf-8").strip()}')
+        return None
+    return NotaryLog(stream.document())
+
+
+
+
+
+
+def issues_file(config):
+    return Path(f'{config["package_details"]["package_name"]}.issues.json')
+
+
+
+
+
+
+def notary_log_file(config):
+    return Path(f'{config["package_details"]["package_name"]}.notarization-log.json')
+
+
+
+
+
+
+def issue_source(issue_path, config):
+    """the local file a path in a notarization log refers to, or None
+    
+    log paths look like `name.pkg/Payload/usr/local/bin/tool`; the part after the
+    installation path starts with the name of an entry in file_list in the package"""
+    parts = Path(issue_path).parts
+    if 'Payload' in parts:
+        parts = parts[len(parts) - parts[::-1].index('Payload'):]
+    install = Path(config['package_details']['installation_path']).parts[1:]
+    if parts[:len(install)] == install:
+        parts = parts[len(install):]
+    if not parts:
+        return None
+    for file in config['package_details']['file_list']:
+        name = Path(staging_name(config, file)).parts
+        if parts[:len(name)] == name:
+            return str(Path(file).joinpath(*parts[len(name):]))
+    return None
+
+
+
+
+
+
+def record_notary_issues(config, submission_id, status, log):
+    """store the log of a submission and index its issues by file and issue code
+    
+    the index is written to <package_name>.issues.json; when the submission failed,
+    the files with errors are re-signed on the next run (see flagged_files())"""
+    atomic_write_json(notary_log_file(config), log.raw)
+    by_path = {}
+    by_code = {}
+    for issue in log.issues:
+        path = issue_source(issue.path, config) if issue.path else None
+        path = path or issue.path or '-'
+        by_path.setdefault(path, []).append({'severity': issue.severity, 'code': issue.code, 
+                                             'message': issue.message, 'architecture': issue.architecture,
+                                             'log_path': issue.path, 'doc_url': issue.doc_url})
+        # notarytool leaves out the code of most issues
+        paths = by_code.setdefault('unknown' if issue.code is None else str(issue.code), [])
+        if path not in paths:
+            paths.append(path)
+    atomic_write_json(issues_file(config), {
+        'submission_id': submission_id, 
+        'status': status, 
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'log': str(notary_log_file(config)),
+        'resigned': False,
+        'by_path': by_path, 
+        'by_code': by_code})
+    
+    print(f'notarization {status}: {len(log.issues)} issues in {len(by_path)} files; see {issues_file(config)}')
+    for path, issues in list(by_path.items())[:20]:
+        for issue in issues:
+            print(f'  {path}: {issue["severity"]}: {issue["message"]}')
+    if len(by_path) > 20:
+        print(f'  ... and {len(by_path) - 20} more files')
+
+
+
+
+
+
+def flagged_files(config):
+    """files with errors in the log of the last failed notarization that were not re-signed yet"""
+    if not main_option(config, 'resign_flagged', True) or config.get('main', {}).get('fresh'):
+        return []
+    try:
+        with open(issues_file(config)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if index.get('status') == 'Accepted' or index.get('resigned'):
+        return []
+    return [path for path, issues in index.get('by_path', {}).items()
+            if os.path.exists(path) and any(i['severity'] == 'error' for i in issues)]
+
+
+
+
+
+
+def mark_flagged_resigned(config):
+    try:
+        with open(issues_file(config)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return
+    index['resigned'] = True
+    atomic_write_json(issues_file(config), index)
+
+
+
+
+
+
+async def notarize_async(config, submission_id=None, on_submit=None, executor=None):
+    """asyncio version of notarize(); blocking steps run on `executor`"""
+    loop = asyncio.get_running_loop()
+    package_file = f'{config["package_details"]["package_name"]}.pkg'
+    ledger = get_notary_ledger(config)
+    pkg_hash = None
+    if ledger:
+        try:
+            pkg_hash = await loop.run_in_executor(executor, in_context(get_digest_cache(config).sha256), package_file)
+        except OSError as e:
+            logging.warning(f'could not hash {package_file} for the notarization ledger: {e}')
+    
+    if pkg_hash and not submission_id and not config.get('main', {}).get('fresh'):
+        previous = ledger.latest(pkg_hash)
+        if previous and previous['status'] == 'Accepted':
+            print(f'{package_file} was accepted in submission {previous["id"]} on {previous.get("completed")}; skipping upload')
+            return 0, bytes(json.dumps(previous.get('info', {}), indent=1), 'utf-8'), b''
+        if previous and previous['status'] not in NOTARY_FINAL_STATES:
+            submission_id = previous['id']
+            print(f'{package_file} is already being notarized in submission {submission_id}')
+    
+    stderr = b''
+    if not submission_id:
+        return_code, stdout, stderr, submission_id = await loop.run_in_executor(
+            executor, in_context(notarize_submit), config)
+        if return_code != 0:
+            return return_code, stdout, stderr
+        if pkg_hash:
+            ledger.submitted(submission_id, pkg_hash, config)
+        if on_submit:
+            on_submit(submission_id)
+    else:
+        print(f'waiting for existing submission {submission_id}')
+    
+    status, info = await poll_notarization(config, submission_id)
+    print(f'notarization status for {submission_id}: {status}')
+    log = None
+    if status in NOTARY_FINAL_STATES:
+        log = await fetch_notary_log(config, submission_id)
+        if log and (status != 'Accepted' or log.issues):
+            await loop.run_in_executor(executor, in_context(record_notary_issues), config, submission_id, status, log)
+        elif status == 'Accepted':
+            issues_file(config).unlink(missing_ok=True)
+    if pkg_hash:
+        values = {'status': status, 'info': info}
+        if status in NOTARY_FINAL_STATES:
+            values.update(completed=time.strftime('%Y-%m-%dT%H:%M:%S'), log=log.raw if log else {})
+        ledger.update(submission_id, sha256=pkg_hash, **values)
+    stdout = bytes(json.dumps(info, indent=1), 'utf-8')
+    return (0 if status == 'Accepted' else 1), stdout, stderr
+
+
+
+
+
+
+def notarize(config, submission_id=None, on_submit=None):
+    """submit the package and wait for the result
+    
+    pass `submission_id` to wait for an earlier submission instead of uploading again;
+    `on_submit(submission_id)` is called as soon as the upload is accepted. A package
+    whose exact bytes were accepted before (see NotaryLedger) is not uploaded again"""
+    return asyncio.run(notarize_async(config, submission_id, on_submit))
+
+
+
+
+
+
+def check_notarization(stdout, config):
+    """check the status of a submission from the json output of `notarytool submit`"""
+    submission_id = NotarySubmission(parse_json_output(stdout)).id
+    if not submission_id:
+        logging.debug('no submission id found')
+        return False
+    status, info = asyncio.run(poll_notarization(config, submission_id))
+    return status == 'Accepted'
+
+
+
+
+
+
+def staple(config):
+    args = {
+        'command': tool_command(config, 'xcrun') + ['stapler'],
+        'args': ['staple'],
+        'package': [f'{config["package_details"]["package_name"]}.pkg']
+    }
+    
+    final_list = [i for k, v in args.items() for i in v]
+    
+    logging.debug('running command:')
+    logging.debug(shlex.join(final_list))    
+
+    
+    return_code, stdout, stderr = run_command(final_list)
+
+    logging.debug(f'return code: {return_code}')
+    logging.debug(f'stdout: {stdout}')
+    logging.debug(f'stderr: {stderr}')
+
+    if return_code == 0:
+        # stapling changes the package; keep the manifest and build record digests in step
+        try:
+            update_manifest_package(config)
+        except OSError as e:
+            logging.warning(f'could not update the package manifest: {e}')
+    
+    return return_code, stdout, stderr
+
+
+
+
+
+
+def process_return(return_value, stdout, stderr):
+    def byte_print(byte_str):
+        if isinstance(byte_str, bytes):
+            for line in str(byte_str, 'utf-8').splitlines():
+                print(line)
+        else:
+            print(byte_str)
+            
+
+    if len(stdout) > 0:
+        print('OUTPUT: ')
+        byte_print(stdout)
+    if len(stderr) > 0:
+        print('ERRORS:')
+        byte_print(stderr)
+        
+    if return_value > 0:
+        retval = False
+        print('failed\n\n')
+    else:
+        retval = True
+        print('success\n\n')
+
+    return retval
+    
+
+
+
+
+
+
+ARTIFACT_SUFFIXES = ('.pkg', '.dmg', '.app')
+VERIFY_CHECKS = ('staple', 'validate', 'assess', 'signature')
+# stapler and spctl talk to Apple; failures with these in their output are worth retrying
+TRANSIENT_ERRORS = ('timed out', 'network', 'connection', 'temporarily', 'try again', 
+                    'cloudkit', 'could not reach', 'service unavailable')
+
+def artifact_checks(config, path, staple=True):
+    """[(check, argv)] that staple and verify the .pkg, .dmg or .app at `path`"""
+    xcrun = tool_command(config, 'xcrun')
+    spctl = tool_command(config, 'spctl')
+    path = str(path)
+    checks = [('validate', xcrun + ['stapler', 'validate', path])]
+    if staple:
+        checks.insert(0, ('staple', xcrun + ['stapler', 'staple', path]))
+    suffix = Path(path).suffix.lower()
+    if suffix == '.pkg':
+        checks += [('assess', spctl + ['--assess', '--type', 'install', '-vv', path]),
+                   ('signature', tool_command(config, 'pkgutil') + ['--check-signature', path])]
+    elif suffix == '.app':
+        checks += [('assess', spctl + ['--assess', '--type', 'execute', '-vv', path]),
+                   ('signature', tool_command(config, 'codesign') + ['--verify', '--deep', '--strict', '-vv', path])]
+    elif suffix == '.dmg':
+        checks += [('assess', spctl + ['--assess', '--type', 'open', '--context', 'context:primary-signature', '-vv', path]),
+                   ('signature', tool_command(config, 'codesign') + ['--verify', '-vv', path])]
+    return checks
+
+
+
+
+
+
+def run_check(command, retries=2, retry_delay=5, timeout=None):
+    """run one staple or verification command, retrying transient failures
+    
+    returns (return code, output, attempts)"""
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return_code, stdout, stderr = run_command(command, timeout=timeout)
+        except OSError as e:
+            return 127, str(e), attempt
+        output = str(stdout + stderr, 'utf-8', 'replace')
+        # a negative return code means the command timed out or was killed
+        transient = return_code < 0 or any(t in output.lower() for t in TRANSIENT_ERRORS)
+        if return_code == 0 or not transient or attempt > retries:
+            return return_code, output, attempt
+        delay = random.uniform(retry_delay/2, retry_delay) * 2**(attempt - 1)
+        logging.info(f'{Path(command[0]).name} failed with a transient error; retrying in {delay:.0f} seconds')
+        sleep(delay)
+
+
+
+
+
+
+def staple_verify_artifact(path, config=None, staple=True, retries=2, retry_delay=5, timeout=300):
+    """staple and verify one artifact; later checks are skipped once one fails"""
+    result = {'artifact': str(path), 'checks': {}, 'attempts': 0, 'ok': True, 'message': ''}
+    for check, command in artifact_checks(config or {}, path, staple):
+        if not result['ok']:
+            result['checks'][check] = 'skipped'
+            continue
+        logging.debug(f'running command: {shlex.join(command)}')
+        return_code, output, attempts = run_check(command, retries, retry_delay, timeout)
+        result['attempts'] += attempts
+        result['checks'][check] = 'ok' if return_code == 0 else 'failed'
+        if return_code != 0:
+            result['ok'] = False
+            lines = output.strip().splitlines()
+            result['message'] = f'{check}: {lines[-1] if lines else f"exit status {return_code}"}'
+        elif check == 'staple' and config:
+            try:
+                update_manifest_package(config)
+            except OSError as e:
+                logging.warning(f'could not update the package manifest: {e}')
+    return result
+
+
+
+
+
+
+def staple_verify(artifacts, jobs=4, staple=True, retries=2, retry_delay=5, timeout=300):
+    """staple and verify many artifacts on a pool of `jobs` workers
+    
+    `artifacts` is a list of paths or (path, config) pairs; returns results in the same order"""
+    artifacts = [a if isinstance(a, tuple) else (a, None) for a in artifacts]
+    results = [None] * len(artifacts)
+    with futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        submitted = {executor.submit(in_context(staple_verify_artifact), path, config, staple, 
+                                     retries, retry_delay, timeout): i
+                     for i, (path, config) in enumerate(artifacts)}
+        for future in futures.as_completed(submitted):
+            i = submitted[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                results[i] = {'artifact': str(artifacts[i][0]), 'checks': {}, 'attempts': 0, 
+                              'ok': False, 'message': str(e)}
+            print(f'{"ok" if results[i]["ok"] else "FAILED"}: {results[i]["artifact"]}')
+    return results
+
+
+
+
+
+
+def format_verify_results(results):
+    header = ['artifact'] + list(VERIFY_CHECKS) + ['attempts', 'result']
+    rows = [[r['artifact']] + [r['checks'].get(c, '-') for c in VERIFY_CHECKS] + 
+            [str(r['attempts']), 'pass' if r['ok'] else f'FAIL {r["message"]}'] for r in results]
+    widths = [max(len(r[i]) for r in [header] + rows) for i in range(len(header))]
+    lines = ['  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip() for row in [header] + rows]
+    lines.insert(1, '  '.join('-'*w for w in widths[:-1] + [len('result')]))
+    passed = sum(r['ok'] for r in results)
+    lines.append(f'\n{passed} of {len(results)} artifacts passed')
+    return '\n'.join(lines)
+
+
+
+
+
+
+def find_artifacts(paths):
+    """expand directories, glob patterns and configuration files into artifact paths
+    
+    directories are searched for .pkg, .dmg and .app without looking inside the .app
+    bundles; a .ini file stands for the package it builds. Returns (path, config) pairs"""
+    artifacts = []
+    for pattern in paths:
+        for path in (sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]):
+            if path.endswith('.ini'):
+                config = get_config(argparse.Namespace(config=path))
+                if config.get('package_details', {}).get('package_name'):
+                    artifacts.append((f'{config["package_details"]["package_name"]}.pkg', config))
+            elif os.path.isdir(path) and not path.rstrip('/').lower().endswith('.app'):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(files) + [d for d in dirs if d.lower().endswith('.app')]:
+                        if name.lower().endswith(ARTIFACT_SUFFIXES):
+                            artifacts.append((os.path.join(root, name), None))
+                    dirs[:] = [d for d in dirs if not d.lower().endswith('.app')]
+            else:
+                artifacts.append((path, None))
+    return artifacts
+
+
+
+
+
+
+## Testing code
+#sys.argv = sys.argv[:1]
+
+# sys.argv.extend(['-O', '9.9.9'])
+# sys.argv.append('insert_files_codesign.ini')
+
+
+# expected_config_keys = {
+#         'identification': {
+#             'application_id': 'Unique Substring of Developer ID Application Cert',
+#             'installer_id': 'Unique Substring of Developer ID Installer Cert',
+#             'apple_id': 'developer@domain.com',
+#             'password': '@keychain:App-Specific-Password-Name-In-Keychain',
+#         },
+#         'package_details': {
+#             'package_name': 'nameofpackage',
+#             'bundle_id': 'com.developer.packagename',
+#             'file_list': "include_file1, include_file2",
+#             'installation_path': '/Applications/',
+#             'entitlements': 'None',
+#             'version': '0.0.0'
+#         }
+#     }
+
+# logging.root.setLevel("DEBUG")
+# args = get_args()
+# config = get_config(args=args, default_config=expected_config_keys)
+
+# config.update({'main': {
+#         'notarize_timer': args.notarize_timer,
+#         'notrarize_max_check': args.num_checks,
+#         'new_config': args.new_config}
+#                   })
+
+# if args.pkg_version:
+#     config['package_details']['version'] = args.pkg_version
+
+# validate_config(config, expected_config_keys)
+
+
+
+
+
+
+def path_sha256(path, file_hash=file_sha256):
+    """SHA-256 of a file, or of the relative names, contents and links in a directory tree"""
+    if not os.path.isdir(path) or os.path.islink(path):
+        return file_hash(path)
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files + [d for d in dirs if os.path.islink(os.path.join(root, d))]):
+            full = os.path.join(root, name)
+            rel = os.path.relpath(full, path)
+            if os.path.islink(full):
+                digest.update(f'L {rel} {os.readlink(full)}\n'.encode())
+            else:
+                digest.update(f'F {rel} {file_hash(full)}\n'.encode())
+    return digest.hexdigest()
+
+
+
+
+
+
+def state_file(config_file):
+    config_file = Path(config_file)
+    return config_file.with_name(f'{config_file.stem}.state.json')
+
+
+
+
+
+
+class StateJournal:
+    """record of the inputs, outputs and result of each stage for one configuration
+    
+    a stage is complete when it succeeded and its recorded inputs still match the
+    outputs of the stage before it and the files on disk. A rerun resumes at the 
+    first stage that is not complete."""
+    
+    stages = ('sign', 'package', 'notarize', 'staple')
+    
+    def __init__(self, path, config):
+        self.path = Path(path)
+        self.config = config
+        self.pending = {}
+        # hashes of the files on disk; cleared whenever the files may have changed
+        self.snapshot = {}
+        try:
+            with open(self.path) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+        self.state.setdefault('stages', {})
+    
+    def package_file(self):
+        return f'{self.config["package_details"]["package_name"]}.pkg'
+    
+    def files(self):
+        if 'files' not in self.snapshot:
+            hashes = {}
+            for file in self.config['package_details']['file_list']:
+                try:
+                    hashes[file] = path_sha256(file, get_digest_cache(self.config).sha256)
+                except OSError:
+                    hashes[file] = None
+            self.snapshot['files'] = hashes
+        return self.snapshot['files']
+    
+    def pkg(self):
+        if 'pkg' not in self.snapshot:
+            try:
+                self.snapshot['pkg'] = get_digest_cache(self.config).sha256(self.package_file())
+            except OSError:
+                self.snapshot['pkg'] = None
+        return self.snapshot['pkg']
+    
+    def params(self):
+        details = self.config['package_details']
+        return {'bundle_id': details['bundle_id'], 
+                'version': details['version'],
+                'installation_path': details['installation_path'],
+                'installer_id': self.config['identification']['installer_id']}
+    
+    def inputs(self, stage):
+        if stage == 'sign':
+            return {'files': self.files()}
+        if stage == 'package':
+            return {'files': self.files(), 'params': self.params()}
+        return {'pkg': self.pkg()}
+    
+    def outputs(self, stage):
+        if stage == 'sign':
+            return {'files': self.files()}
+        return {'pkg': self.pkg()}
+    
+    def entry(self, stage):
+        return self.state['stages'].get(stage, {})
+    
+    def complete(self, stage):
+        """true if `stage` and every stage before it are complete"""
+        entry = self.entry(stage)
+        if entry.get('result') != 'ok':
+            return False
+        
+        sign = self.entry('sign')
+        package = self.entry('package')
+        if stage == 'sign':
+            return sign['outputs'] == {'files': self.files()}
+        if not self.complete('sign'):
+            return False
+        
+        built = package.get('outputs', {}).get('pkg')
+        if stage == 'package':
+            staple = self.entry('staple')
+            stapled = staple.get('outputs', {}).get('pkg') if staple.get('inputs', {}).get('pkg') == built else None
+            return (package['inputs'] == {'files': sign['outputs']['files'], 'params': self.params()}
+                    and self.pkg() in (built, stapled))
+        if not self.complete('package'):
+            return False
+        
+        if stage == 'notarize':
+            return entry['inputs'] == {'pkg': built}
+        return (self.complete('notarize') and entry['inputs'] == {'pkg': built}
+                and entry['outputs'] == {'pkg': self.pkg()})
+    
+    def resume_stage(self):
+        """the first stage that needs to run, or None if every stage is complete"""
+        self.snapshot = {}
+        if flagged_files(self.config):
+            # the last notarization flagged files that still have to be re-signed
+            return 'sign'
+        for stage in self.stages:
+            if not self.complete(stage):
+                return stage
+        return None
+    
+    def pending_submission(self):
+        """submission id of an upload of the current package that was never resolved"""
+        entry = self.entry('notarize')
+        self.snapshot = {}
+        if entry.get('result') == 'submitted' and entry.get('inputs') == {'pkg': self.pkg()}:
+            return entry.get('submission_id')
+        return None
+    
+    def start(self, stage):
+        self.snapshot = {}
+        self.pending[stage] = self.inputs(stage)
+    
+    def submitted(self, submission_id):
+        self.state['stages']['notarize'] = {
+            'inputs': self.pending.get('notarize') or self.inputs('notarize'),
+            'result': 'submitted',
+            'submission_id': submission_id,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        self.save()
+    
+    def record(self, stage, return_code):
+        self.snapshot = {}
+        entry = {'inputs': self.pending.pop(stage, None) or self.inputs(stage),
+                 'result': 'ok' if return_code == 0 else 'failed',
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        if return_code == 0:
+            entry['outputs'] = self.outputs(stage)
+        previous = self.entry(stage)
+        if stage == 'notarize' and previous.get('submission_id'):
+            entry['submission_id'] = previous['submission_id']
+            if return_code != 0 and previous.get('result') == 'submitted':
+                # the submission may still be accepted; poll it again on the next run
+                entry['result'] = 'submitted'
+        self.state['stages'][stage] = entry
+        self.save()
+    
+    def save(self):
+        atomic_write_json(self.path, self.state)
+        get_digest_cache(self.config).save()
+
+
+
+
+
+
+def run_resumable(config, journal):
+    """run every stage that is not complete according to `journal`"""
+    resume = journal.resume_stage()
+    if resume is None:
+        print(f'every stage is complete according to {journal.path}; use --fresh to run again')
+        return 0
+    if resume != 'sign':
+        print(f'resuming at the {resume} stage using {journal.path}')
+    
+    messages = {'sign': 'signing...', 'package': 'packaging...', 'notarize': 'notarizing...', 'staple': 'stapling...'}
+    for stage in StateJournal.stages[StateJournal.stages.index(resume):]:
+        print(messages[stage])
+        journal.start(stage)
+        with stage_span(stage, config['package_details']['package_name']):
+            if stage == 'sign':
+                r, o, e = sign(config)
+            elif stage == 'package':
+                r, o, e = package(config)
+            elif stage == 'notarize':
+                r, o, e = notarize(config, journal.pending_submission(), on_submit=journal.submitted)
+            else:
+                r, o, e = staple(config)
+        journal.record(stage, r)
+        process_return(r, o, e)
+        if r != 0:
+            if stage == 'notarize':
+                print('notariztion process did not complete or was inconclusive')
+                if flagged_files(config):
+                    print(f'run again to re-sign the files listed in {issues_file(config)}')
+                else:
+                    print(f'check manually with: ')
+                    print(f'xcrun notarytool history --keychain-profile {config["identification"]["keychain-profile"]}')
+            return r
+    return 0
+
+
+
+
+
+
+EXPECTED_CONFIG_KEYS = {
+    'identification': {
+        'application_id': 'Unique Substring of Developer ID Application Cert',
+        'installer_id': 'Unique Substring of Developer ID Installer Cert',
+        'keychain-profile': 'Name-of-stored-keychain-profile'
+    },
+    'package_details': {
+        'package_name': 'nameofpackage',
+        'bundle_id': 'com.developer.packagename',
+        'file_list': "include_file1, include_file2",
+        'installation_path': '/Applications/',
+        'entitlements': 'None',
+        'version': '0.0.0'
+    }
+}
+
+# written by -N after EXPECTED_CONFIG_KEYS; the README lists every [main] option
+SAMPLE_MAIN_SECTION = '''[main]
+# optional; command line options override these values
+# reuse signed copies of files that have not changed since they were last signed:
+# matching files are replaced with the copy kept in cache_dir without running
+# codesign. Off unless set to yes; --no-cache turns it off for one run
+cache = no
+cache_dir = ~/.cache/pycodesign/sign
+# notarytool uploads from every pycodesign process on this host take turns through
+# one rate limited queue kept in notary_scheduler_file; no uploads right away
+notary_scheduler = yes
+notary_scheduler_file = ~/.cache/pycodesign/notary-scheduler.json
+'''
+
+
+
+
+
+
+def apply_args(config, args):
+    """override values in `config` with options given on the command line"""
+    if args.pkg_version:
+        config['package_details']['version'] = args.pkg_version
+    
+    config.setdefault('main', {})
+    if args.jobs:
+        config['main']['jobs'] = args.jobs
+    if args.pool:
+        config['main']['pool'] = args.pool
+    if args.inside_out:
+        config['main']['inside_out'] = 'yes'
+    if args.no_cache:
+        config['main']['cache'] = 'no'
+    if args.fresh:
+        config['main']['fresh'] = True
+    return config
+
+
+
+
+
+
+class TreeIndex:
+    """directory listings keyed by path and modification time so unchanged directories are not read again
+    
+    a directory's mtime changes whenever an entry is added, removed or renamed in it,
+    so a cached listing is reused for as long as the mtime is the same"""
+    
+    # listings of directories changed this recently are not kept: on filesystems with
+    # coarse timestamps (1 s on HFS+, 2 s on FAT) a later change can leave the mtime as it was
+    recent_ns = 2*10**9
+    
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.run_stats = {'hits': 0, 'misses': 0}
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)['entries']
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+    
+    def listing(self, directory):
+        """{'dirs', 'files', 'links'} names in `directory`; symlinks are never followed"""
+        directory = os.path.abspath(directory)
+        mtime = os.lstat(directory).st_mtime_ns
+        with self.lock:
+            entry = self.entries.get(directory)
+            if entry and entry['mtime'] == mtime:
+                self.run_stats['hits'] += 1
+                return entry
+            self.run_stats['misses'] += 1
+        
+        listed = time.time_ns()
+        entry = {'mtime': mtime, 'dirs': [], 'files': [], 'links': []}
+        with os.scandir(directory) as scan:
+            for child in scan:
+                if child.is_symlink():
+                    entry['links'].append(child.name)
+                elif child.is_dir():
+                    entry['dirs'].append(child.name)
+                else:
+                    entry['files'].append(child.name)
+        # a directory that changed while it was read is listed again next time
+        if os.lstat(directory).st_mtime_ns == mtime and mtime < listed - self.recent_ns:
+            with self.lock:
+                self.entries[directory] = entry
+                self.dirty = True
+        return entry
+    
+    def walk(self, root, jobs=None):
+        """every path below `root` as {path: 'dir', 'file' or 'link'}; directories are listed in parallel"""
+        found = {}
+        with futures.ThreadPoolExecutor(max_workers=jobs or min(32, os.cpu_count() + 4)) as executor:
+            pending = {executor.submit(self.listing, root): root}
+            while pending:
+                done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    directory = pending.pop(future)
+                    try:
+                        entry = future.result()
+                    except OSError as e:
+                        logging.warning(f'could not scan {directory}: {e}')
+                        continue
+                    for kind in ('dirs', 'files', 'links'):
+                        for name in entry[kind]:
+                            found[os.path.join(directory, name)] = kind[:-1]
+                    for name in entry['dirs']:
+                        path = os.path.join(directory, name)
+                        pending[executor.submit(self.listing, path)] = path
+        return found
+    
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            self.entries = {p: e for p, e in self.entries.items() if os.path.isdir(p)}
+            atomic_write_json(self.path, {'entries': self.entries})
+            self.dirty = False
+
+
+
+
+
+
+_tree_indexes = {}
+_tree_indexes_lock = threading.Lock()
+
+def get_tree_index(config):
+    """the TreeIndex for `config`; shared by every package that uses the same index file"""
+    path = os.path.expanduser(config.get('main', {}).get('tree_index', '~/.cache/pycodesign/tree-index.json'))
+    with _tree_indexes_lock:
+        if path not in _tree_indexes:
+            _tree_indexes[path] = TreeIndex(path)
+        return _tree_indexes[path]
+
+
+
+
+
+
+GLOB_CHARS = re.compile(r'[*?[]')
+
+def is_pattern(entry):
+    return entry.startswith('!') or bool(GLOB_CHARS.search(entry))
+
+
+
+
+
+
+def glob_regex(pattern):
+    """compile a file_list glob; `*`, `?` and `[...]` stay within a path component, `**/` spans any number"""
+    parts = []
+    components = pattern.split('/')
+    for number, component in enumerate(components):
+        last = number == len(components) - 1
+        if component == '**':
+            parts.append('.*' if last else '(?:[^/]+/)*')
+            continue
+        i, regex = 0, ''
+        while i < len(component):
+            c = component[i]
+            if c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            elif c == '[' and component.find(']', i + 2) > 0:
+                end = component.find(']', i + 2)
+                body = component[i + 1:end].replace('\\', '\\\\')
+                regex += '[' + ('^' + body[1:] if body.startswith('!') else body) + ']'
+                i = end
+            else:
+                regex += re.escape(c)
+            i += 1
+        parts.append(regex if last else regex + '/')
+    return re.compile(''.join(parts) + r'\Z')
+
+
+
+
+
+
+def glob_base(pattern):
+    """the directory part of `pattern` before the first component with a wildcard, and the rest"""
+    components = pattern.split('/')
+    for number, component in enumerate(components):
+        if GLOB_CHARS.search(component):
+            return '/'.join(components[:number]) or ('/' if pattern.startswith('/') else '.'), '/'.join(components[number:])
+    return pattern, ''
+
+
+
+
+
+
+def expand_file_list(entries, index, jobs=None):
+    """expand the globs and `!exclude` patterns in the `file_list` entries
+    
+    paths without wildcards are used as they are. Glob matches keep their path
+    relative to the part of the pattern before the first wildcard as their name in
+    the package. Patterns starting with ! remove matching paths; without a / they
+    match names anywhere, including inside listed directories, which are then
+    listed entry by entry. Returns (paths, {path: name in the package})"""
+    includes = [e for e in entries if not e.startswith('!')]
+    excludes = []
+    for entry in entries:
+        if entry.startswith('!'):
+            pattern = os.path.normpath(entry[1:])
+            # patterns with a / match whole paths, the others match names
+            excludes.append((glob_regex(pattern), os.path.isabs(pattern), '/' in pattern))
+    
+    def excluded(path):
+        path = os.path.normpath(path)
+        for regex, absolute, full in excludes:
+            if regex.match(os.path.abspath(path) if absolute else path if full else os.path.basename(path)):
+                return True
+        return False
+    
+    candidates = []
+    for entry in includes:
+        entry = entry.rstrip('/') or entry
+        if not GLOB_CHARS.search(entry):
+            candidates.append((entry, Path(entry).name))
+            continue
+        base, rest = glob_base(entry)
+        if not os.path.isdir(base):
+            logging.warning(f'no files match {entry}: {base} is not a directory')
+            continue
+        regex = glob_regex(rest)
+        matches = sorted(p for p in index.walk(base, jobs) if regex.match(os.path.relpath(p, base)))
+        # a directory that matches takes everything in it along
+        top = []
+        for path in matches:
+            if not top or not path.startswith(top[-1] + os.sep):
+                top.append(path)
+        if not top:
+            logging.warning(f'no files match {entry}')
+        candidates.extend((path, os.path.relpath(path, base)) for path in top)
+    
+    names = {}
+    
+    def add(path, name, split=None):
+        if excluded(path):
+            return
+        if split is None and excludes and os.path.isdir(path) and not os.path.islink(path):
+            # the directories that hold excluded paths are listed entry by entry
+            split = set()
+            for inside in index.walk(path, jobs):
+                parent = os.path.dirname(inside)
+                while excluded(inside) and parent not in split:
+                    split.add(parent)
+                    if parent == path:
+                        break
+                    parent = os.path.dirname(parent)
+        if split and path in split:
+            if is_bundle(path):
+                logging.warning(f'{path} is signed as a bundle; ignoring the excluded paths inside it')
+            else:
+                listing = index.listing(path)
+                for child in sorted(listing['dirs'] + listing['files'] + listing['links']):
+                    add(os.path.join(path, child), f'{name}/{child}', split)
+                return
+        names.setdefault(path, name)
+    
+    for path, name in candidates:
+        add(path, name)
+    
+    def inside_another(path):
+        parent = os.path.dirname(path)
+        while parent and parent != os.path.dirname(parent):
+            if parent in names:
+                return True
+            parent = os.path.dirname(parent)
+        return False
+    
+    # paths that are already in the package along with a directory are not listed again
+    names = {path: name for path, name in names.items() if not inside_another(path)}
+    return list(names), names
+
+
+
+
+
+
+def staging_name(config, file):
+    """where `file` goes below the installation path"""
+    return config['package_details'].get('staging_names', {}).get(file) or Path(file).resolve().name
+
+
+
+
+
+
+def split_file_list(config):
+    # split the file list into an actual list; entries are separated by commas or new lines
+    # globs and !excludes are expanded with the cached tree index
+    try:
+        entries = [f.strip() for f in re.split(r'[,\n]', config['package_details']['file_list']) if f.strip()]
+    except (KeyError, TypeError):
+        entries = None
+    if entries and any(is_pattern(e) for e in entries):
+        index = get_tree_index(config)
+        file_list, names = expand_file_list(entries, index, get_jobs(config))
+        index.save()
+        logging.debug(f'tree index: {index.run_stats["hits"]} directories unchanged, '
+                      f'{index.run_stats["misses"]} listed')
+        print(f'file_list: {len(entries)} entries expanded to {len(file_list)} paths')
+        config['package_details']['file_list'] = file_list
+        config['package_details']['staging_names'] = names
+    elif entries is not None:
+        config['package_details']['file_list'] = entries
+    
+    # [arch.<name>] sections hold per-architecture slices that are merged into 
+    # universal binaries; the merged binaries are added to the file list
+    arch_file_lists = {}
+    for section, values in config.items():
+        if section.startswith('arch.') and values.get('file_list'):
+            arch_file_lists[section[5:]] = [f.strip() for f in values['file_list'].split(',') if f.strip()]
+    if arch_file_lists and 'package_details' in config:
+        config['package_details']['arch_file_lists'] = arch_file_lists
+        file_list = [f for f in config['package_details'].get('file_list', []) if f.strip()]
+        for name in group_slices(arch_file_lists):
+            merged = str(universal_dir(config)/name)
+            if merged not in file_list:
+                file_list.append(merged)
+        config['package_details']['file_list'] = file_list
+    return config
+
+
+
+
+
+
+def load_config(file, args):
+    """read, override and validate a single configuration file; returns {} if it is not usable"""
+    if not os.path.isfile(file):
+        print(f'configuration file not found: {file}')
+        return {}
+    parser = configparser.ConfigParser()
+    parser.read(file)
+    config = {s:dict(parser.items(s)) for s in parser.sections()}
+    if validate_config(config, EXPECTED_CONFIG_KEYS):
+        print(f'skipping invalid configuration file: {file}')
+        return {}
+    apply_args(config, args)
+    split_file_list(config)
+    config['main']['config_file'] = file
+    return config
+
+
+
+
+
+
+BATCH_STAGES = ('sign', 'package', 'notarize', 'staple')
+
+async def run_batch_stage(stage, config, executor, journal=None):
+    """run one stage of one package; blocking stages run on `executor`"""
+    loop = asyncio.get_running_loop()
+    if stage == 'sign':
+        return await loop.run_in_executor(executor, in_context(sign), config)
+    if stage == 'package':
+        return await loop.run_in_executor(executor, in_context(package), config)
+    if stage == 'staple':
+        return await loop.run_in_executor(executor, in_context(staple), config)
+    
+    submission_id = journal.pending_submission() if journal else None
+    return await notarize_async(config, submission_id, journal.submitted if journal else None, executor)
+
+
+
+
+
+
+async def run_batch_package(config, stages, limits, executor, on_event=None):
+    """run the stages of one package in order; each stage waits for a slot in its limit
+    
+    `on_event` is called with a dict whenever a stage starts or finishes"""
+    name = config['package_details']['package_name']
+    result = {'name': name, 'config': config['main']['config_file'], 'stages': {}}
+    halt = False
+    
+    journal = None
+    done = ()
+    if tuple(stages) == BATCH_STAGES and not config['main'].get('fresh'):
+        journal = StateJournal(state_file(config['main']['config_file']), config)
+        resume = journal.resume_stage()
+        done = BATCH_STAGES[:BATCH_STAGES.index(resume)] if resume else BATCH_STAGES
+    
+    for stage in BATCH_STAGES:
+        if stage not in stages:
+            continue
+        if stage in done:
+            result['stages'][stage] = {'status': 'done', 'seconds': 0}
+            continue
+        if halt:
+            result['stages'][stage] = {'status': 'skipped', 'seconds': 0}
+            continue
+        async with limits[stage]:
+            print(f'{name}: {stage} started')
+            if on_event:
+                on_event({'event': 'stage', 'package': name, 'stage': stage, 'status': 'started'})
+            start = time.monotonic()
+            try:
+                if journal:
+                    journal.start(stage)
+                with stage_span(stage, name):
+                    r, o, e = await run_batch_stage(stage, config, executor, journal)
+                if journal:
+                    journal.record(stage, r)
+            except Exception as e:
+                logging.exception(f'{name}: {stage} raised an exception')
+                r, o, e = 1, b'', bytes(str(e), 'utf-8')
+            seconds = time.monotonic() - start
+        status = 'ok' if r == 0 else 'failed'
+        print(f'{name}: {stage} {status} in {seconds:.1f} seconds')
+        if r != 0:
+            process_return(r, o, e)
+            halt = True
+        result['stages'][stage] = {'status': status, 'seconds': seconds}
+        if on_event:
+            on_event({'event': 'stage', 'package': name, 'stage': stage, 'status': status, 'seconds': seconds})
+    return result
+
+
+
+
+
+
+async def run_batch(configs, stages=BATCH_STAGES, concurrency=None):
+    """pipeline the stages of many packages; while one package waits for notarization,
+    others are being packaged and signed. `concurrency` limits each stage: {stage: n}"""
+    concurrency = {'sign': 1, 'package': 2, 'notarize': 10, 'staple': 4, **(concurrency or {})}
+    limits = {stage: asyncio.Semaphore(max(1, concurrency[stage])) for stage in BATCH_STAGES}
+    workers = sum(concurrency[s] for s in BATCH_STAGES if s != 'notarize') + concurrency['notarize']
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return await asyncio.gather(*[run_batch_package(c, stages, limits, executor) for c in configs])
+
+
+
+
+
+
+def format_batch_summary(results, stages=BATCH_STAGES):
+    header = ['package'] + [s for s in BATCH_STAGES if s in stages] + ['total']
+    rows = []
+    for result in results:
+        row = [result['name']]
+        total = 0
+        for stage in header[1:-1]:
+            info = result['stages'].get(stage, {'status': '-', 'seconds': 0})
+            total += info['seconds']
+            row.append(f'{info["status"]} {info["seconds"]:.1f}s' if info['status'] in ('ok', 'failed') else info['status'])
+        row.append(f'{total:.1f}s')
+        rows.append(row)
+    widths = [max(len(r[i]) for r in [header] + rows) for i in range(len(header))]
+    lines = ['  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip() for row in [header] + rows]
+    lines.insert(1, '  '.join('-'*w for w in widths))
+    return '\n'.join(lines)
+
+
+
+
+
+
+def get_batch_args(argv):
+    parser = argparse.ArgumentParser(prog='pycodesign.py batch',
+                                     description='PyCodeSign -- process many configuration files with pipelined stages')
+    parser.add_argument('-v', '--verbose', action='count', default=1)
+    parser.add_argument('configs', nargs='+', metavar='<PYCODESIGN_CONFIG.INI>',
+                        help='configuration files or glob patterns such as "configs/*.ini"')
+    parser.add_argument('--stages', type=str, default=','.join(BATCH_STAGES),
+                        help=f'comma separated stages to run (default: {",".join(BATCH_STAGES)})')
+    for stage, default in (('sign', 1), ('package', 2), ('notarize', 10), ('staple', 4)):
+        parser.add_argument(f'--{stage}-jobs', dest=f'{stage}_jobs', type=int, default=default,
+                            metavar='<INTEGER>',
+                            help=f'number of packages in the {stage} stage at once (default: {default})')
+    parser.add_argument('--verify', action='store_true', default=False,
+                        help='validate the stapled tickets and check the signatures of the finished packages in parallel')
+    add_run_args(parser)
+    return parser.parse_args(argv)
+
+
+
+
+
+
+def batch_main(argv):
+    args = get_batch_args(argv)
+    verbose = 50 - (args.verbose*10)
+    logging.root.setLevel(max(verbose, 10))
+    
+    files = []
+    for pattern in args.configs:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        files.extend(f for f in matches if f not in files)
+    configs = [c for c in (load_config(f, args) for f in files) if c]
+    if not configs:
+        print('no usable configuration files provided')
+        return []
+    
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = [s for s in stages if s not in BATCH_STAGES]
+    if unknown:
+        print(f'unknown stages: {", ".join(unknown)}')
+        return []
+    
+    concurrency = {s: getattr(args, f'{s}_jobs') for s in BATCH_STAGES}
+    start = time.monotonic()
+    results = asyncio.run(run_batch(configs, stages, concurrency))
+    print()
+    print(format_batch_summary(results, stages))
+    print(f'\nprocessed {len(results)} packages in {time.monotonic() - start:.1f} seconds')
+    
+    if args.verify:
+        configs = {c['main']['config_file']: c for c in configs}
+        finished = [(f'{r["name"]}.pkg', configs[r['config']]) for r in results 
+                    if r['stages'] and all(s['status'] in ('ok', 'done') for s in r['stages'].values())]
+        if finished:
+            print(f'\nverifying {len(finished)} packages')
+            verified = staple_verify(finished, concurrency['staple'], staple='staple' not in stages)
+            print()
+            print(format_verify_results(verified))
+    write_run_reports(args)
+    return results
+
+
+
+
+
+
+DEFAULT_SOCKET = '~/.cache/pycodesign/serve.sock'
+
+_progress_sink = contextvars.ContextVar('progress_sink', default=None)
+
+class ProgressWriter:
+    """stand-in for sys.stdout that sends output to the client of the current job, if any"""
+    def __init__(self, stream):
+        self.stream = stream
+    
+    def write(self, text):
+        sink = _progress_sink.get()
+        if sink:
+            sink(text)
+            return len(text)
+        return self.stream.write(text)
+    
+    def flush(self):
+        self.stream.flush()
+    
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+
+
+
+
+def stage_identity(stage, config):
+    """the credential a stage uses; the daemon limits concurrency per stage and identity"""
+    if stage == 'sign':
+        return config['identification']['application_id']
+    if stage == 'package':
+        return config['identification']['installer_id']
+    return config['identification']['keychain-profile']
+
+
+
+
+
+
+def job_args(options):
+    """run options sent by a client, on top of the command line defaults"""
+    parser = argparse.ArgumentParser()
+    add_run_args(parser)
+    args = parser.parse_args([])
+    for key, value in options.items():
+        if hasattr(args, key) and key not in ('report', 'trace'):
+            setattr(args, key, value)
+    return args
+
+
+
+
+
+
+class SignServer:
+    """keep one warm process that runs jobs sent as json over a unix socket
+    
+    a job is a line such as {"configs": ["/path/app.ini"], "stages": ["sign", "package"], "args": {"jobs": 4}, "cwd": "/path"};
+    the server answers with one json event per line: output, stage, error and finally done"""
+    def __init__(self, socket_path, concurrency=None):
+        self.socket_path = Path(socket_path).expanduser()
+        self.concurrency = {'sign': 1, 'package': 2, 'notarize': 10, 'staple': 4, **(concurrency or {})}
+        self.limits = {}
+        self.active = 0
+        self.executor = None
+        # relative paths in a job resolve from the client's directory; the working 
+        # directory is process wide, so only jobs from the same directory run together
+        self.directory = os.getcwd()
+        self.directory_users = 0
+        self.directory_waiting = {}
+        self.directory_changed = None
+    
+    def job_directory(self, request):
+        """the directory relative paths of `request` resolve from; None if it cannot be known"""
+        if request.get('cwd'):
+            return request['cwd'] if os.path.isabs(request['cwd']) else None
+        # older clients: absolute configuration files that all live in one directory
+        configs = request.get('configs', [])
+        parents = {os.path.dirname(f) for f in configs}
+        if configs and all(os.path.isabs(f) for f in configs) and len(parents) == 1:
+            return parents.pop()
+        return None
+    
+    async def enter_directory(self, directory):
+        if self.directory_changed is None:
+            self.directory_changed = asyncio.Condition()
+        async with self.directory_changed:
+            if self.directory_users and self.directory != directory:
+                print(f'waiting for jobs in {self.directory} to finish')
+            # a job for another directory that is already waiting goes first
+            ahead = lambda: any(d != directory for d in self.directory_waiting)
+            self.directory_waiting[directory] = self.directory_waiting.get(directory, 0) + 1
+            try:
+                await self.directory_changed.wait_for(
+                    lambda: self.directory_users == 0 or (self.directory == directory and not ahead()))
+            finally:
+                self.directory_waiting[directory] -= 1
+                if not self.directory_waiting[directory]:
+                    del self.directory_waiting[directory]
+            if self.directory != directory:
+                os.chdir(directory)
+                self.directory = directory
+            self.directory_users += 1
+    
+    async def leave_directory(self):
+        async with self.directory_changed:
+            self.directory_users -= 1
+            self.directory_changed.notify_all()
+    
+    def limits_for(self, config):
+        limits = {}
+        for stage in BATCH_STAGES:
+            key = (stage, stage_identity(stage, config))
+            if key not in self.limits:
+                self.limits[key] = asyncio.Semaphore(max(1, self.concurrency[stage]))
+            limits[stage] = self.limits[key]
+        return limits
+    
+    async def run_job(self, request, send):
+        args = job_args(request.get('args', {}))
+        stages = request.get('stages') or list(BATCH_STAGES)
+        unknown = [s for s in stages if s not in BATCH_STAGES]
+        if unknown:
+            send({'event': 'error', 'message': f'unknown stages: {", ".join(unknown)}'})
+            return []
+        directory = self.job_directory(request)
+        if not directory or not os.path.isdir(directory):
+            # running with the server's directory would sign and overwrite the wrong files
+            send({'event': 'error', 'message': 'the job has no usable working directory; '
+                                               'send "cwd" or absolute configuration files from one directory'})
+            return []
+        
+        await self.enter_directory(directory)
+        try:
+            configs = [c for c in (load_config(f, args) for f in request.get('configs', [])) if c]
+            if not configs:
+                send({'event': 'error', 'message': 'no usable configuration files provided'})
+                return []
+            return await asyncio.gather(*[run_batch_package(c, stages, self.limits_for(c), self.executor, send) 
+                                          for c in configs])
+        finally:
+            await self.leave_directory()
+    
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        send = lambda event: loop.call_soon_threadsafe(events.put_nowait, event)
+        
+        try:
+            request = json.loads(await reader.readline())
+        except (ValueError, asyncio.LimitOverrunError) as e:
+            request = None
+            send({'event': 'error', 'message': f'bad request: {e}'})
+        
+        job = None
+        if isinstance(request, dict):
+            self.active += 1
+            logging.info(f'job started: {request.get("configs")}')
+            _progress_sink.set(lambda text: send({'event': 'output', 'text': text}))
+            job = asyncio.ensure_future(self.run_job(request, send))
+            _progress_sink.set(None)
+            job.add_done_callback(lambda _: send(None))
+        elif request is not None:
+            send({'event': 'error', 'message': 'bad request: expected a json object'})
+        if job is None:
+            send(None)
+        
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                writer.write(bytes(json.dumps(event) + '\n', 'utf-8'))
+                await writer.drain()
+            if job:
+                try:
+                    results = job.result()
+                except Exception as e:
+                    logging.exception('job raised an exception')
+                    writer.write(bytes(json.dumps({'event': 'error', 'message': str(e)}) + '\n', 'utf-8'))
+                    results = []
+                writer.write(bytes(json.dumps({'event': 'done', 'results': results}) + '\n', 'utf-8'))
+                await writer.drain()
+        except (ConnectionError, OSError):
+            # the client went away; the job keeps running to completion
+            logging.info('client disconnected')
+        finally:
+            if job:
+                job.add_done_callback(lambda _: self.finished())
+            writer.close()
+    
+    def finished(self):
+        self.active -= 1
+        if self.active == 0:
+            # nothing is running: drop the per-run timing records so a long-lived server does not grow
+            with _records_lock:
+                RUN_RECORDS.clear()
+                RUN_SPANS.clear()
+    
+    async def serve(self):
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.socket_path.exists():
+            try:
+                _, writer = await asyncio.open_unix_connection(str(self.socket_path))
+                writer.close()
+                print(f'a server is already listening on {self.socket_path}')
+                return
+            except OSError:
+                self.socket_path.unlink()
+        
+        workers = sum(self.concurrency.values())
+        with futures.ThreadPoolExecutor(max_workers=workers) as self.executor:
+            server = await asyncio.start_unix_server(self.handle, path=str(self.socket_path))
+            os.chmod(self.socket_path, 0o600)
+            print(f'listening on {self.socket_path}')
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                self.socket_path.unlink(missing_ok=True)
+
+
+
+
+
+
+def get_serve_args(argv):
+    parser = argparse.ArgumentParser(prog='pycodesign.py serve',
+                                     description='PyCodeSign -- run a server that processes jobs sent by `pycodesign.py submit`')
+    parser.add_argument('-v', '--verbose', action='count', default=1)
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET,
+                        help=f'unix socket to listen on (default: {DEFAULT_SOCKET})')
+    for stage, default in (('sign', 1), ('package', 2), ('notarize', 10), ('staple', 4)):
+        parser.add_argument(f'--{stage}-jobs', dest=f'{stage}_jobs', type=int, default=default,
+                            metavar='<INTEGER>',
+                            help=f'number of packages in the {stage} stage at once for each identity (default: {default})')
+    return parser.parse_args(argv)
+
+
+
+
+
+
+def serve_main(argv):
+    args = get_serve_args(argv)
+    verbose = 50 - (args.verbose*10)
+    logging.root.setLevel(max(verbose, 10))
+    
+    sys.stdout = ProgressWriter(sys.stdout)
+    server = SignServer(args.socket, {s: getattr(args, f'{s}_jobs') for s in BATCH_STAGES})
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        print('server stopped')
+    finally:
+        sys.stdout = sys.stdout.stream
+
+
+
+
+
+
+def get_submit_args(argv):
+    parser = argparse.ArgumentParser(prog='pycodesign.py submit',
+                                     description='PyCodeSign -- send configuration files to a running `pycodesign.py serve`')
+    parser.add_argument('configs', nargs='+', metavar='<PYCODESIGN_CONFIG.INI>',
+                        help='configuration files or glob patterns such as "configs/*.ini"')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET,
+                        help=f'unix socket of the server (default: {DEFAULT_SOCKET})')
+    parser.add_argument('--stages', type=str, default=','.join(BATCH_STAGES),
+                        help=f'comma separated stages to run (default: {",".join(BATCH_STAGES)})')
+    add_run_args(parser)
+    return parser.parse_args(argv)
+
+
+
+
+
+
+async def submit_job(socket_path, request):
+    """send one job to the server and print its events; returns the results of the done event"""
+    reader, writer = await asyncio.open_unix_connection(str(Path(socket_path).expanduser()), limit=16*1024*1024)
+    writer.write(bytes(json.dumps(request) + '\n', 'utf-8'))
+    await writer.drain()
+    
+    results = None
+    async for line in reader:
+        event = json.loads(line)
+        if event['event'] == 'output':
+            sys.stdout.write(event['text'])
+        elif event['event'] == 'error':
+            print(f'error: {event["message"]}')
+        elif event['event'] == 'done':
+            results = event['results']
+    writer.close()
+    return results
+
+
+
+
+
+
+def submit_main(argv):
+    args = get_submit_args(argv)
+    files = []
+    for pattern in args.configs:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        files.extend(os.path.abspath(f) for f in matches if os.path.abspath(f) not in files)
+    
+    request = {
+        'configs': files,
+        'stages': [s.strip() for s in args.stages.split(',') if s.strip()],
+        'args': {k: v for k, v in vars(args).items() if k not in ('configs', 'socket', 'stages', 'report', 'trace')},
+        'cwd': os.getcwd(),
+    }
+    try:
+        results = asyncio.run(submit_job(args.socket, request))
+    except OSError as e:
+        print(f'could not connect to the server at {args.socket}: {e}')
+        print(f'start one with:\n$ {sys.argv[0]} serve')
+        return 1
+    if not results:
+        return 1
+    print()
+    print(format_batch_summary(results, request['stages']))
+    failed = any(s['status'] == 'failed' for r in results for s in r['stages'].values())
+    return 1 if failed else 0
+
+
+
+
+
+
+# ---- remote signing workers ------------------------------------------------------------
+# `pycodesign.py worker` signs files and bundles for a coordinator (a normal run with
+# [main] workers set). Messages are json lines; file contents follow a header as raw
+# bytes and are addressed by their sha256, so nothing a worker already has is sent again.
+
+DEFAULT_WORKER_ADDRESS = '127.0.0.1:7770'
+DEFAULT_WORKER_STORE = '~/.cache/pycodesign/worker-store'
+WORKER_SIGN_OPTIONS = ('--deep', '--force', '--timestamp', '--timestamp=none')
+WORKER_SIGN_PREFIXES = ('--options=', '--preserve-metadata=')
+
+def tree_entries(base, root, digest):
+    """the file tree at base/root as a list of entries with paths relative to `base`
+    
+    `digest(path)` returns the sha256 of a file"""
+    entries = []
+    stack = [root]
+    while stack:
+        rel = stack.pop()
+        path = os.path.join(base, rel)
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            entries.append({'path': rel, 'type': 'link', 'target': os.readlink(path)})
+        elif stat.S_ISDIR(st.st_mode):
+            entries.append({'path': rel, 'type': 'dir', 'mode': st.st_mode & 0o7777})
+            stack.extend(os.path.join(rel, name) for name in sorted(os.listdir(path), reverse=True))
+        else:
+            entries.append({'path': rel, 'type': 'file', 'mode': st.st_mode & 0o7777, 'digest': digest(path)})
+    return entries
+
+
+
+
+
+
+def safe_relative(path):
+    """true if `path` stays inside the directory it is relative to"""
+    return path and not os.path.isabs(path) and '..' not in Path(path).parts
+
+
+def check_entries(entries):
+    """raise ValueError unless every entry and link target stays inside the tree and no path repeats"""
+    paths = [os.path.normpath(e['path']) if safe_relative(e.get('path')) else None for e in entries]
+    if not all(paths):
+        raise ValueError('paths must be relative and stay inside the job')
+    if len(set(paths)) != len(paths):
+        raise ValueError('paths must not repeat')
+    for entry in entries:
+        if entry['type'] == 'link' and not safe_relative(entry.get('target')):
+            raise ValueError(f'link {entry["path"]} must point inside the job: {entry.get("target")}')
+
+
+def check_parents(base, rel):
+    """raise ValueError if a directory between `base` and `rel` is a symlink, so nothing is written through one"""
+    parent = base
+    for part in Path(rel).parts[:-1]:
+        parent = os.path.join(parent, part)
+        try:
+            if stat.S_ISLNK(os.lstat(parent).st_mode):
+                raise ValueError(f'{rel} is inside the symlink {os.path.relpath(parent, base)}')
+        except FileNotFoundError:
+            return
+
+
+
+
+
+
+class WorkerStore:
+    """content addressed file store of a worker: <root>/<first 2 hex digits>/<sha256>"""
+    def __init__(self, root):
+        self.root = Path(root).expanduser()
+        self.root.mkdir(parents=True, exist_ok=True)
+    
+    def path(self, digest):
+        if not re.fullmatch(r'[0-9a-f]{64}', digest or ''):
+            raise ValueError(f'bad digest: {digest}')
+        return self.root/digest[:2]/digest
+    
+    def has(self, digest):
+        return self.path(digest).exists()
+    
+    def put(self, rfile, digest, size):
+        """store `size` bytes read from `rfile`; they must hash to `digest`"""
+        path = self.path(digest)
+        path.parent.mkdir(exist_ok=True)
+        sha256 = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as f:
+            try:
+                while size:
+                    data = rfile.read(min(size, 1024*1024))
+                    if not data:
+                        raise ConnectionError('connection closed during a transfer')
+                    sha256.update(data)
+                    f.write(data)
+                    size -= len(data)
+            except BaseException:
+                os.unlink(f.name)
+                raise
+        if sha256.hexdigest() != digest:
+            os.unlink(f.name)
+            raise ValueError(f'content does not match {digest}')
+        os.replace(f.name, path)
+    
+    def add_file(self, path):
+        """copy the file at `path` into the store; returns its digest"""
+        digest = file_sha256(path)
+        if not self.has(digest):
+            target = self.path(digest)
+            target.parent.mkdir(exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=target.parent, delete=False) as f:
+                with open(path, 'rb') as source:
+                    shutil.copyfileobj(source, f, 1024*1024)
+            os.replace(f.name, target)
+        return digest
+    
+    def prune(self, max_age=7*24*3600):
+        """remove blobs that were not used for `max_age` seconds"""
+        cutoff = time.time() - max_age
+        for path in self.root.glob('??/*'):
+            try:
+                if max(path.stat().st_atime, path.stat().st_mtime) < cutoff:
+                    path.unlink()
+            except OSError:
+                pass
+
+
+
+
+
+
+def worker_sign(store, request, timeout=None):
+    """materialize the tree in `request` from the store, sign it and store the result"""
+    entries = request['entries']
+    if not safe_relative(request.get('root')):
+        raise ValueError('paths must be relative and stay inside the job')
+    check_entries(entries)
+    with tempfile.TemporaryDirectory(prefix='pycodesign-worker-') as job:
+        for entry in sorted(entries, key=lambda e: e['path'].count(os.sep)):
+            path = os.path.join(job, entry['path'])
+            check_parents(job, entry['path'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if entry['type'] == 'dir':
+                os.mkdir(path)
+            elif entry['type'] == 'link':
+                os.symlink(entry['target'], path)
+            else:
+                # O_NOFOLLOW and O_EXCL: never write through a link planted at this path
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+                with open(fd, 'wb') as target, open(store.path(entry['digest']), 'rb') as source:
+                    shutil.copyfileobj(source, target, 1024*1024)
+        for entry in entries:
+            if entry['type'] != 'link':
+                os.chmod(os.path.join(job, entry['path']), entry['mode'])
+        
+        options = [o for o in request.get('options', []) 
+                   if o in WORKER_SIGN_OPTIONS or o.startswith(WORKER_SIGN_PREFIXES)]
+        if request.get('entitlements'):
+            options += ['--entitlements', str(store.path(request['entitlements']))]
+        argv = tool_command({}, 'codesign') + options + ['--sign', request['identity'], os.path.join(job, request['root'])]
+        try:
+            r, o, e = run_command(argv, timeout=request.get('timeout') or timeout)
+        except OSError as error:
+            r, o, e = 127, b'', bytes(str(error), 'utf-8')
+        signed = tree_entries(job, request['root'], store.add_file) if r == 0 else entries
+        # paths in messages refer to the coordinator's copy
+        job_prefix, shown = bytes(job + os.sep, 'utf-8'), bytes(request.get('display', ''), 'utf-8')
+        return {'return_code': r, 'stdout': o.replace(job_prefix, shown).decode('utf-8', 'replace'),
+                'stderr': e.replace(job_prefix, shown).decode('utf-8', 'replace'), 'entries': signed}
+
+
+
+
+
+
+def serve_worker_stream(rfile, wfile, store, token=None, timeout=None):
+    """answer the requests of one coordinator connection until it closes"""
+    def reply(message):
+        wfile.write(bytes(json.dumps(message) + '\n', 'utf-8'))
+        wfile.flush()
+    
+    authorized = token is None
+    while True:
+        line = rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            op = request['op']
+            if op == 'hello':
+                authorized = token is None or hmac.compare_digest(str(request.get('token', '')), token)
+                reply({'ok': authorized, 'version': version, 'host': socket.gethostname()} if authorized
+                      else {'error': 'bad token'})
+                if not authorized:
+                    return
+            elif not authorized:
+                reply({'error': 'say hello first'})
+                return
+            elif op == 'have':
+                reply({'missing': [d for d in request['digests'] if not store.has(d)]})
+            elif op == 'put':
+                store.put(rfile, request['digest'], request['size'])
+                reply({'ok': True})
+            elif op == 'get':
+                path = store.path(request['digest'])
+                reply({'size': path.stat().st_size})
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, wfile, 1024*1024)
+                wfile.flush()
+            elif op == 'sign':
+                reply(worker_sign(store, request, timeout))
+            else:
+                reply({'error': f'unknown request: {op}'})
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            if isinstance(e, ConnectionError):
+                return
+            logging.warning(f'bad request: {e}')
+            reply({'error': str(e)})
+
+
+
+
+
+
+class WorkerConnection:
+    """one connection to a worker: `host:port` over tcp, `ssh:[user@]host` or `exec:<command>` over stdio"""
+    def __init__(self, config, address, token=None):
+        self.address = address
+        self.process = self.socket = None
+        if address.startswith(('ssh:', 'exec:')):
+            kind, target = address.split(':', 1)
+            if kind == 'ssh':
+                command = config.get('main', {}).get('worker_command', 'pycodesign.py worker --stdio')
+                argv = tool_command(config, 'ssh') + [target, command]
+            else:
+                argv = shlex.split(target)
+            self.process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.rfile, self.wfile = self.process.stdout, self.process.stdin
+        else:
+            host, _, port = address.rpartition(':')
+            self.socket = socket.create_connection((host, int(port)), timeout=30)
+            self.socket.settimeout(None)
+            self.rfile, self.wfile = self.socket.makefile('rb'), self.socket.makefile('wb')
+        try:
+            answer = self.request({'op': 'hello', 'token': token or '', 'version': version})
+        except (OSError, ValueError):
+            self.close()
+            raise
+        self.host = answer.get('host', address)
+        if answer.get('version') != version:
+            logging.warning(f'worker {address} runs pycodesign {answer.get("version")}, this is {version}')
+    
+    def send(self, message, source=None):
+        self.wfile.write(bytes(json.dumps(message) + '\n', 'utf-8'))
+        if source:
+            with open(source, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile, 1024*1024)
+        self.wfile.flush()
+    
+    def receive(self):
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError(f'worker {self.address} closed the connection')
+        answer = json.loads(line)
+        if 'error' in answer:
+            raise ConnectionError(f'worker {self.address}: {answer["error"]}')
+        return answer
+    
+    def request(self, message, source=None):
+        self.send(message, source)
+        return self.receive()
+    
+    def fetch(self, digest, target):
+        """write the blob `digest` to `target`"""
+        size = self.request({'op': 'get', 'digest': digest})['size']
+        with open(target, 'wb') as f:
+            while size:
+                data = self.rfile.read(min(size, 1024*1024))
+                if not data:
+                    raise ConnectionError(f'worker {self.address} closed the connection')
+                f.write(data)
+                size -= len(data)
+    
+    def close(self):
+        """also interrupts a request that is waiting for an answer"""
+        if self.socket:
+            try:
+                # close() alone leaves a readline() on the makefile() reader blocked
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for closing in (self.wfile, self.socket):
+            try:
+                if closing:
+                    closing.close()
+            except OSError:
+                pass
+        if self.process:
+            self.process.kill()
+            self.process.wait()
+
+
+
+
+
+
+def apply_signed_tree(connection, base, sent, signed):
+    """bring the local tree at `base` from the `sent` entries to the `signed` ones"""
+    before = {e['path']: e for e in sent}
+    after = {e['path']: e for e in signed}
+    # the worker's answer must not reach outside the item either
+    check_entries([e for e in signed if before.get(e['path']) != e])
+    for rel in sorted(set(before) - set(after), key=lambda r: r.count(os.sep), reverse=True):
+        path = os.path.join(base, rel)
+        if before[rel]['type'] == 'dir':
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.lexists(path):
+            os.unlink(path)
+    for rel, entry in sorted(after.items(), key=lambda item: item[0].count(os.sep)):
+        if before.get(rel) == entry:
+            continue
+        path = os.path.join(base, rel)
+        old = before.get(rel)
+        check_parents(base, rel)
+        if entry['type'] == 'dir':
+            os.makedirs(path, exist_ok=True)
+        elif entry['type'] == 'link':
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(entry['target'], path)
+        elif not old or old.get('digest') != entry['digest']:
+            # replace the file so hard links to the unsigned original are left alone
+            temp = f'{path}.pycodesign-{os.getpid()}'
+            connection.fetch(entry['digest'], temp)
+            os.replace(temp, path)
+        if entry['type'] != 'link':
+            os.chmod(path, entry['mode'])
+
+
+
+
+
+
+class RemoteSigner:
+    """sign files and bundles on the workers in `[main] workers`
+    
+    every worker gets `worker_jobs` connections that take items from a shared queue.
+    An item whose worker fails or stops answering is put back in the queue for the
+    other connections; when none are left the remaining items are signed locally"""
+    def __init__(self, config, sign_args):
+        main_config = config.get('main', {})
+        self.config = config
+        self.addresses = [w.strip() for w in re.split(r'[,\n]', main_config.get('workers', '')) if w.strip()]
+        self.connections = max(1, int(main_config.get('worker_jobs', 1)))
+        self.timeout = float(main_config.get('worker_timeout', 900)) or None
+        self.token = os.environ.get('PYCODESIGN_WORKER_TOKEN')
+        self.digests = get_digest_cache(config)
+        self.sign_args = sign_args
+        
+        # the worker runs its own codesign; only the options are sent along
+        first_option = next((i for i, a in enumerate(sign_args) if a.startswith('-')), len(sign_args))
+        self.options, self.identity, self.entitlements = [], None, None
+        options = iter(sign_args[first_option:])
+        for option in options:
+            if option == '--sign':
+                self.identity = next(options)
+            elif option == '--entitlements':
+                self.entitlements = next(options)
+            else:
+                self.options.append(option)
+    
+    @property
+    def slots(self):
+        return len(self.addresses) * self.connections
+    
+    def describe(self):
+        return f'{self.slots} connections to {len(self.addresses)} remote workers'
+    
+    def upload(self, connection, files):
+        """send the {digest: path} files the worker does not have yet"""
+        missing = connection.request({'op': 'have', 'digests': sorted(files)})['missing']
+        for digest in missing:
+            path = files[digest]
+            connection.request({'op': 'put', 'digest': digest, 'size': os.path.getsize(path)}, path)
+        return len(missing)
+    
+    def sign_item(self, connection, item, timeout=None):
+        start = time.time()
+        base, root = os.path.split(os.path.abspath(item))
+        entries = tree_entries(base, root, self.digests.sha256)
+        try:
+            check_entries(entries)
+        except ValueError as e:
+            # the worker would refuse it; that is no reason to drop the connection
+            logging.warning(f'{item} cannot be signed remotely ({e}); signing it here')
+            return sign_file(item, self.sign_args, timeout)
+        files = {e['digest']: os.path.join(base, e['path']) for e in entries if e['type'] == 'file'}
+        # codesign messages name the item the way it was listed
+        display = os.path.join(os.path.dirname(os.path.normpath(item)), '')
+        request = {'op': 'sign', 'root': root, 'entries': entries, 'identity': self.identity,
+                   'options': self.options, 'display': display, 'timeout': timeout}
+        if self.entitlements:
+            request['entitlements'] = self.digests.sha256(self.entitlements)
+            files[request['entitlements']] = self.entitlements
+        uploaded = self.upload(connection, files)
+        answer = connection.request(request)
+        if answer['return_code'] == 0:
+            apply_signed_tree(connection, base, entries, answer['entries'])
+        logging.debug(f'{item}: signed on {connection.host}, {uploaded} of {len(files)} files uploaded')
+        record_command(['codesign', f'@{connection.host}', item], start, time.time() - start, None,
+                       answer['return_code'], b'', b'')
+        return {'file': item, 'return_code': answer['return_code'], 'worker': connection.host,
+                'stdout': bytes(answer['stdout'], 'utf-8'), 'stderr': bytes(answer['stderr'], 'utf-8')}
+    
+    def run_connection(self, address, pending, results, timeout=None):
+        try:
+            connection = WorkerConnection(self.config, address, self.token)
+        except (OSError, ValueError) as e:
+            logging.warning(f'could not connect to worker {address}: {e}')
+            return
+        try:
+            while True:
+                try:
+                    item = pending.get_nowait()
+                except queue.Empty:
+                    return
+                watchdog = threading.Timer(self.timeout, connection.close) if self.timeout else None
+                if watchdog:
+                    watchdog.start()
+                try:
+                    results.put(self.sign_item(connection, item, timeout))
+                except (OSError, ValueError, KeyError) as e:
+                    # another connection picks the item up again
+                    logging.warning(f'worker {address} failed while signing {item}: {e}')
+                    pending.put(item)
+                    return
+                finally:
+                    if watchdog:
+                        watchdog.cancel()
+        finally:
+            connection.close()
+    
+    def sign(self, items, timeout=None):
+        """sign `items` on the workers; yields per-file results as they complete"""
+        pending, results = queue.Queue(), queue.Queue()
+        for item in items:
+            pending.put(item)
+        threads = [threading.Thread(target=in_context(self.run_connection), args=(address, pending, results, timeout),
+                                    daemon=True)
+                   for address in self.addresses for _ in range(self.connections)]
+        for thread in threads:
+            thread.start()
+        
+        done = 0
+        while done < len(items):
+            try:
+                result = results.get(timeout=0.2)
+            except queue.Empty:
+                if any(thread.is_alive() for thread in threads):
+                    continue
+                # every connection is gone
+                while not pending.empty():
+                    item = pending.get()
+                    logging.warning(f'no workers left; signing {item} here')
+                    results.put(sign_file(item, self.sign_args, timeout))
+                continue
+            done += 1
+            yield result
+
+
+
+
+
+
+def get_remote_signer(config, sign_args):
+    """a RemoteSigner when `[main] workers` is set, otherwise None"""
+    if not config.get('main', {}).get('workers', '').strip():
+        return None
+    return RemoteSigner(config, sign_args)
+
+
+
+
+
+
+def get_worker_args(argv):
+    parser = argparse.ArgumentParser(prog='pycodesign.py worker',
+                                     description='PyCodeSign -- sign files and bundles for runs that list this host in [main] workers')
+    parser.add_argument('-v', '--verbose', action='count', default=1)
+    parser.add_argument('--listen', type=str, default=DEFAULT_WORKER_ADDRESS, metavar='<HOST:PORT>',
+                        help=f'address to accept coordinators on (default: {DEFAULT_WORKER_ADDRESS})')
+    parser.add_argument('--stdio', action='store_true', default=False,
+                        help='serve a single coordinator on stdin and stdout, as started over ssh')
+    parser.add_argument('--store', type=str, default=DEFAULT_WORKER_STORE, metavar='<DIRECTORY>',
+                        help=f'content addressed store for transferred files (default: {DEFAULT_WORKER_STORE})')
+    parser.add_argument('--timeout', type=float, default=900, metavar='<SECONDS>',
+                        help='kill a codesign call that takes longer than this (default: 900)')
+    return parser.parse_args(argv)
+
+
+
+
+
+
+def worker_main(argv):
+    args = get_worker_args(argv)
+    verbose = 50 - (args.verbose*10)
+    logging.root.setLevel(max(verbose, 10))
+    
+    store = WorkerStore(args.store)
+    store.prune()
+    if args.stdio:
+        # stdout carries the protocol; anything printed goes to stderr instead
+        rfile, wfile = sys.stdin.buffer, sys.stdout.buffer
+        sys.stdout = sys.stderr
+        serve_worker_stream(rfile, wfile, store, None, args.timeout)
+        return 0
+    
+    token = os.environ.get('PYCODESIGN_WORKER_TOKEN')
+    host, _, port = args.listen.rpartition(':')
+    if not token:
+        # even on 127.0.0.1 any local user could have files signed and written
+        print('PYCODESIGN_WORKER_TOKEN is not set; refusing to listen without it')
+        print('set the same token here and on the coordinator, or use --stdio over ssh')
+        return 1
+    
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            serve_worker_stream(self.rfile, self.wfile, store, token, args.timeout)
+    
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    socketserver.ThreadingTCPServer.daemon_threads = True
+    with socketserver.ThreadingTCPServer((host, int(port)), Handler) as server:
+        print(f'worker listening on {args.listen}; store: {store.root}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print('worker stopped')
+    return 0
+
+
+
+
+
+
+def get_staple_verify_args(argv):
+    parser = argparse.ArgumentParser(prog='pycodesign.py staple-verify',
+                                     description='PyCodeSign -- staple and verify many .pkg, .dmg and .app artifacts in parallel')
+    parser.add_argument('-v', '--verbose', action='count', default=1)
+    parser.add_argument('artifacts', nargs='+', metavar='<ARTIFACT>',
+                        help='artifacts, directories to search, glob patterns or configuration files')
+    parser.add_argument('-j', '--jobs', type=int, default=4, metavar='<INTEGER>',
+                        help='artifacts to process at once (default: 4)')
+    parser.add_argument('--retries', type=int, default=2, metavar='<INTEGER>',
+                        help='times to retry a check that failed with a transient error (default: 2)')
+    parser.add_argument('--retry-delay', dest='retry_delay', type=float, default=5, metavar='<SECONDS>',
+                        help='delay before the first retry; doubles for each retry after it (default: 5)')
+    parser.add_argument('--timeout', type=float, default=300, metavar='<SECONDS>',
+                        help='kill a check that takes longer than this (default: 300)')
+    parser.add_argument('--verify-only', dest='verify_only', action='store_true', default=False,
+                        help='do not staple; only validate and check the signatures')
+    return parser.parse_args(argv)
+
+
+
+
+
+
+def staple_verify_main(argv):
+    args = get_staple_verify_args(argv)
+    verbose = 50 - (args.verbose*10)
+    logging.root.setLevel(max(verbose, 10))
+    
+    artifacts = find_artifacts(args.artifacts)
+    if not artifacts:
+        print('no .pkg, .dmg or .app artifacts found')
+        return 1
+    print(f'{"verifying" if args.verify_only else "stapling and verifying"} {len(artifacts)} artifacts')
+    results = staple_verify(artifacts, args.jobs, not args.verify_only, args.retries, args.retry_delay, args.timeout)
+    print()
+    print(format_verify_results(results))
+    return 0 if all(r['ok'] for r in results) else 1
+
+
+
+
+
+
+def format_ledger(records):
+    header = ['submitted', 'completed', 'status', 'package', 'version', 'submission id', 'sha256']
+    rows = [[r.get('submitted') or '-', r.get('completed') or '-', r.get('status') or '-', 
+             r.get('package') or '-', r.get('version') or '-', r['id'], (r.get('sha256') or '-')[:12]]
+            for r in records]
+    widths = [max(len(r[i]) for r in [header] + rows) for i in range(len(header))]
+    lines = ['  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip() for row in [header] + rows]
+    lines.insert(1, '  '.join('-'*w for w in widths))
+    return '\n'.join(lines)
+
+
+
+
+
+
+def get_ledger_args(argv):
+    parser = argparse.ArgumentParser(prog='pycodesign.py ledger',
+                                     description='PyCodeSign -- list past notarization submissions from the local ledger')
+    parser.add_argument('packages', nargs='*', metavar='<PACKAGE.PKG>',
+                        help='only show submissions of the exact contents of these packages')
+    parser.add_argument('--ledger', type=str, default='~/.cache/pycodesign/notary-ledger.json',
+                        help='ledger file (default: ~/.cache/pycodesign/notary-ledger.json)')
+    parser.add_argument('--sha256', type=str, default=None,
+                        help='only show submissions of packages whose SHA-256 starts with this')
+    parser.add_argument('--id', type=str, default=None,
+                        help='only show this submission')
+    parser.add_argument('--status', type=str, default=None,
+                        help='only show submissions with this status, such as Accepted or Invalid')
+    parser.add_argument('--log', action='store_true', default=False,
+                        help='print the stored notarization log of each submission')
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='print the matching records as json')
+    return parser.parse_args(argv)
+
+
+
+
+
+
+def ledger_main(argv):
+    args = get_ledger_args(argv)
+    ledger = NotaryLedger(args.ledger)
+    records = ledger.query(args.sha256, args.id, status=args.status)
+    if args.packages:
+        hashes = set()
+        for package_file in args.packages:
+            try:
+                hashes.add(file_sha256(package_file))
+            except OSError as e:
+                print(f'could not read {package_file}: {e}')
+        records = [r for r in records if r.get('sha256') in hashes]
+    
+    if args.json:
+        print(json.dumps(records, indent=1))
+    elif not records:
+        print(f'no matching submissions in {ledger.path}')
+    else:
+        print(format_ledger(records))
+        if args.log:
+            for record in records:
+                print(f'\n{record["id"]}:')
+                print(json.dumps(record.get('log') or {}, indent=1))
+    return records
+
+
+
+
+
+
+def main():
+    expected_config_keys = EXPECTED_CONFIG_KEYS
+    run_all = True
+    
+#     notarize_timer = 60
+#     notrarize_max_check = 5
+    halt = False
+    
+    if '-V' in sys.argv[1:] or '--version' in sys.argv[1:]:
+        # answer before the parser or any deferred module is loaded; wrapper scripts and make rules call this often
+        print(f'{sys.argv[0]} V{version}')
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        return batch_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        return serve_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'submit':
+        sys.exit(submit_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'staple-verify':
+        sys.exit(staple_verify_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'ledger':
+        return ledger_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        sys.exit(worker_main(sys.argv[2:]))
+    
+    args = get_args()
+    
+    if args.version:
+        print(f'{sys.argv[0]} V{version}')
+        return
+    
+    config = get_config(args=args, default_config=expected_config_keys)
+    if args.cache_stats and not config:
+        print(get_sign_cache({}, enabled=True).report())
+        return
+    if not config:
+        print('no configuration file provided')
+        print(f'try:\n$ {sys.argv[0]} -h')
+        return
+    
+    # set up logging only once there is work to do; -N and -h never import it
+    verbose = 50 - (args.verbose*10) 
+    if verbose < 10:
+        verbose = 10
+    logging.root.setLevel(verbose)
+    
+    #config.update({'main': {
+    #    'notarize_timer': args.notarize_timer,
+    #    'notrarize_max_check': args.num_checks,
+    #    'new_config': args.new_config}
+    #              })
+    
+    apply_args(config, args)
+    
+    logging.debug('using config:')
+    logging.debug(config)
+    
+    if validate_config(config, expected_config_keys):
+        print('exiting')
+        return
+        
+    split_file_list(config)
+    config['main']['config_file'] = args.config
+    
+    if args.scan:
+        scan = scan_tree(config['package_details']['file_list'], get_jobs(config))
+        print(format_scan(scan))
+        for warning in check_binaries(scan, config['package_details']['file_list']):
+            print(f'warning: {warning}')
+        return config
+    
+    
+    check_args =[args.notarize_only,
+                 args.package_only,
+                 args.sign_only,
+                 args.staple_only,
+                 args.package_debug ]
+        
+    for each in check_args:
+        if each:
+            run_all = False
+    
+#     if args.notarize_only or args.package_only or args.sign_only or args.staple_only or args.package_debug:
+#         run_all = False
+
+    if run_all and not args.fresh:
+        run_resumable(config, StateJournal(state_file(args.config), config))
+        run_all = False
+        
+    if args.sign_only or run_all:
+        print('signing...')
+        with stage_span('sign', config['package_details']['package_name']):
+            r, o, e = sign(config)
+        process_return(r, o, e)
+        if r > 0:
+            halt = True
+        
+    if args.package_only or args.package_debug or run_all and not halt:
+        print('packaging...')
+        with stage_span('package', config['package_details']['package_name']):
+            r, o, e = package(config, args.package_debug)
+        process_return(r, o, e)
+        if r > 0:
+            halt = True
+    
+    if args.notarize_only or run_all and not halt:
+        print('notarizing...')
+        with stage_span('notarize', config['package_details']['package_name']):
+            r, o, e = notarize(config)
+        process_return(r, o, e)
+        if r == 0:
+            print('notaization process at Apple completed')
+        else:
+            print('notariztion process did not complete or was inconclusive')
+            if flagged_files(config):
+                print(f'run again to re-sign the files listed in {issues_file(config)}')
+            else:
+                print(f'check manually with: ')
+                print(f'xcrun notarytool history --keychain-profile {config["identification"]["keychain-profile"]}')
+            halt = True
+    
+    if args.staple_only or run_all and not halt:
+        print('stapling...')
+        with stage_span('staple', config['package_details']['package_name']):
+            r, o, e = staple(config)
+        process_return(r, o, e)
+        if r > 0:
+            halt = True
+    
+    if args.cache_stats:
+        print(get_sign_cache(config, enabled=True).report())
+    
+    write_run_reports(args)
+
+    
+    return config        
+    
+
+
+
+
+
+
+if __name__ == '__main__':
+    c = main()
+
+
+
+
+
+
+
+
+
@@ -0,0 +1,65 @@
+import logging
+import os
+import shutil
+import stat
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / 'fixtures'
+STUBS = Path(__file__).resolve().parent / 'stubs'
+
+sys.path.insert(0, str(ROOT))
+
+
+@pytest.fixture
+def fixtures():
+    return FIXTURES
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """run every test in its own directory with its own HOME so ~/.cache is never touched;
+    the subcommands set the level of the root logger, which is put back afterwards"""
+    work = tmp_path / 'work'
+    work.mkdir()
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    monkeypatch.setenv('STUB_STATE', str(tmp_path))
+    monkeypatch.chdir(work)
+    level = logging.root.level
+    yield work
+    logging.root.setLevel(level)
+
+
+@pytest.fixture
+def stub_bin(tmp_path, monkeypatch):
+    """directory at the front of PATH; call the fixture with a name and a script to add a tool,
+    or with just a name to install the stub of that name from tests/stubs"""
+    directory = tmp_path / 'bin'
+    directory.mkdir()
+    monkeypatch.setenv('PATH', f'{directory}{os.pathsep}{os.environ["PATH"]}')
+
+    def add(name, script=None):
+        path = directory / name
+        if script is None:
+            shutil.copy(STUBS / name, path)
+        else:
+            path.write_text(script)
+        path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        return path
+    return add
+
+
+def make_config(package_name='tool', file_list=('tool',), **main):
+    """a parsed configuration as main() builds it; keyword arguments go to [main]"""
+    return {
+        'identification': {'application_id': 'Developer ID Application: Example (TEAM123456)',
+                           'installer_id': 'Developer ID Installer: Example (TEAM123456)',
+                           'keychain-profile': 'profile'},
+        'package_details': {'package_name': package_name, 'bundle_id': 'com.example.tool',
+                            'file_list': list(file_list), 'installation_path': '/usr/local/bin',
+                            'entitlements': 'None', 'version': '1.0'},
+        'main': {'resolve_identity': 'no', **main},
+    }
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""write the small Mach-O and non Mach-O samples used by tests/test_macho.py
+
+run from this directory; the output is checked in so the tests do not depend on it"""
+import struct
+
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_RPATH = 0x8000001c
+LC_CODE_SIGNATURE = 0x1d
+
+X86_64 = 0x01000007
+ARM64 = 0x0100000c
+I386 = 7
+
+
+def padded(data, align=8):
+    return data + b'\0' * (-len(data) % align)
+
+
+def dylib_command(cmd, name):
+    name = padded(name.encode() + b'\0')
+    return struct.pack('<IIIIII', cmd, 24 + len(name), 24, 2, 0x10000, 0x10000) + name
+
+
+def rpath_command(path):
+    path = padded(path.encode() + b'\0')
+    return struct.pack('<III', LC_RPATH, 12 + len(path), 12) + path
+
+
+def signature_command():
+    return struct.pack('<IIII', LC_CODE_SIGNATURE, 16, 0, 0)
+
+
+def thin(cputype, filetype, commands, is_64=True):
+    body = b''.join(commands)
+    if is_64:
+        header = struct.pack('<IiIIIIII', 0xfeedfacf, cputype, 0, filetype, len(commands), len(body), 0, 0)
+    else:
+        header = struct.pack('<IiIIIII', 0xfeedface, cputype, 0, filetype, len(commands), len(body), 0)
+    return padded(header + body, 16)
+
+
+def fat(*slices):
+    align = 12
+    header = struct.pack('>II', 0xcafebabe, len(slices))
+    offset = 1 << align
+    arches, data = b'', b''
+    for cputype, image in slices:
+        arches += struct.pack('>iIIII', cputype, 0, offset + len(data), len(image), align)
+        data += padded(image, 1 << align)
+    return padded(header + arches, 1 << align) + data
+
+
+def java_class():
+    """public class Hello {} without methods; starts with 0xcafebabe like a fat header"""
+    pool = [b'\x07\x00\x02', b'\x01' + struct.pack('>H', 5) + b'Hello',
+            b'\x07\x00\x04', b'\x01' + struct.pack('>H', 16) + b'java/lang/Object']
+    return (struct.pack('>IHHH', 0xcafebabe, 0, 52, len(pool) + 1) + b''.join(pool) +
+            struct.pack('>HHHHHHH', 0x21, 1, 3, 0, 0, 0, 0))
+
+
+tool = thin(X86_64, 2, [dylib_command(LC_LOAD_DYLIB, '/usr/lib/libSystem.B.dylib'),
+                        dylib_command(LC_LOAD_DYLIB, '@rpath/libhelper.dylib'),
+                        rpath_command('@executable_path/../lib'),
+                        signature_command()])
+helper_arm64 = thin(ARM64, 6, [dylib_command(LC_ID_DYLIB, '@rpath/libhelper.dylib'),
+                               dylib_command(LC_LOAD_DYLIB, '/opt/local/lib/libz.1.dylib')])
+helper_x86_64 = thin(X86_64, 6, [dylib_command(LC_ID_DYLIB, '@rpath/libhelper.dylib'),
+                                 signature_command()])
+legacy = thin(I386, 8, [signature_command()], is_64=False)
+
+samples = {
+    'thin_x86_64': tool,
+    'thin_arm64.dylib': helper_arm64,
+    'thin_i386.bundle': legacy,
+    'fat.dylib': fat((X86_64, helper_x86_64), (ARM64, helper_arm64)),
+    'Hello.class': java_class(),
+    'truncated': tool[:40],
+    'script.sh': b'#!/bin/sh\necho hello\n',
+}
+
+if __name__ == '__main__':
+    for name, data in samples.items():
+        with open(name, 'wb') as f:
+            f.write(data)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""write the `security` output used by tests/test_identity.py and tests/stubs/security
+
+needs openssl; run from this directory. The output is checked in so the tests do not
+depend on it. Certificates are self-signed with fixed validity dates: the renewed
+application certificate ends after 2049, so its notAfter is a GeneralizedTime, and
+the development certificate has no extensions, so it is a version 1 certificate"""
+import hashlib
+import os
+import ssl
+import subprocess
+import tempfile
+
+CERTIFICATES = [
+    # (name, notBefore, notAfter, extensions)
+    ('Developer ID Application: Example (TEAM123456)', '20220101000000Z', '20270101000000Z', True),
+    ('Developer ID Application: Example (TEAM123456)', '20260101000000Z', '20550630120000Z', True),
+    ('Developer ID Installer: Example (TEAM123456)', '20220101000000Z', '20300301000000Z', True),
+    ('Apple Development: Jane Doe (DEV9876543)', '20220101000000Z', '20300101000000Z', False),
+]
+
+CA_CONFIG = '''[ca]
+default_ca = fixtures
+[fixtures]
+database = {dir}/index.txt
+new_certs_dir = {dir}
+serial = {dir}/serial
+default_md = sha256
+policy = anything
+email_in_dn = no
+unique_subject = no
+[anything]
+commonName = supplied
+[code_signing]
+basicConstraints = critical, CA:FALSE
+keyUsage = critical, digitalSignature
+extendedKeyUsage = codeSigning
+'''
+
+
+def certificate(name, not_before, not_after, extensions):
+    """DER of a self-signed certificate for `name` valid from `not_before` to `not_after`"""
+    with tempfile.TemporaryDirectory() as directory:
+        open(os.path.join(directory, 'index.txt'), 'w').close()
+        with open(os.path.join(directory, 'serial'), 'w') as f:
+            f.write('1000\n')
+        with open(os.path.join(directory, 'ca.cnf'), 'w') as f:
+            f.write(CA_CONFIG.format(dir=directory))
+        key, request, cert = (os.path.join(directory, n) for n in ('key.pem', 'req.pem', 'cert.pem'))
+        subprocess.run(['openssl', 'req', '-new', '-newkey', 'rsa:2048', '-nodes', '-keyout', key,
+                        '-subj', f'/CN={name}', '-out', request], check=True, capture_output=True)
+        subprocess.run(['openssl', 'ca', '-batch', '-selfsign', '-config', os.path.join(directory, 'ca.cnf'),
+                        '-keyfile', key, '-in', request, '-out', cert, '-notext',
+                        '-startdate', not_before, '-enddate', not_after,
+                        *(['-extensions', 'code_signing'] if extensions else [])], check=True, capture_output=True)
+        with open(cert) as f:
+            return ssl.PEM_cert_to_DER_cert(f.read())
+
+
+def main():
+    identities = []
+    certificates = []
+    for name, not_before, not_after, extensions in CERTIFICATES:
+        der = certificate(name, not_before, not_after, extensions)
+        sha1 = hashlib.sha1(der).hexdigest().upper()
+        identities.append((sha1, name))
+        certificates.append(f'SHA-256 hash: {hashlib.sha256(der).hexdigest().upper()}\n'
+                            f'SHA-1 hash: {sha1}\n{ssl.DER_cert_to_PEM_cert(der)}')
+    with open('find-identity.txt', 'w') as f:
+        for number, (sha1, name) in enumerate(identities, start=1):
+            f.write(f'  {number}) {sha1} "{name}"\n')
+        f.write(f'     {len(identities)} valid identities found\n')
+    with open('find-certificate.txt', 'w') as f:
+        f.write(''.join(certificates))
+
+
+if __name__ == '__main__':
+    main()
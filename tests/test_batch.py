@@ -0,0 +1,83 @@
+import configparser
+import json
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import make_config
+
+
+@pytest.fixture
+def toolchain(stub_bin):
+    for name in ('codesign', 'productbuild', 'xcrun'):
+        stub_bin(name)
+
+
+def write_ini(workdir, name, binary=None):
+    """a configuration for package `name` that signs the file `binary` (default: `name`)"""
+    binary = binary or name
+    (workdir / binary).write_bytes(f'{binary}\n'.encode())
+    config = make_config(package_name=name, notarize_timer=0.01, notarize_max_interval=0.02)
+    config['package_details']['file_list'] = binary
+    parser = configparser.ConfigParser()
+    parser.read_dict(config)
+    with open(workdir / f'{name}.ini', 'w') as f:
+        parser.write(f)
+
+
+def calls(tmp_path):
+    with open(tmp_path / 'calls.log') as f:
+        return [c[0] if c[0] != 'xcrun' else ' '.join(c[1:3]) for c in map(json.loads, f)]
+
+
+def statuses(results):
+    return {r['name']: {s: e['status'] for s, e in r['stages'].items()} for r in results}
+
+
+def test_batch_runs_every_stage(toolchain, workdir, tmp_path, capsys):
+    write_ini(workdir, 'alpha')
+    write_ini(workdir, 'beta')
+    (workdir / 'broken.ini').write_text('[main]\n')
+    results = pycodesign.batch_main(['*.ini', 'alpha.ini', '--sign-jobs', '2'])
+    out = capsys.readouterr().out
+    assert 'skipping invalid configuration file: broken.ini' in out
+    # alpha.ini is only run once although two arguments name it
+    assert [r['name'] for r in results] == ['alpha', 'beta']
+    ok = {'sign': 'ok', 'package': 'ok', 'notarize': 'ok', 'staple': 'ok'}
+    assert statuses(results) == {'alpha': ok, 'beta': ok}
+    assert 'processed 2 packages in' in out
+    assert [line.split()[0] for line in out.splitlines() if line.startswith(('package', 'alpha ', 'beta '))] == \
+        ['package', 'alpha', 'beta']
+    done = calls(tmp_path)
+    assert done.count('codesign') == 2 and done.count('notarytool submit') == 2 and done.count('stapler staple') == 2
+    assert (workdir / 'alpha.pkg').read_text().endswith('STAPLED\n')
+    # the journals let the next batch skip the finished packages
+    results = pycodesign.batch_main(['alpha.ini', 'beta.ini'])
+    assert statuses(results)['beta'] == dict.fromkeys(ok, 'done')
+    assert len(calls(tmp_path)) == len(done)
+
+
+def test_failed_stage_skips_the_rest_of_its_package(toolchain, workdir, tmp_path):
+    write_ini(workdir, 'alpha')
+    write_ini(workdir, 'beta', binary='bad-beta')
+    results = pycodesign.batch_main(['alpha.ini', 'beta.ini'])
+    assert statuses(results) == {
+        'alpha': {'sign': 'ok', 'package': 'ok', 'notarize': 'ok', 'staple': 'ok'},
+        'beta': {'sign': 'failed', 'package': 'skipped', 'notarize': 'skipped', 'staple': 'skipped'},
+    }
+    assert not (workdir / 'beta.pkg').exists()
+    assert calls(tmp_path).count('productbuild') == 1
+
+
+def test_selected_stages(toolchain, workdir, tmp_path, capsys):
+    write_ini(workdir, 'alpha')
+    results = pycodesign.batch_main(['alpha.ini', '--stages', 'sign, package'])
+    assert statuses(results) == {'alpha': {'sign': 'ok', 'package': 'ok'}}
+    assert calls(tmp_path) == ['codesign', 'productbuild']
+    # the summary table only has columns for the stages that ran
+    assert [line.split() for line in capsys.readouterr().out.splitlines() if line.startswith('package')] == \
+        [['package', 'sign', 'package', 'total']]
+    assert pycodesign.batch_main(['alpha.ini', '--stages', 'sign,upload']) == []
+    assert 'unknown stages: upload' in capsys.readouterr().out
+    assert pycodesign.batch_main(['missing.ini']) == []
+    assert 'no usable configuration files provided' in capsys.readouterr().out
@@ -0,0 +1,99 @@
+import os
+import time
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import make_config
+
+HOUR_AGO = time.time() - 3600
+
+
+@pytest.fixture
+def dist(workdir):
+    """dist/ with libraries at several depths; every directory looks an hour old"""
+    files = ['dist/tool/bin/tool', 'dist/tool/lib/a.dylib', 'dist/tool/lib/deep/b.dylib',
+             'dist/c.dylib', 'dist/tool/lib/notes.txt', 'dist/tool/lib/__pycache__/x.pyc']
+    for file in files:
+        (workdir / file).parent.mkdir(parents=True, exist_ok=True)
+        (workdir / file).write_bytes(b'x')
+    age(workdir / 'dist')
+    return workdir / 'dist'
+
+
+def age(root):
+    for directory, dirs, files in os.walk(root):
+        os.utime(directory, (HOUR_AGO, HOUR_AGO))
+
+
+def expand(entries, index):
+    return pycodesign.expand_file_list(entries, index)[1]
+
+
+def test_double_star_patterns(dist, tmp_path):
+    index = pycodesign.TreeIndex(tmp_path / 'index.json')
+    assert expand(['dist/**/*.dylib'], index) == {
+        'dist/c.dylib': 'c.dylib',
+        'dist/tool/lib/a.dylib': 'tool/lib/a.dylib',
+        'dist/tool/lib/deep/b.dylib': 'tool/lib/deep/b.dylib',
+    }
+    # * stays within one component
+    assert expand(['dist/*/lib/*.dylib'], index) == {'dist/tool/lib/a.dylib': 'tool/lib/a.dylib'}
+    # a matching directory takes everything in it along
+    assert expand(['dist/**/lib'], index) == {'dist/tool/lib': 'tool/lib'}
+    assert expand(['dist/tool/lib/**', '!*.txt', '!__pycache__'], index) == {
+        'dist/tool/lib/a.dylib': 'a.dylib',
+        'dist/tool/lib/deep': 'deep',
+    }
+
+
+def test_pattern_without_matches(dist, tmp_path, caplog):
+    index = pycodesign.TreeIndex(tmp_path / 'index.json')
+    paths, names = pycodesign.expand_file_list(['dist/**/*.framework'], index)
+    assert paths == [] and names == {}
+    assert 'no files match dist/**/*.framework' in caplog.text
+    paths, names = pycodesign.expand_file_list(['missing/*.dylib'], index)
+    assert paths == []
+    assert 'missing is not a directory' in caplog.text
+
+
+def test_index_is_reused_until_a_directory_changes(dist, tmp_path):
+    index_file = tmp_path / 'index.json'
+    index = pycodesign.TreeIndex(index_file)
+    before = expand(['dist/**/*.dylib'], index)
+    index.save()
+    assert index.run_stats == {'hits': 0, 'misses': 6}
+
+    index = pycodesign.TreeIndex(index_file)
+    assert expand(['dist/**/*.dylib'], index) == before
+    assert index.run_stats == {'hits': 6, 'misses': 0}
+
+    # adding or removing a file changes the mtime of its directory only
+    (dist / 'tool' / 'lib' / 'deep' / 'new.dylib').write_bytes(b'x')
+    (dist / 'c.dylib').unlink()
+    index = pycodesign.TreeIndex(index_file)
+    after = expand(['dist/**/*.dylib'], index)
+    assert 'dist/tool/lib/deep/new.dylib' in after
+    assert 'dist/c.dylib' not in after
+    assert index.run_stats == {'hits': 4, 'misses': 2}
+
+
+def test_recent_listings_are_not_kept(dist, tmp_path):
+    # a change within the timestamp resolution of the filesystem can keep the old mtime
+    deep = dist / 'tool' / 'lib' / 'deep'
+    now = time.time()
+    os.utime(deep, (now, now))
+    index = pycodesign.TreeIndex(tmp_path / 'index.json')
+    assert 'dist/tool/lib/deep/b.dylib' in expand(['dist/**/*.dylib'], index)
+    (deep / 'same-second.dylib').write_bytes(b'x')
+    os.utime(deep, (now, now))
+    assert 'dist/tool/lib/deep/same-second.dylib' in expand(['dist/**/*.dylib'], index)
+
+
+def test_split_file_list_expands_with_the_index(dist, tmp_path):
+    config = make_config(tree_index=str(tmp_path / 'index.json'))
+    config['package_details']['file_list'] = 'dist/tool/bin/tool,\n dist/**/*.dylib, !b.dylib'
+    file_list = pycodesign.split_file_list(config)['package_details']['file_list']
+    assert file_list == ['dist/tool/bin/tool', 'dist/c.dylib', 'dist/tool/lib/a.dylib']
+    assert config['package_details']['staging_names']['dist/tool/lib/a.dylib'] == 'tool/lib/a.dylib'
+    assert (tmp_path / 'index.json').exists()
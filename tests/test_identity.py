@@ -0,0 +1,141 @@
+import base64
+import calendar
+import json
+import re
+import shutil
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import FIXTURES, make_config
+
+# SHA-1 of the certificates in fixtures/security
+APPLICATION_OLD = '4780293E76391604C4734283717E7932099584F2'
+APPLICATION_RENEWED = '233826B829B8596C49A480793B69DDB1FFDE1E5F'
+INSTALLER = '9B59FE931E89029F6EA22F29D0C3540F1F1B277D'
+DEVELOPMENT = '6F207319EF21DCBAEDF383A0976A2FB9621D130E'
+
+
+@pytest.fixture(autouse=True)
+def fresh_process(monkeypatch):
+    """identities are looked up once per process; start every test without them"""
+    monkeypatch.setattr(pycodesign, '_keychain_identities', None)
+    monkeypatch.setattr(pycodesign, '_signing_identities', {})
+
+
+@pytest.fixture
+def security(stub_bin, monkeypatch):
+    monkeypatch.setenv('FAKE_SECURITY_FIXTURES', str(FIXTURES / 'security'))
+    return stub_bin('security')
+
+
+def security_calls(tmp_path):
+    try:
+        with open(tmp_path / 'calls.log') as f:
+            return [c[1] for c in map(json.loads, f) if c[0] == 'security']
+    except FileNotFoundError:
+        return []
+
+
+def certificates():
+    text = (FIXTURES / 'security' / 'find-certificate.txt').read_bytes()
+    return {sha1.decode(): base64.b64decode(pem) for sha1, pem in
+            re.findall(rb'SHA-1 hash: ([0-9A-F]{40})\s+-----BEGIN CERTIFICATE-----(.*?)-----END', text, re.S)}
+
+
+def utc(*date):
+    return calendar.timegm(date + (0,) * (6 - len(date)))
+
+
+def config(**main):
+    return make_config(resolve_identity='yes', **main)
+
+
+def test_find_identity_output(security, tmp_path):
+    identities = pycodesign.keychain_identities({})
+    assert identities == {
+        APPLICATION_OLD: 'Developer ID Application: Example (TEAM123456)',
+        APPLICATION_RENEWED: 'Developer ID Application: Example (TEAM123456)',
+        INSTALLER: 'Developer ID Installer: Example (TEAM123456)',
+        DEVELOPMENT: 'Apple Development: Jane Doe (DEV9876543)',
+    }
+    assert pycodesign.keychain_identities({}) is identities
+    assert security_calls(tmp_path) == ['find-identity']
+
+
+def test_certificate_not_after():
+    der = certificates()
+    # version 3 certificates with a UTCTime and a GeneralizedTime notAfter
+    assert pycodesign.certificate_not_after(der[APPLICATION_OLD]) == utc(2027, 1, 1)
+    assert pycodesign.certificate_not_after(der[APPLICATION_RENEWED]) == utc(2055, 6, 30, 12)
+    # a version 1 certificate has no [0] version field
+    assert pycodesign.certificate_not_after(der[DEVELOPMENT]) == utc(2030, 1, 1)
+
+
+def test_certificate_expiry(security):
+    assert pycodesign.certificate_expiry({}, 'Developer ID Application') == {
+        APPLICATION_OLD: utc(2027, 1, 1), APPLICATION_RENEWED: utc(2055, 6, 30, 12)}
+
+
+def test_unreadable_certificate(security, tmp_path, monkeypatch, caplog):
+    fixtures = tmp_path / 'security'
+    shutil.copytree(FIXTURES / 'security', fixtures)
+    text = (fixtures / 'find-certificate.txt').read_text()
+    # cut the DER of the first certificate short
+    start = text.index('-----BEGIN CERTIFICATE-----\n') + len('-----BEGIN CERTIFICATE-----\n')
+    (fixtures / 'find-certificate.txt').write_text(text[:start] + text[start + 640:])
+    monkeypatch.setenv('FAKE_SECURITY_FIXTURES', str(fixtures))
+    expiry = pycodesign.certificate_expiry({}, 'Developer ID Application')
+    assert expiry == {APPLICATION_RENEWED: utc(2055, 6, 30, 12)}
+    assert f'could not read the certificate {APPLICATION_OLD}' in caplog.text
+
+
+def test_resolve_identity(security, caplog):
+    # the renewed certificate has the same name and is valid longest
+    assert pycodesign.resolve_identity({}, 'TEAM123456')['sha1'] == APPLICATION_RENEWED
+    # installer certificates only match installer_id and the other way round
+    assert pycodesign.resolve_identity({}, 'TEAM123456', installer=True)['sha1'] == INSTALLER
+    assert pycodesign.resolve_identity({}, 'Jane Doe')['not_after'] == utc(2030, 1, 1)
+    assert pycodesign.resolve_identity({}, APPLICATION_OLD.lower())['sha1'] == APPLICATION_OLD
+    assert pycodesign.resolve_identity({}, 'Nobody') is None
+    assert 'no valid signing identity matches "Nobody"' in caplog.text
+    assert pycodesign.resolve_identity({}, 'e (') is None
+    assert '"e (" matches several signing identities' in caplog.text
+
+
+def test_signing_identity_is_cached(security, tmp_path, monkeypatch):
+    identity_cache = tmp_path / 'identities.json'
+    assert pycodesign.signing_identity(config(identity_cache=str(identity_cache)), 'application_id') == APPLICATION_RENEWED
+    assert pycodesign.signing_identity(config(identity_cache=str(identity_cache)), 'installer_id') == INSTALLER
+    assert security_calls(tmp_path) == ['find-identity', 'find-certificate', 'find-certificate']
+    cached = json.loads(identity_cache.read_text())['identities']
+    assert cached['application_id Developer ID Application: Example (TEAM123456)']['sha1'] == APPLICATION_RENEWED
+
+    # the next process reads the identity cache instead of the keychain
+    monkeypatch.setattr(pycodesign, '_keychain_identities', None)
+    monkeypatch.setattr(pycodesign, '_signing_identities', {})
+    assert pycodesign.signing_identity(config(identity_cache=str(identity_cache)), 'application_id') == APPLICATION_RENEWED
+    assert len(security_calls(tmp_path)) == 3
+
+    # until identity_ttl has passed
+    monkeypatch.setattr(pycodesign, '_signing_identities', {})
+    assert pycodesign.signing_identity(config(identity_cache=str(identity_cache), identity_ttl=0), 'application_id') == APPLICATION_RENEWED
+    assert len(security_calls(tmp_path)) == 5
+
+
+def test_expiring_identity_warns(security, tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(pycodesign.time, 'time', lambda: utc(2030, 2, 15))
+    identity = pycodesign.signing_identity(config(identity_cache=str(tmp_path / 'identities.json')), 'installer_id')
+    assert identity == INSTALLER
+    assert 'Developer ID Installer: Example (TEAM123456) expires on' in caplog.text
+
+
+def test_identity_used_as_given(tmp_path, monkeypatch):
+    # no `security` on PATH, resolving turned off or a SHA-1 already
+    monkeypatch.setenv('PATH', str(tmp_path / 'empty'))
+    value = 'Developer ID Application: Example (TEAM123456)'
+    assert pycodesign.signing_identity(config(identity_cache=str(tmp_path / 'i.json')), 'application_id') == value
+    assert pycodesign.signing_identity(make_config(), 'application_id') == value
+    sha1_config = config()
+    sha1_config['identification']['application_id'] = APPLICATION_OLD
+    assert pycodesign.signing_identity(sha1_config, 'application_id') == APPLICATION_OLD
@@ -0,0 +1,77 @@
+import json
+import os
+import shutil
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import FIXTURES
+
+SIGN_ARGS = ['codesign', '--force', '--timestamp', '--options=runtime', '--sign', 'TEAM123456']
+
+APP = 'Tool.app/Contents'
+HELPER = f'{APP}/Frameworks/Helper.framework'
+INNER = f'{HELPER}/Versions/A/Frameworks/Inner.framework'
+LIBZ = f'{HELPER}/Versions/A/Libraries/libz.1.dylib'
+LIBHELPER = f'{APP}/Frameworks/libhelper.dylib'
+CLI = f'{APP}/MacOS/tool-cli'
+EXT = f'{APP}/PlugIns/Ext.bundle'
+
+
+@pytest.fixture
+def app(workdir):
+    """Tool.app with a framework nested in a framework, a plug-in and libraries that load each other
+
+    tool-cli loads @rpath/libhelper.dylib, which loads libz.1.dylib"""
+    samples = {
+        f'{APP}/MacOS/Tool': 'thin_x86_64',
+        CLI: 'thin_x86_64',
+        LIBHELPER: 'thin_arm64.dylib',
+        f'{HELPER}/Versions/A/Helper': 'thin_arm64.dylib',
+        LIBZ: 'fat.dylib',
+        f'{INNER}/Versions/A/Inner': 'fat.dylib',
+        f'{EXT}/Contents/MacOS/Ext': 'thin_i386.bundle',
+        f'{APP}/Resources/run.sh': 'script.sh',
+    }
+    for path, sample in samples.items():
+        (workdir / path).parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy(FIXTURES / 'macho' / sample, workdir / path)
+    os.symlink('A', workdir / HELPER / 'Versions' / 'Current')
+    os.symlink('Versions/Current/Helper', workdir / HELPER / 'Helper')
+    return 'Tool.app'
+
+
+def test_innermost_code_comes_first(app):
+    plan = pycodesign.plan_signing([app])
+    assert [sorted(level) for level in plan] == [
+        sorted([INNER, LIBZ, EXT]),
+        sorted([LIBHELPER, HELPER]),
+        [CLI],
+        ['Tool.app'],
+    ]
+
+
+def test_every_item_follows_what_it_contains(app):
+    plan = pycodesign.plan_signing([app])
+    level = {item: number for number, items in enumerate(plan) for item in items}
+    for item in level:
+        for other in level:
+            if other != item and other.startswith(item + '/'):
+                assert level[other] < level[item], f'{other} must be signed before {item}'
+    # main executables and files that are not Mach-O are signed with their bundle or not at all
+    assert f'{APP}/MacOS/Tool' not in level
+    assert f'{HELPER}/Versions/A/Helper' not in level
+    assert f'{APP}/Resources/run.sh' not in level
+
+
+def test_sign_inside_out_runs_level_by_level(app, stub_bin, tmp_path):
+    stub_bin('codesign')
+    results = pycodesign.sign_inside_out([app], SIGN_ARGS, jobs=3)
+    assert all(r['return_code'] == 0 for r in results)
+    with open(tmp_path / 'calls.log') as f:
+        signed = [call[-1] for call in map(json.loads, f)]
+    plan = pycodesign.plan_signing([app])
+    level = {item: number for number, items in enumerate(plan) for item in items}
+    assert sorted(signed) == sorted(level)
+    assert [level[s] for s in signed] == sorted(level[s] for s in signed)
+    assert signed[-1] == 'Tool.app'
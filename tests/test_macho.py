@@ -0,0 +1,82 @@
+import shutil
+
+import pycodesign_core as pycodesign
+
+# samples are written by fixtures/macho/make_samples.py
+SAMPLES = ('thin_x86_64', 'thin_arm64.dylib', 'thin_i386.bundle', 'fat.dylib', 'Hello.class',
+           'truncated', 'script.sh')
+
+
+def scan(fixtures, name):
+    return pycodesign.scan_macho(str(fixtures / 'macho' / name))
+
+
+def test_thin_executable(fixtures):
+    result = scan(fixtures, 'thin_x86_64')
+    assert result['macho'] and not result['fat'] and result['error'] is None
+    assert result['archs'] == ['x86_64']
+    assert result['filetype'] == 'execute'
+    assert result['signed']
+    assert result['dylibs'] == ['/usr/lib/libSystem.B.dylib', '@rpath/libhelper.dylib']
+    assert result['rpaths'] == ['@executable_path/../lib']
+
+
+def test_thin_dylib(fixtures):
+    result = scan(fixtures, 'thin_arm64.dylib')
+    assert result['archs'] == ['arm64']
+    assert result['filetype'] == 'dylib'
+    assert result['install_name'] == '@rpath/libhelper.dylib'
+    assert result['dylibs'] == ['/opt/local/lib/libz.1.dylib']
+    assert not result['signed']
+
+
+def test_thin_32_bit(fixtures):
+    result = scan(fixtures, 'thin_i386.bundle')
+    assert result['archs'] == ['i386']
+    assert result['filetype'] == 'bundle'
+    assert result['signed']
+
+
+def test_fat(fixtures):
+    result = scan(fixtures, 'fat.dylib')
+    assert result['macho'] and result['fat']
+    assert result['archs'] == ['x86_64', 'arm64']
+    # only the x86_64 slice carries LC_CODE_SIGNATURE
+    assert not result['signed']
+    assert result['dylibs'] == ['/opt/local/lib/libz.1.dylib']
+
+
+def test_java_class_is_not_fat(fixtures):
+    result = scan(fixtures, 'Hello.class')
+    assert not result['macho'] and result['error'] is None
+
+
+def test_not_macho(fixtures):
+    assert not scan(fixtures, 'script.sh')['macho']
+    assert not pycodesign.scan_macho(str(fixtures / 'missing'))['macho']
+
+
+def test_truncated(fixtures):
+    result = scan(fixtures, 'truncated')
+    assert result['macho']
+    assert result['error']
+
+
+def test_scan_tree_and_warnings(fixtures, tmp_path):
+    # copy only the samples; running make_samples.py leaves a __pycache__ next to them
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    for name in SAMPLES:
+        shutil.copy2(fixtures / 'macho' / name, tree / name)
+    scanned = pycodesign.scan_tree([str(tree)], jobs=2)
+    assert sorted(scanned) == sorted(str(tree / n) for n in SAMPLES)
+    machos = {p for p, r in scanned.items() if r['macho']}
+    assert {str(tree / n) for n in ('thin_x86_64', 'fat.dylib', 'truncated')} <= machos
+    assert str(tree / 'Hello.class') not in machos
+
+    warnings = pycodesign.check_binaries(scanned, listed=[str(tree / 'script.sh')])
+    text = '\n'.join(warnings)
+    assert 'script.sh is not a Mach-O binary' in text
+    assert 'truncated could not be read as Mach-O' in text
+    assert 'loads /opt/local/lib/libz.1.dylib' in text
+    assert 'thin_i386.bundle is missing architectures' in text
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import make_config
+
+
+@pytest.fixture
+def tools(stub_bin, workdir):
+    stub_bin('productbuild')
+    stub_bin('xcrun')
+    (workdir / 'tool').write_bytes(b'tool\n')
+    os.chmod(workdir / 'tool', 0o755)
+    (workdir / 'lib').mkdir()
+    (workdir / 'lib' / 'libtool.1.dylib').write_bytes(b'lib\n')
+    os.chmod(workdir / 'lib' / 'libtool.1.dylib', 0o644)
+    os.symlink('libtool.1.dylib', workdir / 'lib' / 'libtool.dylib')
+
+
+def digests(path):
+    data = path.read_bytes()
+    return {'sha256': hashlib.sha256(data).hexdigest(), 'blake2b': hashlib.blake2b(data).hexdigest()}
+
+
+def package(config):
+    return_code, stdout, stderr = pycodesign.package(config)
+    assert return_code == 0, stderr
+
+
+def test_manifest_lists_package_and_payload(tools, workdir, capsys):
+    config = make_config(file_list=('tool', 'lib'), digests='sha256, blake2b, md4, nope')
+    package(config)
+    assert 'wrote integrity manifest tool.manifest.json' in capsys.readouterr().out
+    manifest = json.loads(pycodesign.manifest_file(config).read_text())
+    assert manifest['package'] == {'name': 'tool.pkg', 'size': (workdir / 'tool.pkg').stat().st_size,
+                                   **digests(workdir / 'tool.pkg')}
+    assert manifest['version'] == config['package_details']['version']
+    assert manifest['files'] == {
+        '/usr/local/bin/tool': {'size': 5, 'mode': '755', **digests(workdir / 'tool')},
+        '/usr/local/bin/lib/libtool.1.dylib': {'size': 4, 'mode': '644', **digests(workdir / 'lib' / 'libtool.1.dylib')},
+        # directories are left out, links inside them are kept as links
+        '/usr/local/bin/lib/libtool.dylib': {'link': 'libtool.1.dylib'},
+    }
+
+
+def test_staple_updates_package_digests(tools, workdir):
+    config = make_config(digests='sha256, blake2b')
+    package(config)
+    before = json.loads(pycodesign.manifest_file(config).read_text())
+    assert pycodesign.staple(config)[0] == 0
+    after = json.loads(pycodesign.manifest_file(config).read_text())
+    assert after['package'] == {'name': 'tool.pkg', 'size': (workdir / 'tool.pkg').stat().st_size,
+                                **digests(workdir / 'tool.pkg')}
+    assert after['package'] != before['package']
+    assert after['files'] == before['files']
+    # the build record follows the stapled package too
+    build = json.loads(pycodesign.staging_paths(config)[1].read_text())
+    assert build['pkg_sha256'] == after['package']['sha256']
+
+
+def test_update_without_manifest(tools, workdir):
+    config = make_config(manifest='no')
+    package(config)
+    assert not pycodesign.manifest_file(config).exists()
+    (workdir / 'tool.pkg').write_bytes(b'stapled\n')
+    pycodesign.update_manifest_package(config)
+    assert not pycodesign.manifest_file(config).exists()
+    build = json.loads(pycodesign.staging_paths(config)[1].read_text())
+    assert build['pkg_sha256'] == hashlib.sha256(b'stapled\n').hexdigest()
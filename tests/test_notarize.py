@@ -0,0 +1,90 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import make_config
+
+
+@pytest.fixture
+def xcrun(stub_bin, workdir):
+    stub_bin('xcrun')
+    (workdir / 'tool.pkg').write_bytes(b'package')
+
+
+def config(**main):
+    return make_config(notarize_timer=0.01, notarize_max_interval=0.02, **main)
+
+
+def calls(tmp_path, command):
+    with open(tmp_path / 'calls.log') as f:
+        return [c for c in map(json.loads, f) if c[1:3] == ['notarytool', command]]
+
+
+def test_poll_until_accepted(xcrun, monkeypatch, tmp_path):
+    monkeypatch.setenv('FAKE_NOTARY_STATES', 'In Progress,In Progress,Accepted')
+    status, info = asyncio.run(pycodesign.poll_notarization(config(), 'abc'))
+    assert status == 'Accepted'
+    assert info['id'] == 'abc'
+    assert len(calls(tmp_path, 'info')) == 3
+
+
+def test_poll_deadline(xcrun, monkeypatch, tmp_path):
+    monkeypatch.setenv('FAKE_NOTARY_STATES', 'In Progress')
+    status, info = asyncio.run(pycodesign.poll_notarization(config(notarize_timeout=0.1), 'abc'))
+    assert status == 'Timeout'
+    assert info['status'] == 'In Progress'
+
+
+def test_notarize_accepted(xcrun, monkeypatch, tmp_path, workdir):
+    monkeypatch.setenv('FAKE_NOTARY_STATES', 'In Progress,Accepted')
+    submitted = []
+    return_code, stdout, stderr = pycodesign.notarize(config(), on_submit=submitted.append)
+    assert return_code == 0
+    assert json.loads(stdout)['status'] == 'Accepted'
+    [submit] = calls(tmp_path, 'submit')
+    assert '--wait' not in submit
+    assert submitted == [json.loads((workdir / 'tool.submission.json').read_text())['id']]
+    assert not (workdir / 'tool.issues.json').exists()
+
+
+def test_notarize_invalid(xcrun, monkeypatch, workdir):
+    monkeypatch.setenv('FAKE_NOTARY_STATES', 'In Progress,Invalid')
+    return_code, stdout, stderr = pycodesign.notarize(config())
+    assert return_code == 1
+    assert json.loads(stdout)['status'] == 'Invalid'
+    issues = json.loads((workdir / 'tool.issues.json').read_text())
+    assert issues['status'] == 'Invalid'
+
+
+def test_accepted_package_is_not_uploaded_again(xcrun, tmp_path):
+    assert pycodesign.notarize(config())[0] == 0
+    assert pycodesign.notarize(config())[0] == 0
+    assert len(calls(tmp_path, 'submit')) == 1
+    # --fresh always uploads
+    assert pycodesign.notarize(config(fresh=True))[0] == 0
+    assert len(calls(tmp_path, 'submit')) == 2
+
+
+def test_wait_for_existing_submission(xcrun, tmp_path):
+    return_code, stdout, stderr = pycodesign.notarize(config(), submission_id='earlier')
+    assert return_code == 0
+    assert calls(tmp_path, 'submit') == []
+    assert calls(tmp_path, 'info')[0][3] == 'earlier'
+
+
+def test_batch_tracks_submissions_concurrently(xcrun, monkeypatch, tmp_path, workdir):
+    monkeypatch.setenv('FAKE_NOTARY_STATES', 'In Progress,In Progress,Accepted')
+    for name in ('one', 'two', 'three'):
+        (workdir / f'{name}.pkg').write_bytes(name.encode())
+
+    async def run():
+        configs = [make_config(package_name=n, notarize_timer=0.01, notarize_max_interval=0.02)
+                   for n in ('one', 'two', 'three')]
+        return await asyncio.gather(*[pycodesign.notarize_async(c) for c in configs])
+
+    assert [r[0] for r in asyncio.run(run())] == [0, 0, 0]
+    assert len(calls(tmp_path, 'submit')) == 3
+    assert len(calls(tmp_path, 'info')) == 9
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import FIXTURES, make_config
+
+
+@pytest.fixture
+def invalid_log():
+    return pycodesign.NotaryLog(json.loads((FIXTURES / 'notarytool' / 'log-invalid.json').read_text()))
+
+
+@pytest.fixture
+def config(workdir):
+    """the payload the log refers to: tool.pkg/Payload/usr/local/bin/tool/..."""
+    (workdir / 'tool' / 'lib').mkdir(parents=True)
+    (workdir / 'tool' / 'tool').write_bytes(b'tool\n')
+    (workdir / 'tool' / 'lib' / 'libfoo.dylib').write_bytes(b'lib\n')
+    return make_config()
+
+
+def test_invalid_log_is_indexed(config, invalid_log, workdir, capsys):
+    pycodesign.record_notary_issues(config, invalid_log.id, 'Invalid', invalid_log)
+    assert 'notarization Invalid: 3 issues in 2 files' in capsys.readouterr().out
+    index = json.loads(pycodesign.issues_file(config).read_text())
+    # the log has no issue codes
+    assert index['by_code'] == {'unknown': ['tool/lib/libfoo.dylib', 'tool/tool']}
+    assert [i['architecture'] for i in index['by_path']['tool/lib/libfoo.dylib']] == ['x86_64', 'arm64']
+    assert index['by_path']['tool/tool'][0]['log_path'] == 'tool.pkg/Payload/usr/local/bin/tool/tool'
+    assert json.loads(pycodesign.notary_log_file(config).read_text())['jobId'] == invalid_log.id
+
+
+def test_files_with_errors_are_resigned(config, invalid_log):
+    pycodesign.record_notary_issues(config, invalid_log.id, 'Invalid', invalid_log)
+    # warnings alone do not flag a file
+    assert pycodesign.flagged_files(config) == ['tool/lib/libfoo.dylib']
+    assert pycodesign.flagged_files(make_config(resign_flagged='no')) == []
+    assert pycodesign.flagged_files(make_config(fresh=True)) == []
+    pycodesign.mark_flagged_resigned(config)
+    assert pycodesign.flagged_files(config) == []
+
+
+def test_accepted_log_flags_nothing(config, invalid_log):
+    pycodesign.record_notary_issues(config, invalid_log.id, 'Accepted', invalid_log)
+    assert pycodesign.flagged_files(config) == []
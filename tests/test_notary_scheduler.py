@@ -0,0 +1,126 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import ROOT, make_config
+
+# holds a slot for a while and writes when it had it; argv: state file, output file, name
+HOLD_SLOT = '''
+import json, sys, time
+import pycodesign_core
+scheduler = pycodesign_core.NotaryScheduler(sys.argv[1], rate=600, burst=5, max_in_flight=1)
+ticket = scheduler.acquire(name=sys.argv[3])
+start = time.time()
+time.sleep(0.6)
+end = time.time()
+scheduler.release(ticket)
+with open(sys.argv[2], 'w') as f:
+    json.dump([start, end], f)
+'''
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(pycodesign.time, 'time', lambda: now[0])
+    return now
+
+
+def test_bucket_refills_at_the_rate(tmp_path, clock):
+    # 6 uploads per minute is one every 10 seconds
+    scheduler = pycodesign.NotaryScheduler(tmp_path / 'scheduler.json', rate=6, burst=3)
+    with scheduler.state() as state:
+        assert state['tokens'] == 3
+        state['tokens'] = 0
+    clock[0] += 10
+    with scheduler.state() as state:
+        assert state['tokens'] == pytest.approx(1)
+    clock[0] += 5
+    with scheduler.state() as state:
+        assert state['tokens'] == pytest.approx(1.5)
+    # never more than a burst
+    clock[0] += 3600
+    with scheduler.state() as state:
+        assert state['tokens'] == 3
+
+
+def test_empty_bucket_waits_for_a_token(tmp_path, monkeypatch):
+    naps = []
+    monkeypatch.setattr(pycodesign, 'sleep', naps.append)
+    # 60 per minute is one per second; the burst of one is used right away
+    scheduler = pycodesign.NotaryScheduler(tmp_path / 'scheduler.json', rate=60, burst=1)
+    scheduler.release(scheduler.acquire(name='one.pkg'))
+    assert naps == []
+    with scheduler.state() as state:
+        # an hour has passed, but the bucket holds at most one token
+        state['updated'] -= 3600
+        state['tokens'] = 0
+    scheduler.release(scheduler.acquire(name='two.pkg'))
+    assert naps == []
+    with scheduler.state() as state:
+        state['tokens'] = 0
+    start = time.monotonic()
+    monkeypatch.setattr(pycodesign, 'sleep', lambda s: (naps.append(s), time.sleep(s)))
+    scheduler.release(scheduler.acquire(name='three.pkg'))
+    assert naps and time.monotonic() - start >= 0.7
+
+
+def test_two_processes_take_turns(tmp_path):
+    state_file = tmp_path / 'scheduler.json'
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    processes = [subprocess.Popen([sys.executable, '-c', HOLD_SLOT, str(state_file), str(tmp_path / f'{n}.json'),
+                                   f'{n}.pkg'], env=env, stdout=subprocess.PIPE, text=True)
+                 for n in ('first', 'second')]
+    outputs = [p.communicate(timeout=30)[0] for p in processes]
+    assert [p.returncode for p in processes] == [0, 0]
+    (a_start, a_end), (b_start, b_end) = sorted(json.loads((tmp_path / f'{n}.json').read_text())
+                                                for n in ('first', 'second'))
+    # one slot: the second upload starts after the first one released it
+    assert b_start >= a_end
+    assert any('waiting to upload' in o and 'uploads in flight' in o for o in outputs)
+    state = json.loads(state_file.read_text())
+    assert state['in_flight'] == {} and state['queue'] == {}
+
+
+def test_entries_of_dead_processes_are_dropped(tmp_path):
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    scheduler = pycodesign.NotaryScheduler(tmp_path / 'scheduler.json', max_in_flight=1)
+    with scheduler.state() as state:
+        state['in_flight']['gone'] = {'pid': dead.pid, 'since': time.time(), 'name': 'gone.pkg'}
+    ticket = scheduler.acquire(name='tool.pkg')
+    with scheduler.state() as state:
+        assert list(state['in_flight']) == [ticket]
+
+
+def test_rate_limit_backs_off(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(pycodesign.random, 'uniform', lambda a, b: 1.0)
+    scheduler = pycodesign.NotaryScheduler(tmp_path / 'scheduler.json', backoff=30, max_backoff=100)
+    scheduler.report('limited')
+    assert scheduler.backoff_remaining() == 30
+    scheduler.report('limited')
+    scheduler.report('limited')
+    assert scheduler.backoff_remaining() == 100
+    clock[0] += 100
+    assert scheduler.backoff_remaining() == 0
+    scheduler.report('ok')
+    with scheduler.state() as state:
+        assert state['backoff'] == 50
+
+
+def test_default_and_opt_out(workdir, tmp_path, monkeypatch):
+    monkeypatch.setattr(pycodesign, '_notary_schedulers', {})
+    scheduler = pycodesign.get_notary_scheduler(make_config())
+    assert scheduler.path == tmp_path / 'home' / '.cache' / 'pycodesign' / 'notary-scheduler.json'
+    assert pycodesign.get_notary_scheduler(make_config()) is scheduler
+    assert pycodesign.get_notary_scheduler(make_config(notary_scheduler='no')) is None
+    # -N writes both settings
+    pycodesign.get_config(pycodesign.argparse.Namespace(config=None, new_config=True),
+                          pycodesign.EXPECTED_CONFIG_KEYS)
+    sample = (workdir / 'pycodesign.ini').read_text()
+    assert 'notary_scheduler = yes\nnotary_scheduler_file = ~/.cache/pycodesign/notary-scheduler.json\n' in sample
@@ -0,0 +1,134 @@
+import pytest
+
+import pycodesign_core as pycodesign
+
+
+def read(fixtures, name):
+    return (fixtures / name).read_bytes()
+
+
+def stream_lines(parser, data, stream):
+    """feed `data` to `parser.on_line` line by line as run_command() does"""
+    for line in data.splitlines(keepends=True):
+        parser.on_line('tool', stream, line)
+    return parser
+
+
+def test_submit(fixtures):
+    stream = stream_lines(pycodesign.JSONStream(), read(fixtures, 'notarytool/submit.json'), 'stdout')
+    submission = pycodesign.NotarySubmission(stream.document())
+    assert submission.id == '2efe2717-52ef-43a5-96dc-0797e4ca1041'
+    assert submission.message == 'Successfully uploaded file'
+    assert submission.raw['path'] == '/Users/builder/src/tool/tool.pkg'
+    assert submission.status is None
+
+
+@pytest.mark.parametrize('name, status', [('info-in-progress.json', 'In Progress'), ('info-invalid.json', 'Invalid')])
+def test_info(fixtures, name, status):
+    submission = pycodesign.NotarySubmission(pycodesign.parse_json_output(read(fixtures, f'notarytool/{name}')))
+    assert submission.status == status
+    assert submission.name == 'tool.pkg'
+    assert submission.created == '2023-11-01T12:00:03.118Z'
+
+
+def test_log_with_issues(fixtures):
+    stream = stream_lines(pycodesign.JSONStream(), read(fixtures, 'notarytool/log-invalid.json'), 'stdout')
+    log = pycodesign.NotaryLog(stream.document())
+    assert log.id == '2efe2717-52ef-43a5-96dc-0797e4ca1041'
+    assert log.status == 'Invalid'
+    assert log.summary == 'Archive contains critical validation errors'
+    assert [(i.severity, i.architecture) for i in log.issues] == [('error', 'x86_64'), ('error', 'arm64'),
+                                                                   ('warning', 'x86_64')]
+    assert log.issues[0].path == 'tool.pkg/Payload/usr/local/bin/tool/lib/libfoo.dylib'
+    assert log.issues[0].doc_url.endswith('#3087721')
+    assert log.issues[2].doc_url is None
+
+
+def test_log_without_issues(fixtures):
+    log = pycodesign.NotaryLog(pycodesign.parse_json_output(read(fixtures, 'notarytool/log-accepted.json')))
+    assert log.status == 'Accepted'
+    assert log.issues == []
+
+
+def test_result_objects_have_slots():
+    for result in (pycodesign.JSONStream(), pycodesign.NotarySubmission({}), pycodesign.NotaryIssue({}),
+                   pycodesign.NotaryLog({}), pycodesign.CodesignVerdict('x'), pycodesign.CodesignOutput([])):
+        assert not hasattr(result, '__dict__')
+
+
+def test_json_split_across_chunks():
+    stream = pycodesign.JSONStream()
+    for part in ('{"id": "a", "message": "braces } and ', '{ in \\"strings\\"", ', '"nested": {"list": [1, {"x": "]"}]}}'):
+        stream.feed(part)
+    assert stream.document() == {'id': 'a', 'message': 'braces } and { in "strings"',
+                                 'nested': {'list': [1, {'x': ']'}]}}
+
+
+def test_json_noise_and_several_documents():
+    stream = pycodesign.JSONStream()
+    stream.feed('Conducting pre-submission checks for tool.pkg...\n')
+    stream.feed('{"id": "first"}\n')
+    stream.feed('[1, 2, 3]\n')
+    stream.feed('{"id": "second"}\n')
+    assert len(stream.documents) == 3
+    # lists are skipped; the last object wins
+    assert stream.document() == {'id': 'second'}
+
+
+@pytest.mark.parametrize('text', [
+    '',
+    'Error: HTTP status code: 401. Invalid credentials.\n',
+    '{"id": "unterminated"\n',
+    '{"id": not json}\n',
+    '[]\n',
+])
+def test_json_malformed(text):
+    assert pycodesign.parse_json_output(text.encode()) == {}
+    submission = pycodesign.NotarySubmission(pycodesign.parse_json_output(text.encode()))
+    assert submission.id is None and submission.status is None
+
+
+def test_json_only_reads_stdout():
+    stream = pycodesign.JSONStream()
+    stream.on_line('xcrun', 'stderr', b'{"id": "from stderr"}\n')
+    assert stream.document() == {}
+
+
+def test_log_with_malformed_issues():
+    log = pycodesign.NotaryLog({'jobId': 'x', 'issues': ['not an issue', None, {'severity': 'error'}]})
+    assert [i.severity for i in log.issues] == ['error']
+    assert pycodesign.NotaryLog({}).issues == []
+
+
+SIGNED = ['dist/tool/tool', 'dist/tool/lib/libfoo.dylib', 'dist/tool/lib/odd: name.so', 'dist/Tool Helper.app']
+
+
+def test_codesign_signed(fixtures):
+    output = stream_lines(pycodesign.CodesignOutput(SIGNED), read(fixtures, 'codesign/sign.txt'), 'stderr')
+    assert output.failed() == []
+    assert all(output.verdicts[f].ok for f in SIGNED)
+    assert output.verdicts['dist/tool/lib/odd: name.so'].messages == ['signed Mach-O thin (arm64) [odd: name]']
+    assert output.other == []
+
+
+def test_codesign_failures(fixtures):
+    files = ['dist/tool/tool', 'dist/tool/lib/libbar.dylib', 'dist/Tool Helper.app', 'dist/tool/lib/unmentioned.so']
+    output = stream_lines(pycodesign.CodesignOutput(files), read(fixtures, 'codesign/sign-failed.txt'), 'stderr')
+    assert [v.path for v in output.failed()] == ['dist/tool/lib/libbar.dylib', 'dist/Tool Helper.app']
+    assert output.verdicts['dist/tool/lib/libbar.dylib'].messages == [
+        'replacing existing signature', 'main executable failed strict validation']
+    assert output.verdicts['dist/tool/tool'].ok is True
+    assert output.verdicts['dist/tool/lib/unmentioned.so'].ok is None
+    # lines that are not about one of the files
+    assert len(output.other) == 2
+    assert output.other[0].startswith('In subcomponent:')
+    assert 'ambiguous' in output.other[1]
+
+
+def test_codesign_ignores_stdout_and_blank_lines():
+    output = pycodesign.CodesignOutput(['tool'])
+    output.on_line('codesign', 'stdout', b'tool: main executable failed strict validation\n')
+    output.on_line('codesign', 'stderr', b'\n')
+    output.on_line('codesign', 'stderr', b'\xfftool: garbled\n')
+    assert output.verdicts['tool'].ok is None
+    assert len(output.other) == 1
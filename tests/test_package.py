@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import make_config
+
+
+@pytest.fixture
+def tools(stub_bin, workdir):
+    stub_bin('productbuild')
+    stub_bin('xcrun')
+    (workdir / 'tool').write_bytes(b'tool\n')
+    (workdir / 'helper').write_bytes(b'helper\n')
+
+
+def builds(tmp_path):
+    with open(tmp_path / 'calls.log') as f:
+        return [c for c in map(json.loads, f) if c[0] == 'productbuild']
+
+
+def package(config, capsys):
+    return_code, stdout, stderr = pycodesign.package(config)
+    assert return_code == 0, stderr
+    return capsys.readouterr().out
+
+
+def test_unchanged_inputs_are_not_packaged_again(tools, tmp_path, workdir, capsys):
+    config = make_config(file_list=('tool', 'helper'))
+    package(config, capsys)
+    built = (workdir / 'tool.pkg').read_text()
+    assert 'usr/local/bin/tool' in built and 'usr/local/bin/helper' in built
+    assert 'tool.pkg is up to date' in package(config, capsys)
+    assert len(builds(tmp_path)) == 1
+    assert (workdir / 'tool.pkg').read_text() == built
+
+
+def test_changed_file_is_staged_again(tools, tmp_path, workdir, capsys):
+    config = make_config(file_list=('tool', 'helper'))
+    package(config, capsys)
+    before = (workdir / 'tool.pkg').read_text()
+    (workdir / 'tool').unlink()
+    (workdir / 'tool').write_bytes(b'tool 2\n')
+    assert '1 staged paths added, changed or removed since the last build (2 in total)' in package(config, capsys)
+    assert len(builds(tmp_path)) == 2
+    after = (workdir / 'tool.pkg').read_text()
+    assert after != before
+    staging = pycodesign.staging_paths(config)[0]
+    assert (staging / 'usr/local/bin/tool').read_bytes() == b'tool 2\n'
+
+
+def test_removed_file_leaves_the_staging_directory(tools, tmp_path, workdir, capsys):
+    package(make_config(file_list=('tool', 'helper')), capsys)
+    config = make_config(file_list=('tool',))
+    assert '1 staged paths added, changed or removed since the last build (1 in total)' in package(config, capsys)
+    assert len(builds(tmp_path)) == 2
+    staging = pycodesign.staging_paths(config)[0]
+    assert not (staging / 'usr/local/bin/helper').exists()
+    assert 'helper' not in (workdir / 'tool.pkg').read_text()
+
+
+def test_stapled_package_is_current(tools, tmp_path, workdir, capsys):
+    config = make_config()
+    package(config, capsys)
+    assert pycodesign.staple(config)[0] == 0
+    stapled = (workdir / 'tool.pkg').read_bytes()
+    assert stapled.endswith(b'STAPLED\n')
+    # a standalone -p after a full run must keep the notarized, stapled package
+    assert 'tool.pkg is up to date' in package(config, capsys)
+    assert len(builds(tmp_path)) == 1
+    assert (workdir / 'tool.pkg').read_bytes() == stapled
+    manifest = json.loads(pycodesign.manifest_file(config).read_text())
+    assert manifest['package']['size'] == len(stapled)
@@ -0,0 +1,124 @@
+import configparser
+import json
+import sys
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import make_config
+
+
+@pytest.fixture
+def toolchain(stub_bin, workdir):
+    for name in ('codesign', 'productbuild', 'xcrun'):
+        stub_bin(name)
+    (workdir / 'tool').write_bytes(b'binary\n')
+
+
+def write_ini(path, **main):
+    config = make_config(notarize_timer=0.01, notarize_max_interval=0.02, **main)
+    config['package_details']['file_list'] = 'tool'
+    parser = configparser.ConfigParser()
+    parser.read_dict(config)
+    with open(path, 'w') as f:
+        parser.write(f)
+    return parser
+
+
+def run(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['pycodesign.py', *argv])
+    pycodesign.main()
+
+
+def calls(tmp_path):
+    """the tools called since the last call to calls()"""
+    try:
+        with open(tmp_path / 'calls.log') as f:
+            found = [c[0] if c[0] != 'xcrun' else ' '.join(c[1:3]) for c in map(json.loads, f)]
+    except FileNotFoundError:
+        return []
+    (tmp_path / 'calls.log').unlink()
+    return found
+
+
+def stages(workdir):
+    return {s: e['result'] for s, e in json.loads((workdir / 'tool.state.json').read_text())['stages'].items()}
+
+
+def test_complete_run_is_not_repeated(toolchain, monkeypatch, tmp_path, workdir, capsys):
+    write_ini(workdir / 'tool.ini')
+    run(monkeypatch, 'tool.ini')
+    assert calls(tmp_path) == ['codesign', 'productbuild', 'notarytool submit', 'notarytool info',
+                               'notarytool log', 'stapler staple']
+    assert stages(workdir) == {'sign': 'ok', 'package': 'ok', 'notarize': 'ok', 'staple': 'ok'}
+    capsys.readouterr()
+    run(monkeypatch, 'tool.ini')
+    assert 'every stage is complete according to' in capsys.readouterr().out
+    assert calls(tmp_path) == []
+    # --fresh runs every stage
+    run(monkeypatch, '--fresh', 'tool.ini')
+    assert 'codesign' in calls(tmp_path)
+
+
+def test_version_bump_packages_again(toolchain, monkeypatch, tmp_path, workdir, capsys):
+    write_ini(workdir / 'tool.ini')
+    run(monkeypatch, 'tool.ini')
+    calls(tmp_path)
+    parser = write_ini(workdir / 'tool.ini')
+    parser['package_details']['version'] = '1.1'
+    with open(workdir / 'tool.ini', 'w') as f:
+        parser.write(f)
+    capsys.readouterr()
+    run(monkeypatch, 'tool.ini')
+    assert 'resuming at the package stage' in capsys.readouterr().out
+    done = calls(tmp_path)
+    assert 'codesign' not in done
+    assert done[0] == 'productbuild'
+    assert done[-1] == 'stapler staple'
+
+
+def test_changed_input_is_signed_again(toolchain, monkeypatch, tmp_path, workdir):
+    write_ini(workdir / 'tool.ini')
+    run(monkeypatch, 'tool.ini')
+    calls(tmp_path)
+    (workdir / 'tool').write_bytes(b'binary 2\n')
+    run(monkeypatch, 'tool.ini')
+    assert calls(tmp_path)[:2] == ['codesign', 'productbuild']
+    assert stages(workdir)['staple'] == 'ok'
+
+
+def test_resume_after_failed_notarization(toolchain, monkeypatch, tmp_path, workdir, capsys):
+    # the first run gives up while Apple is still processing the upload
+    write_ini(workdir / 'tool.ini', notarize_timeout=0.05)
+    monkeypatch.setenv('FAKE_NOTARY_STATES', 'In Progress')
+    run(monkeypatch, 'tool.ini')
+    assert calls(tmp_path)[:3] == ['codesign', 'productbuild', 'notarytool submit']
+    state = json.loads((workdir / 'tool.state.json').read_text())['stages']
+    assert state['notarize']['result'] == 'submitted'
+    assert 'staple' not in state
+
+    # the next run polls the same submission instead of signing, packaging or uploading again
+    monkeypatch.setenv('FAKE_NOTARY_STATES', 'Accepted')
+    capsys.readouterr()
+    run(monkeypatch, 'tool.ini')
+    assert 'resuming at the notarize stage' in capsys.readouterr().out
+    assert calls(tmp_path) == ['notarytool info', 'notarytool log', 'stapler staple']
+    assert stages(workdir) == {'sign': 'ok', 'package': 'ok', 'notarize': 'ok', 'staple': 'ok'}
+
+
+def test_journal_stage_checks(toolchain, workdir):
+    config = make_config()
+    journal = pycodesign.StateJournal(workdir / 'tool.state.json', config)
+    assert journal.resume_stage() == 'sign'
+    for stage in ('sign', 'package'):
+        journal.start(stage)
+        (workdir / 'tool.pkg').write_bytes(b'pkg')
+        journal.record(stage, 0)
+    assert journal.resume_stage() == 'notarize'
+    # a package that changed on disk is built again
+    (workdir / 'tool.pkg').write_bytes(b'other pkg')
+    assert journal.resume_stage() == 'package'
+    # a failed stage is run again
+    journal.start('package')
+    journal.record('package', 1)
+    assert journal.resume_stage() == 'package'
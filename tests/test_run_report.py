@@ -0,0 +1,43 @@
+import asyncio
+import json
+import sys
+
+import pytest
+
+import pycodesign_core as pycodesign
+
+BUSY = 'import time\nend = time.process_time() + 0.2\nwhile time.process_time() < end: pass\nprint("done")'
+
+
+@pytest.fixture(autouse=True)
+def run_records(monkeypatch):
+    monkeypatch.setattr(pycodesign, 'RUN_RECORDS', [])
+    monkeypatch.setattr(pycodesign, 'RUN_SPANS', [])
+
+
+async def two_at_once():
+    return await asyncio.gather(*[pycodesign.run_command_async([sys.executable, '-c', BUSY]) for _ in range(2)])
+
+
+def test_cpu_time_of_async_commands_is_not_recorded(workdir, capsys):
+    with pycodesign.stage_span('sign', 'tool'):
+        assert pycodesign.run_command([sys.executable, '-c', BUSY])[0] == 0
+    with pycodesign.stage_span('notarize', 'tool'):
+        assert [r[0] for r in asyncio.run(two_at_once())] == [0, 0]
+
+    blocking, *polled = pycodesign.RUN_RECORDS
+    # wait4 gives the cpu time of just the blocking command
+    assert blocking['cpu_user'] + blocking['cpu_system'] >= 0.15
+    # commands on the event loop overlap, so they get no cpu time rather than a wrong one
+    assert [(r['cpu_user'], r['cpu_system'], r['stdout_bytes']) for r in polled] == [(None, None, 5)] * 2
+
+    sign, notarize = pycodesign.summarize_spans()
+    assert (sign['commands'], sign['cpu_commands']) == (1, 1)
+    assert sign['cpu_user'] == blocking['cpu_user']
+    assert (notarize['commands'], notarize['cpu_commands'], notarize['cpu_user']) == (2, 0, 0)
+
+    pycodesign.write_report(workdir / 'run.json')
+    pycodesign.write_trace(workdir / 'trace.json')
+    assert json.loads((workdir / 'run.json').read_text())['commands'][1]['cpu_user'] is None
+    events = json.loads((workdir / 'trace.json').read_text())['traceEvents']
+    assert [e['args']['cpu_user'] for e in events if e.get('cat') == 'subprocess'][1:] == [None, None]
@@ -0,0 +1,71 @@
+import asyncio
+from concurrent import futures
+
+import pytest
+
+import pycodesign_core as pycodesign
+
+CONFIG = '''[identification]
+application_id = TEAM123456
+installer_id = TEAM123456
+keychain-profile = profile
+[package_details]
+package_name = tool
+bundle_id = com.example.tool
+file_list = tool
+installation_path = /usr/local/bin
+entitlements = None
+version = 1.0
+[main]
+resolve_identity = no
+cache = no
+'''
+
+
+@pytest.fixture
+def projects(stub_bin, tmp_path):
+    stub_bin('codesign')
+    directories = []
+    for name in ('one', 'two'):
+        project = tmp_path / name
+        project.mkdir()
+        (project / 'tool.ini').write_text(CONFIG)
+        (project / 'tool').write_bytes(f'{name}\n'.encode())
+        directories.append(project)
+    return directories
+
+
+def run_jobs(requests):
+    server = pycodesign.SignServer('unused.sock')
+    events = []
+
+    async def run():
+        with futures.ThreadPoolExecutor(max_workers=4) as server.executor:
+            return await asyncio.gather(*[server.run_job(r, events.append) for r in requests])
+    return asyncio.run(run()), events
+
+
+def test_jobs_run_in_the_client_directory(projects, workdir):
+    (workdir / 'tool').write_bytes(b'server\n')
+    requests = [{'configs': ['tool.ini'], 'stages': ['sign'], 'cwd': str(p)} for p in projects]
+    results, events = run_jobs(requests)
+    assert [r[0]['stages']['sign']['status'] for r in results] == ['ok', 'ok']
+    for project in projects:
+        assert (project / 'tool').read_bytes() == f'{project.name}\nSIGNED\n'.encode()
+    assert (workdir / 'tool').read_bytes() == b'server\n'
+
+
+def test_absolute_configs_without_cwd(projects):
+    results, events = run_jobs([{'configs': [str(projects[0] / 'tool.ini')], 'stages': ['sign']}])
+    assert results[0][0]['stages']['sign']['status'] == 'ok'
+    assert (projects[0] / 'tool').read_bytes().endswith(b'SIGNED\n')
+
+
+def test_job_without_a_directory_is_rejected(projects, workdir):
+    (workdir / 'tool.ini').write_text(CONFIG)
+    (workdir / 'tool').write_bytes(b'server\n')
+    results, events = run_jobs([{'configs': ['tool.ini'], 'stages': ['sign']},
+                                {'configs': ['tool.ini'], 'stages': ['sign'], 'cwd': 'relative'}])
+    assert results == [[], []]
+    assert [e['event'] for e in events] == ['error', 'error']
+    assert (workdir / 'tool').read_bytes() == b'server\n'
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import make_config
+
+SIGN_ARGS = ['codesign', '--force', '--timestamp', '--options=runtime', '--sign', 'TEAM123456']
+
+
+@pytest.fixture
+def codesign(stub_bin):
+    return stub_bin('codesign')
+
+
+@pytest.fixture
+def files(workdir):
+    names = ['one', 'bad_two', 'three', 'four', 'bad_five']
+    for name in names:
+        (workdir / name).write_bytes(b'binary\n')
+    return names
+
+
+def codesign_calls(tmp_path):
+    with open(tmp_path / 'calls.log') as f:
+        return [c for c in map(json.loads, f) if c[0] == 'codesign']
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_failures_are_reported_per_file(codesign, files, workdir, tmp_path, pool):
+    results = pycodesign.sign_files(files, SIGN_ARGS, jobs=3, pool=pool)
+    assert [r['file'] for r in results] == files
+    assert [r['return_code'] for r in results] == [0, 1, 0, 0, 1]
+    assert b'bad_two: main executable failed strict validation' in results[1]['stderr']
+    # one codesign call per file and a failure does not stop the others
+    assert len(codesign_calls(tmp_path)) == len(files)
+    assert (workdir / 'four').read_bytes().endswith(b'SIGNED\n')
+    assert not (workdir / 'bad_five').read_bytes().endswith(b'SIGNED\n')
+
+
+def test_summary(codesign, files):
+    return_code, stdout, stderr = pycodesign.summarize_sign_results(pycodesign.sign_files(files, SIGN_ARGS, jobs=2))
+    assert return_code == 1
+    text = stderr.decode()
+    assert text.startswith('failed to sign 2 of 5 files:\n')
+    assert 'bad_two (return code 1):' in text
+    assert 'bad_five (return code 1):' in text
+    assert 'three' not in text
+
+
+def test_missing_codesign(files):
+    [result] = pycodesign.sign_files(files[:1], ['no-such-codesign', '--sign', 'x'], jobs=2)
+    assert result['return_code'] == 127
+
+
+def test_timeout(stub_bin, files, monkeypatch):
+    stub_bin('codesign')
+    monkeypatch.setenv('FAKE_CODESIGN_DELAY', '5')
+    [result] = pycodesign.sign_files(files[:1], SIGN_ARGS, jobs=1, timeout=0.2)
+    assert result['return_code'] != 0
+    assert b'timed out' in result['stderr']
+
+
+def test_sign_with_jobs(codesign, workdir, tmp_path):
+    for name in ('one', 'two', 'three'):
+        (workdir / name).write_bytes(b'binary\n')
+    config = make_config(file_list=['one', 'two', 'three'], jobs=2, cache='no')
+    return_code, stdout, stderr = pycodesign.sign(config)
+    assert return_code == 0
+    calls = codesign_calls(tmp_path)
+    assert sorted(c[-1] for c in calls) == ['one', 'three', 'two']
+    assert all('--deep' in c for c in calls)
+
+
+def test_sign_without_jobs_reports_failed_files(codesign, files, tmp_path, capsys):
+    config = make_config(file_list=files, cache='no')
+    return_code, stdout, stderr = pycodesign.sign(config)
+    assert return_code == 1
+    [call] = codesign_calls(tmp_path)
+    assert call[-len(files):] == files
+    out = capsys.readouterr().out
+    assert 'FAILED: bad_two' in out and 'FAILED: bad_five' in out
+    assert 'FAILED: one' not in out
@@ -0,0 +1,129 @@
+import json
+import os
+import plistlib
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import make_config
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return tmp_path / 'sign-cache'
+
+
+@pytest.fixture
+def codesign_stub(stub_bin):
+    return stub_bin('codesign')
+
+
+def codesign_calls(tmp_path):
+    with open(tmp_path / 'calls.log') as f:
+        return [c for c in map(json.loads, f) if c[0] == 'codesign']
+
+
+def sign_in_place(path):
+    with open(path, 'ab') as f:
+        f.write(b'SIGNED\n')
+
+
+def cached_copy(cache, path, data):
+    """sign `path` (holding `data`) through the cache the way sign_files() does"""
+    path.write_bytes(data)
+    status, input_hash = cache.lookup(str(path))
+    assert status is None
+    sign_in_place(path)
+    cache.store(str(path), input_hash)
+    return pycodesign.file_sha256(str(path))
+
+
+def test_off_by_default(codesign_stub, workdir, tmp_path):
+    (workdir / 'tool').write_bytes(b'binary\n')
+    assert pycodesign.get_sign_cache(make_config()) is None
+    for _ in range(2):
+        (workdir / 'tool').write_bytes(b'binary\n')
+        assert pycodesign.sign(make_config(jobs=1))[0] == 0
+    assert len(codesign_calls(tmp_path)) == 2
+    assert not (tmp_path / 'home').exists()
+
+
+def test_hit_and_miss(cache_dir, workdir):
+    cache = pycodesign.SignCache(cache_dir, 'options')
+    tool = workdir / 'tool'
+    signed = cached_copy(cache, tool, b'binary\n')
+    # the signed file itself is known
+    assert cache.lookup(str(tool))[0] == 'signed'
+    # the unsigned input is restored from the blob without signing
+    tool.write_bytes(b'binary\n')
+    tool.chmod(0o751)
+    assert cache.lookup(str(tool))[0] == 'restored'
+    assert tool.read_bytes() == b'binary\nSIGNED\n'
+    assert tool.stat().st_mode & 0o777 == 0o751
+    # other contents miss
+    tool.write_bytes(b'binary 2\n')
+    assert cache.lookup(str(tool))[0] is None
+    assert cache.run_stats == {'hits': 2, 'misses': 2, 'stores': 1, 'evictions': 0}
+    cache.save()
+    # the index survives a new process
+    assert pycodesign.SignCache(cache_dir, 'options').index['entries'][cache.key(signed)] == signed
+
+
+def test_identity_and_entitlements_change_the_key(cache_dir, workdir):
+    entitlements = workdir / 'entitlements.plist'
+    entitlements.write_bytes(plistlib.dumps({'com.apple.security.cs.allow-jit': True}))
+
+    def config(application_id='Developer ID Application: Example (TEAM123456)'):
+        config = make_config(cache='yes', cache_dir=str(cache_dir))
+        config['identification']['application_id'] = application_id
+        config['package_details']['entitlements'] = str(entitlements)
+        return config
+
+    cache = pycodesign.get_sign_cache(config(), ['codesign', '--sign'])
+    cached_copy(cache, workdir / 'tool', b'binary\n')
+    cache.save()
+
+    def lookup(config, sign_args=('codesign', '--sign')):
+        (workdir / 'tool').write_bytes(b'binary\n')
+        return pycodesign.get_sign_cache(config, list(sign_args)).lookup(str(workdir / 'tool'))[0]
+
+    assert lookup(config()) == 'restored'
+    assert lookup(config('Developer ID Application: Other (TEAM654321)')) is None
+    assert lookup(config(), ('codesign', '--sign', '--options=runtime')) is None
+    entitlements.write_bytes(plistlib.dumps({'com.apple.security.cs.allow-jit': False}))
+    assert lookup(config()) is None
+
+
+def test_least_recently_used_blobs_are_evicted(cache_dir, workdir, monkeypatch):
+    clock = iter(range(1000))
+    monkeypatch.setattr(pycodesign.time, 'time', lambda: next(clock))
+    cache = pycodesign.SignCache(cache_dir, 'options', max_size=2*len(b'file 0\nSIGNED\n'))
+    signed = [cached_copy(cache, workdir / f'file{i}', f'file {i}\n'.encode()) for i in range(3)]
+    # file0 is used again, so file1 is now the least recently used
+    assert cache.lookup(str(workdir / 'file0'))[0] == 'signed'
+    cache.save()
+    assert sorted(cache.index['blobs']) == sorted([signed[0], signed[2]])
+    assert not cache.blob_path(signed[1]).exists()
+    assert signed[1] not in cache.index['entries'].values()
+    assert cache.index['stats']['evictions'] == 1
+
+
+def test_corrupt_blob_is_a_miss(cache_dir, workdir):
+    cache = pycodesign.SignCache(cache_dir, 'options')
+    signed = cached_copy(cache, workdir / 'tool', b'binary\n')
+    cache.blob_path(signed).write_bytes(b'truncated')
+    (workdir / 'tool').write_bytes(b'binary\n')
+    assert cache.lookup(str(workdir / 'tool'))[0] is None
+    assert (workdir / 'tool').read_bytes() == b'binary\n'
+    assert not cache.blob_path(signed).exists()
+    assert signed not in cache.index['blobs']
+    assert not [f for f in os.listdir(workdir) if f.endswith('.pycodesign-restore')]
+
+
+def test_sign_with_cache(codesign_stub, workdir, tmp_path, cache_dir):
+    config = make_config(jobs=1, cache='yes', cache_dir=str(cache_dir))
+    for _ in range(2):
+        (workdir / 'tool').write_bytes(b'binary\n')
+        assert pycodesign.sign(config)[0] == 0
+        assert (workdir / 'tool').read_bytes() == b'binary\nSIGNED\n'
+    assert len(codesign_calls(tmp_path)) == 1
@@ -0,0 +1,134 @@
+import errno
+import os
+import shutil
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import make_config
+
+BACKENDS = ('auto', 'hardlink', 'reflink', 'copy', 'ditto')
+
+
+@pytest.fixture
+def bundle(workdir):
+    """a small .app with an executable, a private file, a relative link and a dangling link"""
+    root = workdir / 'Tool.app' / 'Contents'
+    (root / 'MacOS').mkdir(parents=True)
+    (root / 'MacOS' / 'tool').write_bytes(b'\xcf\xfa\xed\xfe binary')
+    (root / 'MacOS' / 'tool').chmod(0o755)
+    (root / 'Frameworks' / 'Helper.framework' / 'Versions' / 'A').mkdir(parents=True)
+    (root / 'Frameworks' / 'Helper.framework' / 'Versions' / 'A' / 'Helper').write_bytes(b'helper')
+    os.symlink('A', root / 'Frameworks' / 'Helper.framework' / 'Versions' / 'Current')
+    os.symlink('Versions/Current/Helper', root / 'Frameworks' / 'Helper.framework' / 'Helper')
+    os.symlink('../Resources/missing', root / 'MacOS' / 'dangling')
+    (root / 'Resources').mkdir()
+    (root / 'Resources' / 'secret').write_bytes(b'secret')
+    (root / 'Resources' / 'secret').chmod(0o640)
+    os.utime(root / 'Resources' / 'secret', (1_000_000_000, 1_000_000_000))
+    return workdir / 'Tool.app'
+
+
+def tree(path):
+    """{relative path: (kind, mode, link target or contents)} of everything under `path`"""
+    entries = {}
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            full = os.path.join(root, name)
+            st = os.lstat(full)
+            if os.path.islink(full):
+                entries[os.path.relpath(full, path)] = ('link', None, os.readlink(full))
+            elif os.path.isdir(full):
+                entries[os.path.relpath(full, path)] = ('dir', st.st_mode & 0o7777, None)
+            else:
+                with open(full, 'rb') as f:
+                    entries[os.path.relpath(full, path)] = ('file', st.st_mode & 0o7777, f.read())
+    return entries
+
+
+def stage(name, src, dst):
+    stats = pycodesign.new_staging_stats()
+    pycodesign.STAGING_BACKENDS[name](src, dst, stats)
+    return stats
+
+
+@pytest.mark.parametrize('name', BACKENDS)
+def test_tree_is_recreated(name, bundle, tmp_path):
+    if name == 'ditto' and not shutil.which('ditto'):
+        pytest.skip('ditto is only available on macOS')
+    staged = tmp_path / 'stage' / 'Tool.app'
+    staged.parent.mkdir()
+    stats = stage(name, bundle, staged)
+    assert tree(staged) == tree(bundle)
+    assert stats['files'] == 3
+    assert stats['bytes_linked'] + stats['bytes_cloned'] + stats['bytes_copied'] == len(b'\xcf\xfa\xed\xfe binary') + 12
+    secret = staged / 'Contents' / 'Resources' / 'secret'
+    assert secret.stat().st_mtime == 1_000_000_000
+    # links are recreated, never followed
+    assert (staged / 'Contents' / 'Frameworks' / 'Helper.framework' / 'Versions' / 'Current').is_symlink()
+    assert (staged / 'Contents' / 'MacOS' / 'dangling').is_symlink()
+
+
+def test_hardlink_shares_the_source_inode(bundle, tmp_path):
+    stats = stage('hardlink', bundle, tmp_path / 'Tool.app')
+    tool = 'Contents/MacOS/tool'
+    assert os.stat(tmp_path / 'Tool.app' / tool).st_ino == os.stat(bundle / tool).st_ino
+    assert stats['bytes_linked'] > 0 and stats['bytes_copied'] == 0
+
+
+@pytest.mark.parametrize('name', ['copy', 'reflink'])
+def test_copies_are_separate_files(name, bundle, tmp_path):
+    stage(name, bundle, tmp_path / 'Tool.app')
+    tool = 'Contents/MacOS/tool'
+    assert os.stat(tmp_path / 'Tool.app' / tool).st_ino != os.stat(bundle / tool).st_ino
+    (tmp_path / 'Tool.app' / tool).write_bytes(b'changed')
+    assert (bundle / tool).read_bytes() == b'\xcf\xfa\xed\xfe binary'
+
+
+def test_hardlink_falls_back_to_a_copy(bundle, tmp_path, monkeypatch):
+    def cross_device(*args, **kwargs):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(pycodesign.os, 'link', cross_device)
+    stats = stage('hardlink', bundle, tmp_path / 'Tool.app')
+    assert tree(tmp_path / 'Tool.app') == tree(bundle)
+    assert stats['bytes_linked'] == 0
+    assert stats['bytes_cloned'] + stats['bytes_copied'] > 0
+
+
+def test_reflink_falls_back_to_a_copy(bundle, tmp_path, monkeypatch):
+    # filesystems without FICLONE (ext4, tmpfs) end up here on Linux
+    def no_clone(src, dst):
+        raise OSError(errno.EOPNOTSUPP, 'Operation not supported')
+    monkeypatch.setattr(pycodesign, 'clone_file', no_clone)
+    stats = stage('reflink', bundle, tmp_path / 'with_copy_file_range')
+    assert tree(tmp_path / 'with_copy_file_range') == tree(bundle)
+    assert stats['bytes_cloned'] == 0 and stats['bytes_copied'] > 0
+
+    monkeypatch.delattr(pycodesign.os, 'copy_file_range', raising=False)
+    stats = stage('reflink', bundle, tmp_path / 'in_process')
+    assert tree(tmp_path / 'in_process') == tree(bundle)
+    assert stats['bytes_cloned'] == 0 and stats['bytes_copied'] > 0
+
+
+def test_single_file_and_link_entries(workdir, tmp_path):
+    (workdir / 'tool').write_bytes(b'tool')
+    (workdir / 'tool').chmod(0o700)
+    os.symlink('tool', workdir / 'alias')
+    for name in ('auto', 'copy'):
+        stage(name, workdir / 'tool', tmp_path / f'{name}-tool')
+        stage(name, workdir / 'alias', tmp_path / f'{name}-alias')
+        assert (tmp_path / f'{name}-tool').stat().st_mode & 0o777 == 0o700
+        assert os.readlink(tmp_path / f'{name}-alias') == 'tool'
+
+
+def test_backend_selection(caplog):
+    assert pycodesign.get_staging_backend(make_config())[0] == 'auto'
+    assert pycodesign.get_staging_backend(make_config(staging='copy')) == ('copy', pycodesign.STAGING_BACKENDS['copy'])
+    assert pycodesign.get_staging_backend(make_config(staging='rsync'))[0] == 'auto'
+    assert 'unknown staging backend "rsync"' in caplog.text
+
+
+def test_auto_links_on_the_same_filesystem(bundle, tmp_path):
+    stats = stage('auto', bundle, tmp_path / 'Tool.app')
+    assert stats['bytes_copied'] == stats['bytes_cloned'] == 0
+    assert stats['bytes_linked'] == len(b'\xcf\xfa\xed\xfe binary') + 12
@@ -0,0 +1,107 @@
+import configparser
+import json
+import os
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import make_config
+
+# Gatekeeper rejects artifacts named "unsigned*"; "flaky*" loses the connection on the first try
+SPCTL = '''#!/usr/bin/env python3
+import json, os, sys
+state = os.environ['STUB_STATE']
+with open(os.path.join(state, 'calls.log'), 'a') as f:
+    f.write(json.dumps(['spctl', *sys.argv[1:]]) + '\\n')
+name = os.path.basename(sys.argv[-1])
+if name.startswith('unsigned'):
+    print(f'{sys.argv[-1]}: rejected\\nsource=no usable signature')
+    sys.exit(3)
+if name.startswith('flaky') and not os.path.exists(os.path.join(state, 'flaky')):
+    open(os.path.join(state, 'flaky'), 'w').close()
+    print('the network connection was lost')
+    sys.exit(1)
+print(f'{sys.argv[-1]}: accepted\\nsource=Notarized Developer ID')
+'''
+
+CHECK_SIGNATURE = '''#!/usr/bin/env python3
+import json, os, sys
+with open(os.path.join(os.environ['STUB_STATE'], 'calls.log'), 'a') as f:
+    f.write(json.dumps([os.path.basename(sys.argv[0]), *sys.argv[1:]]) + '\\n')
+print(f'Package "{sys.argv[-1]}":\\n   Status: signed by a developer certificate issued by Apple for distribution')
+'''
+
+
+@pytest.fixture
+def tools(stub_bin):
+    stub_bin('xcrun')
+    stub_bin('spctl', SPCTL)
+    stub_bin('pkgutil', CHECK_SIGNATURE)
+    stub_bin('codesign', CHECK_SIGNATURE)
+
+
+@pytest.fixture
+def release(workdir):
+    root = workdir / 'release'
+    (root / 'nested').mkdir(parents=True)
+    (root / 'tool.pkg').write_bytes(b'pkg\n')
+    (root / 'nested' / 'tool.dmg').write_bytes(b'dmg\n')
+    (root / 'Tool.app' / 'Contents' / 'Helpers' / 'Helper.app').mkdir(parents=True)
+    (root / 'unsigned.pkg').write_bytes(b'pkg\n')
+    (root / 'flaky.dmg').write_bytes(b'dmg\n')
+    (root / 'notes.txt').write_bytes(b'notes\n')
+    return root
+
+
+def calls(tmp_path, tool):
+    with open(tmp_path / 'calls.log') as f:
+        return [c for c in map(json.loads, f) if c[0] == tool]
+
+
+def test_find_artifacts(release, workdir):
+    parser = configparser.ConfigParser()
+    parser.read_dict(make_config(package_name='other'))
+    with open(workdir / 'other.ini', 'w') as f:
+        parser.write(f)
+    found = pycodesign.find_artifacts(['release', 'other.ini', 'release/*.pkg'])
+    paths = [p for p, config in found]
+    # files first, then the bundles; nothing inside a bundle
+    assert paths == ['release/flaky.dmg', 'release/tool.pkg', 'release/unsigned.pkg', 'release/Tool.app',
+                     'release/nested/tool.dmg', 'other.pkg', 'release/tool.pkg', 'release/unsigned.pkg']
+    # a configuration file stands for the package it builds
+    assert found[5][1]['package_details']['package_name'] == 'other'
+
+
+def test_staple_verify_command(tools, release, tmp_path, capsys):
+    return_code = pycodesign.staple_verify_main(['release', '-j', '3', '--retry-delay', '0'])
+    assert return_code == 1
+    out = capsys.readouterr().out
+    assert '4 of 5 artifacts passed' in out
+    # attempts counts every run of every check
+    rows = {line.split()[0]: line.split()[1:] for line in out.splitlines() if line.startswith('release/')}
+    assert rows['release/tool.pkg'] == ['ok', 'ok', 'ok', 'ok', '4', 'pass']
+    # the failed check stops the ones after it
+    assert rows['release/unsigned.pkg'][:6] == ['ok', 'ok', 'failed', 'skipped', '3', 'FAIL']
+    assert 'assess: source=no usable signature' in out
+    # a transient error is retried
+    assert rows['release/flaky.dmg'] == ['ok', 'ok', 'ok', 'ok', '5', 'pass']
+    assert rows['release/Tool.app'][-1] == 'pass'
+    assert len(calls(tmp_path, 'xcrun')) == 10
+    stapled = [c[-1] for c in calls(tmp_path, 'xcrun') if c[2] == 'staple']
+    assert sorted(stapled) == sorted(['release/Tool.app', 'release/flaky.dmg', 'release/tool.pkg',
+                                      'release/unsigned.pkg', 'release/nested/tool.dmg'])
+    assert (release / 'tool.pkg').read_bytes() == b'pkg\nSTAPLED\n'
+    assert (release / 'Tool.app' / 'Contents' / 'CodeResources').read_bytes() == b'STAPLED\n'
+
+
+def test_verify_only(tools, release, tmp_path, capsys):
+    assert pycodesign.staple_verify_main(['--verify-only', 'release/tool.pkg', 'release/nested']) == 0
+    assert '2 of 2 artifacts passed' in capsys.readouterr().out
+    assert all(c[2] == 'validate' for c in calls(tmp_path, 'xcrun'))
+    assert (release / 'tool.pkg').read_bytes() == b'pkg\n'
+
+
+def test_nothing_found(tools, workdir, capsys):
+    assert pycodesign.staple_verify_main([str(workdir)]) == 1
+    assert 'no .pkg, .dmg or .app artifacts found' in capsys.readouterr().out
+    assert not os.path.exists(os.path.join(os.environ['STUB_STATE'], 'calls.log'))
@@ -0,0 +1,95 @@
+import json
+import sys
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import STUBS, make_config
+
+SIGN_ARGS = ['codesign', '--force', '--sign', 'TEAM123456']
+
+
+@pytest.fixture
+def slices(workdir):
+    for arch in ('arm64', 'x86_64'):
+        (workdir / arch).mkdir()
+        for name in ('tool', 'helper'):
+            (workdir / arch / name).write_bytes(f'{arch} {name}\n'.encode())
+
+
+def calls(tmp_path, tool):
+    with open(tmp_path / 'calls.log') as f:
+        return [c for c in map(json.loads, f) if c[0] == tool]
+
+
+def universal_config(**main):
+    config = make_config(**main)
+    config['package_details']['file_list'] = 'extra'
+    config['arch.arm64'] = {'file_list': 'arm64/tool, arm64/helper'}
+    config['arch.x86_64'] = {'file_list': 'x86_64/tool, x86_64/helper'}
+    # lipo is injected through [tools] instead of PATH
+    config['tools'] = {'lipo': f'{sys.executable} {STUBS / "lipo"}'}
+    return pycodesign.split_file_list(config)
+
+
+def test_merge_slices(workdir, tmp_path):
+    lipo = [sys.executable, str(STUBS / 'lipo')]
+    (workdir / 'a').write_bytes(b'a\n')
+    (workdir / 'b').write_bytes(b'b\n')
+    result = pycodesign.merge_slices(lipo, workdir / 'out' / 'tool', ['a', 'b'])
+    assert result == {'file': str(workdir / 'out' / 'tool'), 'return_code': 0, 'stdout': b'', 'stderr': b''}
+    assert (workdir / 'out' / 'tool').read_bytes() == b'a\nb\n'
+    assert calls(tmp_path, 'lipo') == [['lipo', '-create', '-output', str(workdir / 'out' / 'tool'), 'a', 'b']]
+
+
+def test_merge_slices_failure(workdir):
+    lipo = [sys.executable, str(STUBS / 'lipo')]
+    (workdir / 'same1').write_bytes(b'a\n')
+    (workdir / 'same2').write_bytes(b'b\n')
+    result = pycodesign.merge_slices(lipo, workdir / 'tool', ['same1', 'same2'])
+    assert result['return_code'] == 1
+    assert b'have the same architectures' in result['stderr']
+
+
+def test_missing_lipo(workdir):
+    result = pycodesign.merge_slices(['no-such-lipo'], workdir / 'tool', ['a', 'b'])
+    assert result['return_code'] == 127
+
+
+def test_config_adds_merged_binaries(slices):
+    config = universal_config()
+    details = config['package_details']
+    assert details['arch_file_lists'] == {'arm64': ['arm64/tool', 'arm64/helper'],
+                                          'x86_64': ['x86_64/tool', 'x86_64/helper']}
+    assert details['file_list'] == ['extra', 'universal/tool', 'universal/helper']
+
+
+def test_sign_universal(stub_bin, slices, workdir, tmp_path):
+    stub_bin('codesign')
+    results = pycodesign.sign_universal(universal_config(), SIGN_ARGS, jobs=4)
+    assert all(r['return_code'] == 0 for r in results)
+    assert len(results) == 4 + 2 + 2
+
+    # slices are signed before they are merged and the merged binary is signed again
+    merged = (workdir / 'universal' / 'tool').read_bytes()
+    assert merged == b'arm64 tool\nSIGNED\nx86_64 tool\nSIGNED\nSIGNED\n'
+    signed = [c[-1] for c in calls(tmp_path, 'codesign')]
+    assert sorted(signed) == sorted(['arm64/tool', 'arm64/helper', 'x86_64/tool', 'x86_64/helper',
+                                     'universal/tool', 'universal/helper'])
+    for name in ('tool', 'helper'):
+        assert signed.index(f'universal/{name}') > max(signed.index(f'{a}/{name}') for a in ('arm64', 'x86_64'))
+    assert [c[3:] for c in calls(tmp_path, 'lipo') if c[3].endswith('tool')] == [['universal/tool', 'arm64/tool', 'x86_64/tool']]
+
+
+def test_failed_slice_is_not_merged(stub_bin, slices, workdir, tmp_path):
+    stub_bin('codesign')
+    (workdir / 'x86_64' / 'bad').write_bytes(b'x86_64 bad\n')
+    (workdir / 'arm64' / 'bad').write_bytes(b'arm64 bad\n')
+    config = universal_config()
+    config['package_details']['arch_file_lists']['arm64'].append('arm64/bad')
+    config['package_details']['arch_file_lists']['x86_64'].append('x86_64/bad')
+    results = pycodesign.sign_universal(config, SIGN_ARGS, jobs=2)
+    failed = [r['file'] for r in results if r['return_code']]
+    assert sorted(failed) == ['arm64/bad', 'x86_64/bad']
+    assert not (workdir / 'universal' / 'bad').exists()
+    assert (workdir / 'universal' / 'tool').exists()
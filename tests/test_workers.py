@@ -0,0 +1,211 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import ROOT, make_config
+
+SIGN_ARGS = ['codesign', '--force', '--timestamp', '--options=runtime', '--sign', 'TEAM123456']
+TOKEN = 'secret'
+WORKER = [sys.executable, str(ROOT / 'pycodesign.py'), 'worker']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        assert process.poll() is None, process.stdout.read()
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f'worker on port {port} did not start')
+
+
+@pytest.fixture
+def workers(stub_bin, tmp_path, monkeypatch):
+    """start `count` local TCP workers sharing the stub codesign; returns their addresses"""
+    stub_bin('codesign')
+    monkeypatch.setenv('PYCODESIGN_WORKER_TOKEN', TOKEN)
+    processes = []
+
+    def start(count):
+        addresses = []
+        for i in range(count):
+            port = free_port()
+            process = subprocess.Popen(WORKER + ['--listen', f'127.0.0.1:{port}', '--store', str(tmp_path / f'store{port}')],
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            processes.append(process)
+            wait_for_port(port, process)
+            addresses.append(f'127.0.0.1:{port}')
+        return addresses
+    yield start
+    for process in processes:
+        process.kill()
+        process.wait()
+        process.stdout.close()
+
+
+@pytest.fixture
+def items(workdir):
+    files = []
+    for i in range(6):
+        (workdir / f'lib{i}.dylib').write_bytes(f'library {i}\n'.encode())
+        files.append(f'lib{i}.dylib')
+    app = workdir / 'Tool.app' / 'Contents'
+    (app / 'MacOS').mkdir(parents=True)
+    (app / 'MacOS' / 'tool').write_bytes(b'tool\n')
+    (app / 'Info.plist').write_bytes(b'<plist/>\n')
+    (app / 'Current').symlink_to('MacOS')
+    return files + ['Tool.app']
+
+
+def remote_signer(addresses, **main):
+    config = make_config(workers=', '.join(addresses), **main)
+    return pycodesign.get_remote_signer(config, SIGN_ARGS)
+
+
+def test_sign_on_several_workers(workers, items, workdir, tmp_path, monkeypatch):
+    monkeypatch.setenv('FAKE_CODESIGN_DELAY', '0.2')
+    addresses = workers(3)
+    signer = remote_signer(addresses, worker_jobs=2)
+    results = pycodesign.sign_files(items, SIGN_ARGS, remote=signer)
+    assert [r['file'] for r in results] == items
+    assert all(r['return_code'] == 0 and r['worker'] for r in results)
+    # every worker has its own store; the items were spread over them
+    used = [a for a in addresses if list((tmp_path / f'store{a.rpartition(":")[2]}').glob('??/*'))]
+    assert len(used) >= 2
+    for name in items[:-1]:
+        assert (workdir / name).read_bytes().endswith(b'\nSIGNED\n')
+    # signed trees are copied back, links included
+    app = workdir / 'Tool.app' / 'Contents'
+    assert (app / '_CodeSignature' / 'CodeResources').read_text() == 'signed\n'
+    assert os.readlink(app / 'Current') == 'MacOS'
+    assert (app / 'MacOS' / 'tool').read_bytes() == b'tool\n'
+
+
+def test_failures_come_back_per_file(workers, workdir):
+    (workdir / 'good').write_bytes(b'good\n')
+    (workdir / 'bad_one').write_bytes(b'bad\n')
+    results = pycodesign.sign_files(['good', 'bad_one'], SIGN_ARGS, remote=remote_signer(workers(1)))
+    assert [r['return_code'] for r in results] == [0, 1]
+    # messages name the file the way it was listed, not the worker's copy
+    assert results[1]['stderr'] == b'bad_one: main executable failed strict validation\n'
+    assert (workdir / 'bad_one').read_bytes() == b'bad\n'
+
+
+def test_dead_worker_is_retried_elsewhere(workers, stub_bin, items, tmp_path, workdir):
+    good = workers(1)
+    # a codesign that kills the worker running it
+    deadly = tmp_path / 'deadly'
+    deadly.mkdir()
+    (deadly / 'codesign').write_text('#!/bin/sh\nkill -9 $PPID\n')
+    (deadly / 'codesign').chmod(0o755)
+    dead = f'exec:env PATH={deadly}:{os.environ["PATH"]} {" ".join(WORKER)} --stdio --store {tmp_path / "dead"}'
+    signer = remote_signer([dead] + good)
+    results = pycodesign.sign_files(items, SIGN_ARGS, remote=signer)
+    assert all(r['return_code'] == 0 for r in results)
+    assert {r['worker'] for r in results} == {socket.gethostname()}
+    assert (workdir / 'lib0.dylib').read_bytes().endswith(b'SIGNED\n')
+
+
+def test_local_fallback_without_workers(stub_bin, items, workdir):
+    stub_bin('codesign')
+    signer = remote_signer([f'127.0.0.1:{free_port()}'])
+    results = pycodesign.sign_files(items[:2], SIGN_ARGS, remote=signer)
+    assert all(r['return_code'] == 0 and not r.get('worker') for r in results)
+    assert (workdir / 'lib1.dylib').read_bytes().endswith(b'SIGNED\n')
+
+
+def test_bad_token(workers, monkeypatch):
+    [address] = workers(1)
+    with pytest.raises(ConnectionError, match='bad token'):
+        pycodesign.WorkerConnection({}, address, 'wrong')
+
+
+def test_worker_needs_a_token(monkeypatch, capsys):
+    monkeypatch.delenv('PYCODESIGN_WORKER_TOKEN', raising=False)
+    assert pycodesign.worker_main(['--listen', f'127.0.0.1:{free_port()}', '--store', 'store']) == 1
+    assert 'refusing to listen' in capsys.readouterr().out
+
+
+def test_stalled_worker_is_dropped(stub_bin, workdir):
+    """a worker that says hello and then never answers; the watchdog has to wake the reader"""
+    stub_bin('codesign')
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+
+    def stall():
+        connection, _ = listener.accept()
+        with connection, connection.makefile('rb') as rfile:
+            rfile.readline()
+            connection.sendall(b'{"ok": true, "version": "%s", "host": "stalled"}\n' % pycodesign.version.encode())
+            while rfile.readline():
+                pass
+    threading.Thread(target=stall, daemon=True).start()
+
+    (workdir / 'tool').write_bytes(b'tool\n')
+    signer = remote_signer([f'127.0.0.1:{listener.getsockname()[1]}'], worker_timeout=1)
+    start = time.monotonic()
+    [result] = pycodesign.sign_files(['tool'], SIGN_ARGS, remote=signer)
+    assert time.monotonic() - start < 5
+    assert result['return_code'] == 0 and not result.get('worker')
+    listener.close()
+
+
+def job_request(store, entries, root='x'):
+    return {'op': 'sign', 'root': root, 'entries': entries, 'identity': 'TEAM123456', 'options': []}
+
+
+@pytest.mark.parametrize('target', ['/tmp', '../outside', 'a/../../outside'])
+def test_worker_refuses_links_out_of_the_job(tmp_path, target):
+    store = pycodesign.WorkerStore(tmp_path / 'store')
+    evil = tmp_path / 'evil'
+    evil.write_bytes(b'evil\n')
+    digest = store.add_file(evil)
+    entries = [{'path': 'x', 'type': 'dir', 'mode': 0o755},
+               {'path': 'x/esc', 'type': 'link', 'target': target},
+               {'path': 'x/esc/evil', 'type': 'file', 'mode': 0o644, 'digest': digest}]
+    with pytest.raises(ValueError, match='must point inside the job'):
+        pycodesign.worker_sign(store, job_request(store, entries))
+
+
+def test_worker_never_writes_through_a_link(tmp_path, stub_bin):
+    stub_bin('codesign')
+    store = pycodesign.WorkerStore(tmp_path / 'store')
+    evil = tmp_path / 'evil'
+    evil.write_bytes(b'evil\n')
+    digest = store.add_file(evil)
+    # the link stays inside the job but a file is written below it
+    entries = [{'path': 'x', 'type': 'dir', 'mode': 0o755},
+               {'path': 'x/real', 'type': 'dir', 'mode': 0o755},
+               {'path': 'x/esc', 'type': 'link', 'target': 'real'},
+               {'path': 'x/esc/evil', 'type': 'file', 'mode': 0o644, 'digest': digest}]
+    with pytest.raises(ValueError, match='inside the symlink x/esc'):
+        pycodesign.worker_sign(store, job_request(store, entries))
+    # a file entry at the same path as a link
+    entries = [{'path': 'x', 'type': 'dir', 'mode': 0o755},
+               {'path': 'x/esc', 'type': 'link', 'target': 'real'},
+               {'path': 'x/./esc', 'type': 'file', 'mode': 0o644, 'digest': digest}]
+    with pytest.raises(ValueError, match='must not repeat'):
+        pycodesign.worker_sign(store, job_request(store, entries))
+
+
+def test_item_with_outside_links_is_signed_locally(workers, workdir):
+    (workdir / 'Tool.app').mkdir()
+    (workdir / 'Tool.app' / 'up').symlink_to('../elsewhere')
+    [result] = pycodesign.sign_files(['Tool.app'], SIGN_ARGS, remote=remote_signer(workers(1)))
+    assert result['return_code'] == 0 and not result.get('worker')
+    assert (workdir / 'Tool.app' / 'Contents' / '_CodeSignature' / 'CodeResources').exists()
@@ -0,0 +1,52 @@
+from pathlib import Path
+
+import pytest
+
+import pycodesign_core as pycodesign
+from conftest import make_config
+
+
+@pytest.fixture
+def staging(workdir):
+    root = workdir / 'staging'
+    (root / 'usr/local/bin').mkdir(parents=True)
+    (root / 'usr/local/bin/tool').write_bytes(b'tool\n')
+    return root
+
+
+def test_signed_package_replaces_the_old_one(stub_bin, staging, workdir):
+    stub_bin('productsign')
+    package = workdir / 'tool.pkg'
+    package.write_bytes(b'old package\n')
+    return_code, stdout, stderr = pycodesign.xar_package(make_config(), staging, Path('tool.pkg'))
+    assert return_code == 0, stderr
+    assert package.read_bytes().startswith(b'xar!')
+    assert package.read_bytes().endswith(b'PRODUCTSIGNED\n')
+    assert sorted(p.name for p in workdir.glob('*.pkg')) == ['tool.pkg']
+
+
+def test_failed_signing_keeps_the_old_package(stub_bin, staging, workdir, monkeypatch):
+    stub_bin('productsign')
+    monkeypatch.setenv('FAKE_PRODUCTSIGN_FAIL', '1')
+    (workdir / 'tool.pkg').write_bytes(b'old package\n')
+    return_code, stdout, stderr = pycodesign.xar_package(make_config(), staging, Path('tool.pkg'))
+    assert return_code == 1
+    assert b'tool.pkg was not replaced; the unsigned package is tool.unsigned.pkg' in stderr
+    assert (workdir / 'tool.pkg').read_bytes() == b'old package\n'
+    assert (workdir / 'tool.unsigned.pkg').read_bytes().startswith(b'xar!')
+    assert not (workdir / 'tool.signing.pkg').exists()
+
+
+def test_missing_productsign(staging, workdir, monkeypatch):
+    monkeypatch.setenv('PATH', str(workdir / 'empty'))
+    (workdir / 'tool.pkg').write_bytes(b'old package\n')
+    return_code, stdout, stderr = pycodesign.xar_package(make_config(), staging, Path('tool.pkg'))
+    assert return_code == 127
+    assert stderr.startswith(b'could not run productsign:')
+    assert (workdir / 'tool.pkg').read_bytes() == b'old package\n'
+
+
+def test_unsigned(staging, workdir):
+    return_code, stdout, stderr = pycodesign.xar_package(make_config(pkg_sign='no'), staging, Path('tool.pkg'))
+    assert return_code == 0
+    assert (workdir / 'tool.pkg').read_bytes().startswith(b'xar!')